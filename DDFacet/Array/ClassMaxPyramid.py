@@ -0,0 +1,108 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+
+
+class ClassMaxPyramid(object):
+    """
+    Hierarchical peak-search index for minor cycle loops, where the peak of an image is looked up at every
+    iteration but the image only changes in a small window (the PSF subtraction) in between.
+
+    The image is cut into TileSize x TileSize tiles. For each tile we keep the maximum and its position, and for each
+    row of tiles the maximum over that row. Looking up the global peak then only scans the row maxima and one row of
+    tiles, and update() only rescans the tiles overlapping the window that was modified.
+
+    Semantics follow the C routine behind NpParallel.A_whereMax (pyWhereMax/pyWhereMaxMask): if DoAbs is set the
+    search is on abs(A), pixels where Mask!=0 and NaNs are skipped, and leading axes of A (e.g. pol) are searched
+    jointly. As in the C code, the peak is only looked for above 0: if no pixel is positive (e.g. all are masked,
+    or all negative with DoAbs=0), whereMax() returns 0,0,0. Between exactly equal maxima, the pixel returned may
+    differ from that of the C code, which takes the first in row-major order. A is referenced, not copied, so the
+    caller modifies A in place and then calls update() on the modified window.
+    """
+    def __init__(self, A, DoAbs=1, Mask=None, TileSize=64):
+        NX, NY = A.shape[-2], A.shape[-1]
+        nz = A.size/(NX*NY)
+        # take a view with the (nz,NX,NY) shape: this raises an error rather than silently copying A
+        self.A = A.view()
+        self.A.shape = (nz, NX, NY)
+        self.NX, self.NY = NX, NY
+        self.DoAbs = DoAbs
+        if Mask is not None:
+            Mask = (np.asarray(Mask) != 0).reshape((-1, NX, NY))
+        self.Mask = Mask
+        self.TileSize = T = int(TileSize)
+        self.NTilesX = (NX+T-1)/T
+        self.NTilesY = (NY+T-1)/T
+        self.TileMax = np.zeros((self.NTilesX, self.NTilesY), A.dtype)
+        self.TileArgMax = np.zeros((self.NTilesX, self.NTilesY), np.int64)
+        self.RowMax = np.zeros((self.NTilesX,), A.dtype)
+        self.RowArgMax = np.zeros((self.NTilesX,), np.int64)
+        # scan one row of tiles at a time to keep the temporary arrays small
+        for itx in xrange(self.NTilesX):
+            self._scanTiles(itx, itx+1, 0, self.NTilesY)
+
+    def _scanTiles(self, tx0, tx1, ty0, ty1):
+        T = self.TileSize
+        x0, x1 = tx0*T, min(tx1*T, self.NX)
+        y0, y1 = ty0*T, min(ty1*T, self.NY)
+        A = self.A[:, x0:x1, y0:y1]
+        if self.DoAbs:
+            A = np.abs(A)
+        # NaNs are skipped, as the comparisons of the C code do
+        Skip = np.isnan(A)
+        if self.Mask is not None:
+            Skip |= self.Mask[:, x0:x1, y0:y1]
+        A = np.where(Skip, -np.inf, A).astype(self.TileMax.dtype)
+        A = A.max(axis=0)
+        # pad to a whole number of tiles, and regroup as (ntx,nty,T*T)
+        ntx, nty = tx1-tx0, ty1-ty0
+        P = np.empty((ntx*T, nty*T), self.TileMax.dtype)
+        P.fill(-np.inf)
+        P[:x1-x0, :y1-y0] = A
+        P = P.reshape((ntx, T, nty, T)).transpose((0, 2, 1, 3)).reshape((ntx, nty, T*T))
+        ind = np.argmax(P, axis=-1)
+        self.TileMax[tx0:tx1, ty0:ty1] = P.max(axis=-1)
+        xt = np.arange(tx0, tx1).reshape((ntx, 1))*T + ind/T
+        yt = np.arange(ty0, ty1).reshape((1, nty))*T + ind%T
+        self.TileArgMax[tx0:tx1, ty0:ty1] = xt*self.NY + yt
+        Rows = self.TileMax[tx0:tx1]
+        self.RowArgMax[tx0:tx1] = np.argmax(Rows, axis=1)
+        self.RowMax[tx0:tx1] = Rows.max(axis=1)
+
+    def update(self, x0, x1, y0, y1):
+        """Rescans the tiles overlapping the window [x0:x1,y0:y1] of the image"""
+        x0, x1 = max(x0, 0), min(x1, self.NX)
+        y0, y1 = max(y0, 0), min(y1, self.NY)
+        if x1 <= x0 or y1 <= y0:
+            return
+        T = self.TileSize
+        self._scanTiles(x0/T, (x1-1)/T+1, y0/T, (y1-1)/T+1)
+
+    def whereMax(self):
+        """Returns x,y,value of the peak, as NpParallel.A_whereMax does"""
+        itx = np.argmax(self.RowMax)
+        V = self.RowMax[itx]
+        # no positive pixel (e.g. everything masked): the C code returns a zero peak, so that the minor cycle
+        # stops on its flux threshold
+        if not V > 0:
+            return 0, 0, 0.
+        ind = self.TileArgMax[itx, self.RowArgMax[itx]]
+        return int(ind/self.NY), int(ind%self.NY), V
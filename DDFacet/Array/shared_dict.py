@@ -3,10 +3,19 @@ import NpShared
 import numpy as np
 import traceback
 import collections
+import struct
+import threading
 
 SHM_PREFIX = "/dev/shm/"
 SHM_PREFIX_LEN = len(SHM_PREFIX)
 
+# SharedDict.save() file format: magic string, then the array and pickle blobs, each aligned to SAVE_ALIGNMENT bytes,
+# then the pickled index of items, then the offset of the index as a little-endian uint64
+SAVE_MAGIC = "DDFSDCT1"
+SAVE_ALIGNMENT = 4096
+# number of threads writing or reading blobs in parallel
+SAVE_THREADS = 4
+
 def _to_shm (path):
     """Helper function, converts /dev/shm/name to shm://name"""
 ##    return "shm://" + path[SHM_PREFIX_LEN:]
@@ -29,6 +38,106 @@ def dict_to_shm(name, D):
     return Ds
 
 
+def _align(offset):
+    return (offset + SAVE_ALIGNMENT - 1) // SAVE_ALIGNMENT * SAVE_ALIGNMENT
+
+def _index_items(path, blobs, offset):
+    """
+    Helper function for SharedDict.save(). Forms up the index of the items found in SharedDict directory path,
+    allocating blobs from the given file offset onwards. Appends (offset, source) to blobs, where source is an array
+    or a pickle filename. Returns index (a list of dicts, one per item), and the offset of the end of the last blob.
+    """
+    index = []
+    for name in sorted(os.listdir(path)):
+        filepath = os.path.join(path, name)
+        kind = name[-1]
+        if kind == 'd':
+            items, offset = _index_items(filepath, blobs, offset)
+            index.append(dict(name=name, kind=kind, items=items))
+            continue
+        if kind == 'a':
+            source = NpShared.GiveArray(_to_shm(filepath))
+            entry = dict(name=name, kind=kind, dtype=source.dtype.str, shape=source.shape, nbytes=source.nbytes)
+        elif kind == 'p':
+            source = filepath
+            entry = dict(name=name, kind=kind, nbytes=os.path.getsize(filepath))
+        else:
+            print "Can't save shared dict entry " + filepath
+            continue
+        entry["offset"] = offset = _align(offset)
+        blobs.append((offset, source))
+        offset += entry["nbytes"]
+        index.append(entry)
+    return index, offset
+
+def _create_items(path, index, blobs):
+    """
+    Helper function for SharedDict.restore(). Creates the items in the index under SharedDict directory path.
+    Appends (offset, nbytes, target) to blobs, where target is an array to be filled, or a pickle filename.
+    """
+    for entry in index:
+        filepath = os.path.join(path, entry["name"])
+        if entry["kind"] == 'd':
+            os.mkdir(filepath)
+            _create_items(filepath, entry["items"], blobs)
+        elif entry["kind"] == 'a':
+            target = NpShared.CreateShared(_to_shm(filepath), entry["shape"], np.dtype(entry["dtype"]))
+            blobs.append((entry["offset"], entry["nbytes"], target))
+        else:
+            blobs.append((entry["offset"], entry["nbytes"], filepath))
+
+def _run_blob_threads(func, filename, blobs, sizes):
+    """Helper function. Splits blobs between up to SAVE_THREADS threads by size, and calls func(filename, blobs)
+    in each"""
+    nthreads = max(1, min(SAVE_THREADS, len(blobs)))
+    shares = [ [] for i in xrange(nthreads) ]
+    load = [0]*nthreads
+    for i in sorted(range(len(blobs)), key=lambda i: -sizes[i]):
+        ithread = load.index(min(load))
+        shares[ithread].append(blobs[i])
+        load[ithread] += sizes[i]
+    errors = []
+    def run(share):
+        try:
+            func(filename, share)
+        except Exception, exc:
+            traceback.print_exc()
+            errors.append(exc)
+    threads = [ threading.Thread(target=run, args=(share,)) for share in shares[1:] ]
+    for thread in threads:
+        thread.start()
+    run(shares[0])
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def _write_blobs(filename, blobs):
+    with open(filename, "r+b") as f:
+        for offset, source in blobs:
+            f.seek(offset)
+            if isinstance(source, np.ndarray):
+                if source.size:
+                    f.write(source.reshape(-1).view(np.uint8).data)
+            else:
+                f.write(file(source, "rb").read())
+
+def _read_blobs(filename, blobs):
+    with open(filename, "rb") as f:
+        for offset, nbytes, target in blobs:
+            f.seek(offset)
+            if isinstance(target, np.ndarray):
+                buf = target.reshape(-1).view(np.uint8)
+                done = 0
+                while done < nbytes:
+                    n = f.readinto(buf[done:])
+                    if not n:
+                        raise IOError("%s is truncated" % filename)
+                    done += n
+            else:
+                file(target, "wb").write(f.read(nbytes))
+
+
 class SharedDictRepresentation(object):
     def __init__(self, path, readwrite, load):
         self.path = path
@@ -143,11 +252,46 @@ class SharedDict (collections.OrderedDict):
             collections.OrderedDict.clear(self)
 
     def save(self, filename):
-        os.system("tar cf %s -C %s ." % (filename, self.path))
+        """
+        Saves the contents of the dict, as found in shared memory (subdicts included), to a file. Arrays are written
+        straight from shared memory, by several threads in parallel. See SAVE_MAGIC for the format.
+        """
+        blobs = []
+        index, end = _index_items(self.path, blobs, len(SAVE_MAGIC))
+        end = _align(end)
+        with open(filename, "wb") as f:
+            f.write(SAVE_MAGIC)
+            f.truncate(end)
+        _run_blob_threads(_write_blobs, filename, blobs,
+                          [ source.nbytes if isinstance(source, np.ndarray) else os.path.getsize(source)
+                            for _, source in blobs ])
+        # the index goes last, so a partially written file is not readable
+        with open(filename, "r+b") as f:
+            f.seek(end)
+            cPickle.dump(index, f, 2)
+            f.write(struct.pack("<Q", end))
 
     def restore(self, filename):
+        """
+        Restores the contents of the dict from a file written by save(). Arrays are read straight into newly
+        created shared arrays, by several threads in parallel. Files written by older versions (tar files) are
+        also supported.
+        """
         self.delete()
-        os.system("tar xf %s -C %s" % (filename, self.path))
+        with open(filename, "rb") as f:
+            if f.read(len(SAVE_MAGIC)) != SAVE_MAGIC:
+                index = None
+            else:
+                f.seek(-8, os.SEEK_END)
+                offset, = struct.unpack("<Q", f.read(8))
+                f.seek(offset)
+                index = cPickle.load(f)
+        if index is None:
+            os.system("tar xf %s -C %s" % (filename, self.path))
+        else:
+            blobs = []
+            _create_items(self.path, index, blobs)
+            _run_blob_threads(_read_blobs, filename, blobs, [ nbytes for _, nbytes, _ in blobs ])
         self.reload()
 
     def reload(self):
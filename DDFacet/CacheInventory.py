@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+import optparse
+import os
+import glob
+import time
+
+from DDFacet.Other import MyLogger
+from DDFacet.Other.CacheManager import CacheManager
+
+log= MyLogger.getLogger("CacheInventory")
+
+
+def read_options():
+    desc="""Lists the contents and sizes of DDFacet caches, and optionally trims them to a size budget.
+Arguments are cache directories (*.ddfcache), or MSs, in which case their caches are looked up."""
+
+    opt = optparse.OptionParser(usage='Usage: %prog <options> CACHE_OR_MS [CACHE_OR_MS...]',version='%prog version 1.0',description=desc)
+
+    group = optparse.OptionGroup(opt, "* Caches")
+    group.add_option('--Dir',help='Directory caches are kept in (as --Cache-Dir), if not next to the MSs. Default is %default',default=None)
+    group.add_option('--Long',help='List every cache element',action="store_true",default=False)
+    opt.add_option_group(group)
+
+    group = optparse.OptionGroup(opt, "* Cleanup")
+    group.add_option('--MaxSize',help='Trim each cache to this size in GB, least recently used elements first',type=float,default=0)
+    group.add_option('--MaxTotalSize',help='Trim all caches together to this size in GB, least recently used elements first',type=float,default=0)
+    group.add_option('--CleanUncommitted',help='Delete files that are not part of a committed cache element (e.g. left behind by interrupted runs).'
+                     ' Do not use while DDFacet is running on these caches!',action="store_true",default=False)
+    opt.add_option_group(group)
+    options, arguments = opt.parse_args()
+
+    return options, arguments
+
+
+def find_caches(arguments, cachedir=None):
+    """Returns the cache directories given by the arguments: cache directories, or MSs"""
+    dirnames = []
+    for arg in arguments:
+        arg = arg.rstrip("/")
+        if arg.endswith(".ddfcache") and os.path.isdir(arg):
+            dirnames.append(arg)
+            continue
+        if cachedir:
+            arg = os.path.join(cachedir, os.path.basename(arg))
+        found = sorted(glob.glob(arg+"*.ddfcache"))
+        if not found:
+            print>>log, "no caches found for %s" % arg
+        dirnames += found
+    return CacheManager._getTopDirs(dirnames)
+
+
+def print_inventory(dirname, long=False):
+    """Prints the contents of a cache, and returns its total size"""
+    items = CacheManager.getInventory(dirname)
+    committed = [ item for item in items if item[3] ]
+    size = sum([ item[1] for item in items ])
+    uncommitted = size - sum([ item[1] for item in committed ])
+    last_used = max([ item[2] for item in committed ]) if committed else None
+    print>>log, "%s: %d elements, %.3f GB (%.3f GB uncommitted), last used %s" % (dirname, len(committed),
+                size/float(1<<30), uncommitted/float(1<<30), time.ctime(last_used) if last_used else "never")
+    if long:
+        for path, size, mtime, ok in sorted(items, key=lambda item: item[2]):
+            print>>log, "  %10.1f MB  %s  %-11s  %s" % (size/float(1<<20), time.ctime(mtime),
+                                                       "committed" if ok else "uncommitted", os.path.relpath(path, dirname))
+    return size
+
+
+if __name__=="__main__":
+    options, arguments = read_options()
+    dirnames = find_caches(arguments, options.Dir)
+
+    if options.CleanUncommitted:
+        for dirname in dirnames:
+            for path, size, _, ok in CacheManager.getInventory(dirname):
+                if not ok:
+                    print>>log, "deleting uncommitted %s (%.1f MB)" % (path, size/float(1<<20))
+                    CacheManager._removeElement(path)
+    if options.MaxSize:
+        for dirname in dirnames:
+            CacheManager.trimCaches([dirname], options.MaxSize*(1<<30))
+    if options.MaxTotalSize:
+        CacheManager.trimCaches(dirnames, options.MaxTotalSize*(1<<30))
+
+    total = 0
+    for dirname in dirnames:
+        total += print_inventory(dirname, options.Long)
+    print>>log, "%d caches, %.3f GB in total" % (len(dirnames), total/float(1<<30))
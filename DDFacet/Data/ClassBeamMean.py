@@ -85,123 +85,87 @@ class ClassBeamMean():
         iPix,jPix=np.mgrid[0:npix,0:npix]
         self.iPix=iPix.ravel()
         self.jPix=jPix.ravel()
-        lc=lc.flatten()
-        mc=mc.flatten()
-        ra=np.zeros_like(lc)
-        dec=np.zeros_like(lc)
-        for i in range(ra.size):
-            ra[i],dec[i]=self.CoordMachine.lm2radec(np.array([lc[i]]),
-                                                    np.array([mc[i]]))
+        ra,dec=self.CoordMachine.lm2radec(lc.flatten(),mc.flatten())
         self.radec=ra,dec
         self.npix=npix
         self.NDir=ra.size
         
 
 
-    def StackBeam(self,ThisMSData,iDir):
+    def StackBeam(self,ThisMSData,iDirs):
+        """
+        Stacks the beam of one chunk of data, for directions iDirs of the smoothing grid.
+
+        The beam is evaluated in all directions in one go. Since the squared weights only need to be summed per
+        (beam time range, baseline, channel), they are reduced over the rows first, and the Jones terms are then
+        only evaluated per baseline rather than per row. Beams that are the same for all antennas reduce further,
+        to a single "baseline".
+        """
         self.StackedBeamDict.reload()
         MyLogger.setSilent("ClassJones")
-        Dt=self.GD["Beam"]["DtBeamMin"]*60.
         JonesMachine=self.DicoJonesMachine[ThisMSData["iMS"]]
         RAs,DECs = self.radec
+        iDirs=np.array(iDirs).ravel()
 
         times=ThisMSData["times"]
         A0=ThisMSData["A0"]
         A1=ThisMSData["A1"]
-        flags=ThisMSData["flags"]
         W=ThisMSData["Weights"]
         ChanToFreqBand=ThisMSData["ChanMapping"]
         beam_times = np.array(JonesMachine.BeamMachine.getBeamSampleTimes(times, quiet=True))
 
-        T2=ClassTimeIt.ClassTimeIt()
-        T2.disable()
-        CurrentBeamITime=-1
-        # #print "  Estimate beam in %i directions"%(RAs.size)
-        # MS=self.ListMS[ThisMSData["iMS"]]
-        # JonesMachine=ClassJones.ClassJones(self.GD,MS,self.VS.FacetMachine)
-        # JonesMachine.InitBeamMachine()
-        DicoBeam=JonesMachine.EstimateBeam(beam_times, RAs[iDir:iDir+1], DECs[iDir:iDir+1], progressBar=False, quiet=True)
-        T2.timeit("GetBeam 1")
-        #DicoBeam=JonesMachine.EstimateBeam(beam_times, RAs[0:10], DECs[0:10],progressBar=False)
-        #T2.timeit("GetBeam 10")
-        #print DicoBeam["Jones"].shape
-        NTRange=DicoBeam["t0"].size
-        #pBAR= ProgressBar(Title="      Mean Beam")
-        #pBAR.render(0, '%4i/%i' % (0,NTRange))
         T=ClassTimeIt.ClassTimeIt("Stacking")
         T.disable()
-
-        # DicoBeam["Jones"].shape = nt, nd, na, nch, _, _
-
-        for iTRange in range(DicoBeam["t0"].size):
-        
-            t0=DicoBeam["t0"][iTRange]
-            t1=DicoBeam["t1"][iTRange]
-            J=np.abs(DicoBeam["Jones"][iTRange])
-            ind=np.where((times>=t0)&(times<t1))[0]
-            T.timeit("0")
-            A0s=A0[ind]
-            A1s=A1[ind]
-            fs=flags[ind]
-            Ws=W[ind]
-            MSnchan=Ws.shape[1]
-            T.timeit("1")
-            
-            nd,na,nch,_,_=J.shape
-            
-            # ######################
-            # This call is slow
-            J0=J[:,A0s,:,:,:]
-            J1=J[:,A1s,:,:,:]
-            T.timeit("2")
-            # ######################
-
-            # J0=np.zeros((nd,A0s.size,nch,2,2),dtype=J.dtype)
-            # #T.timeit("1a")
-            # J0List=[J[:,A0s[i],:,:,:] for i in range(A0s.size)]
-            # #T.timeit("1b")
-            # J1=np.zeros((nd,A0s.size,nch,2,2),dtype=J.dtype)
-            # #T.timeit("1c")
-            # J1List=[J[:,A1s[i],:,:,:] for i in range(A0s.size)]
-            # #T.timeit("1d")
-            # for i in range(A0s.size):
-            #     J0[:,i,:,:,:]=J0List[i]
-            #     J1[:,i,:,:,:]=J1List[i]
-            # T.timeit("2b")
-
-        
-            JJ=(J0[:,:,:,0,0]*J1[:,:,:,0,0]+J0[:,:,:,1,1]*J1[:,:,:,1,1])/2.
-            T.timeit("3")
-            
-            WW=Ws**2
-            T.timeit("4")
-            WW=WW.reshape((1,ind.size,MSnchan))
-            T.timeit("5")
-            JJsq=WW*JJ**2
-            T.timeit("6")
-            
-            SumWsqThisRange=np.sum(JJsq,axis=1)
-            T.timeit("7")
-
-            #self.SumJJsq+=SumWsqThisRange.reshape((self.npix,self.npix,self.MS.Nchan))
-            #T.timeit("8")
-            SumWsq=np.sum(WW,axis=1)
-            #self.SumWsq+=SumWsq
-
-            for iBand in range(self.VS.NFreqBands):
-                indFreqBand,=np.where(ChanToFreqBand==iBand)
-                if indFreqBand.size==0: continue
-                self.StackedBeamDict[iDir]["SumJJsq"][iBand]+=np.sum(SumWsqThisRange.reshape((MSnchan,))[indFreqBand])
-                self.StackedBeamDict[iDir]["SumWsq"][iBand]+=np.sum(SumWsq.reshape((MSnchan,))[indFreqBand])
-
-            #print SumWsq,self.SumWsq,self.SumJJsq.shape,J0.shape
-            T.timeit("9")
-            
-            #NDone = iTRange+1
-            #intPercent = int(100 * NDone / float(NTRange))
-            #pBAR.render(intPercent, '%4i/%i' % (NDone, NTRange))
-
-        T2.timeit("Stack")
+        DicoBeam=JonesMachine.EstimateBeam(beam_times, RAs[iDirs], DECs[iDirs], progressBar=False, quiet=True,
+                                           ExpandAntennas=False)
+        T.timeit("GetBeam")
+        # DicoBeam["Jones"].shape = nt, nd, na, nch, _, _, where na may be 1
+        J=np.abs(DicoBeam["Jones"])
+        nt,nd,na,nch,_,_=J.shape
+        MSnchan=W.shape[1]
+        if nch not in (1,MSnchan):
+            J=J[:,:,:,DicoBeam["VisToJonesChanMapping"]]
+
+        # beam time range of each row (ranges are contiguous, see EstimateBeam), and rows outside of them
+        iTRange=np.searchsorted(DicoBeam["t1"],times,side="right")
+        valid=(times>=DicoBeam["t0"][0])&(iTRange<nt)
+        if na>1:
+            key=(iTRange*na+A0)*na+A1
+        else:
+            key=iTRange
+        key=key[valid]
+        WW=np.float64(W[valid])**2
+        # sum of the squared weights per (time range, baseline) key
+        order=np.argsort(key,kind="mergesort")
+        key=key[order]
+        first=np.concatenate(([0],np.where(key[1:]!=key[:-1])[0]+1)) if key.size else np.zeros(0,np.int64)
+        WWKey=np.add.reduceat(WW[order],first,axis=0) if key.size else np.zeros((0,MSnchan))
+        key=key[first]
+        T.timeit("reduce rows")
+
+        if na>1:
+            it,p,q=key/(na*na),(key/na)%na,key%na
+        else:
+            it=key
+            p=q=np.zeros_like(key)
+        # Jones terms per key, shape [nkey,nd,nch]
+        J0=J[it,:,p]
+        J1=J[it,:,q]
+        JJ=(J0[...,0,0]*J1[...,0,0]+J0[...,1,1]*J1[...,1,1])/2.
+        # a beam with a single channel applies to all channels
+        JJsq=np.broadcast_to(np.float64(JJ)**2,(key.size,nd,MSnchan))
+        SumJJsq=np.einsum("kc,kdc->dc",WWKey,JJsq)
+        SumWsq=np.sum(WWKey,axis=0)
+        T.timeit("stack")
+
+        # reduce channels to frequency bands
+        BandMatrix=np.float64(ChanToFreqBand.reshape((MSnchan,1))==np.arange(self.VS.NFreqBands).reshape((1,-1)))
+        SumJJsq=np.dot(SumJJsq,BandMatrix)
+        SumWsq=np.dot(SumWsq,BandMatrix)
+        for i,iDir in enumerate(iDirs):
+            self.StackedBeamDict[iDir]["SumJJsq"]+=SumJJsq[i]
+            self.StackedBeamDict[iDir]["SumWsq"]+=SumWsq
+        T.timeit("bands")
         MyLogger.setLoud("ClassJones")
   
         
@@ -206,48 +206,53 @@ class ClassFITSBeam (object):
         Inputs: t0 is a single time. ra, dec are Ndir vectors of directions.
         Output: a complex array of shape [Ndir,Nant,Nfreq,2,2] giving the Jones matrix per antenna, direction and frequency
         """
-
-        # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
-        dm.do_frame(self.pos0);
-        # put time into reference frame
-        dm.do_frame(dm.epoch("UTC",dq.quantity(t0,"s")))
-        # compute PA 
-        parad = dm.posangle(self.field_centre,self.zenith).get_value("rad")
-        # print>>log,"time %f, position angle %f"%(t0, parad*180/math.pi)
-
+        # NB: here we copy the same Jones to every antenna, see evaluateBeams() for the compact form
+        return numpy.repeat(self.evaluateBeams([t0], ra, dec)[0], self.ms.na, axis=1)
+
+    def evaluateBeams (self, times, ra, dec):
+        """Evaluates beam at a number of times, in directions ra, dec.
+        Inputs: times is a vector of Ntime times. ra, dec are Ndir vectors of directions.
+        Output: a complex array of shape [Ntime,Ndir,1,Nfreq,2,2] giving the Jones matrix per time, direction and
+        frequency. The antenna axis has length 1, since the beam is the same for all antennas: it broadcasts
+        against per-antenna Jones arrays.
+        """
         # compute l,m per direction
         ndir = len(ra)
         l0 = numpy.zeros(ndir,float)
         m0 = numpy.zeros(ndir,float)
         for i,(r1,d1) in enumerate(zip(ra,dec)):
           l0[i], m0[i] = self.ms.radec2lm_scalar(r1,d1,original=True)
-        # print>>log,ra*180/np.pi,dec*180/np.pi
-        # print>>log,l0*180/np.pi,m0*180/np.pi
-        # rotate each by parallactic angle
         r = numpy.sqrt(l0*l0+m0*m0)
         angle = numpy.arctan2(m0,l0)
-        l = r*numpy.cos(angle+parad)
-        m = r*numpy.sin(angle+parad)  
-
-        # print>>log,"Beam evaluated for l,m"
-        # print>>log,l
-        # print>>log,m
 
-        # get interpolated values. Output shape will be [ndir,nfreq]
+        # compute PA per time
+        ntime = len(times)
+        parad = numpy.zeros(ntime,float)
+        for it, t0 in enumerate(times):
+            # put antenna0 position as reference frame. NB: in the future may want to do it per antenna
+            dm.do_frame(self.pos0);
+            # put time into reference frame
+            dm.do_frame(dm.epoch("UTC",dq.quantity(t0,"s")))
+            parad[it] = dm.posangle(self.field_centre,self.zenith).get_value("rad")
+
+        # rotate each direction by each parallactic angle, giving [ntime*ndir] vectors of l,m
+        l = (r[numpy.newaxis,:]*numpy.cos(angle[numpy.newaxis,:]+parad[:,numpy.newaxis])).ravel()
+        m = (r[numpy.newaxis,:]*numpy.sin(angle[numpy.newaxis,:]+parad[:,numpy.newaxis])).ravel()
+
+        # get interpolated values for all times and directions at once. Output shape will be [ntime*ndir,nfreq]
         beamjones = [ self.vbs[corr].interpolate(l,m,freq=self.freqs,freqaxis=1) for corr in self.corrs ]
 
         # now make output matrix
-        jones = numpy.zeros((ndir,self.ms.na,len(self.freqs),2,2),dtype=numpy.complex64)
+        jones = numpy.zeros((ntime*ndir,1,len(self.freqs),2,2),dtype=numpy.complex64)
 
         # populate it with values
-        # NB: here we copy the same Jones to every antenna. In principle we could compute
+        # NB: the same Jones applies to every antenna. In principle we could compute
         # a parangle per antenna. When we have pointing error, it's also going to be per
         # antenna
-        for iant in xrange(self.ms.na):
-            for ijones,(ix,iy) in enumerate(((0,0),(0,1),(1,0),(1,1))):
-                bj = beamjones[ijones]
-                jones[:,iant,:,ix,iy] = beamjones[ijones].reshape((len(bj),1)) if bj.ndim == 1 else bj
-        return jones
+        for ijones,(ix,iy) in enumerate(((0,0),(0,1),(1,0),(1,1))):
+            bj = beamjones[ijones]
+            jones[:,0,:,ix,iy] = bj.reshape((len(bj),1)) if bj.ndim == 1 else bj
+        return jones.reshape((ntime,ndir,1,len(self.freqs),2,2))
 
 
 
@@ -87,6 +87,8 @@ class ClassJones():
             else:
                 DicoSols, TimeMapping, DicoClusterDirs = self.MakeSols("Beam", DATA, quiet=quiet)
                 self.MS.cache.saveCache("JonesNorm_Beam.npz")
+            # beam Jones may be cached in antenna-broadcast form, but the gridders want one Jones per antenna
+            DicoSols["Jones"] = self.ExpandAntennas(DicoSols["Jones"])
             DATA["Beam"] =  dict(Jones=DicoSols, TimeMapping=TimeMapping, Dirs=DicoClusterDirs)
 
     # def ToShared(self, StrType, DicoSols, TimeMapping, DicoClusterDirs):
@@ -277,6 +279,14 @@ class ClassJones():
         DicoJonesMatrices = DicoSols
         ind = np.zeros((times.size,), np.int32)
         nt, na, nd, _, _, _ = DicoJonesMatrices["Jones"].shape
+        t0, t1 = DicoJonesMatrices["t0"], DicoJonesMatrices["t1"]
+        # usual case of sorted, non-overlapping intervals: look up the interval of each row by bisection
+        if nt and (t0[1:] >= t0[:-1]).all() and (t1[:-1] <= t0[1:]).all():
+            it = np.searchsorted(t0, times, side="right") - 1
+            valid = it >= 0
+            valid[valid] = times[valid] < t1[it[valid]]
+            ind[valid] = it[valid]
+            return ind
         ii = 0
         for it in xrange(nt):
             t0 = DicoJonesMatrices["t0"][it]
@@ -628,6 +638,7 @@ class ClassJones():
             self.ApplyBeam = True
             self.BeamMachine = ClassLOFARBeam.ClassLOFARBeam(self.MS, self.GD)
             self.GiveInstrumentBeam = self.BeamMachine.GiveInstrumentBeam
+            self.GiveInstrumentBeams = self.BeamMachine.GiveInstrumentBeams
             #print>>log, "  Estimating LOFAR beam model in %s mode every %5.1f min."%(LOFARBeamMode,DtBeamMin)
             # self.GiveInstrumentBeam=self.MS.GiveBeam
             # estimate beam sample times using DtBeamMin
@@ -635,6 +646,7 @@ class ClassJones():
         elif GD["Beam"]["Model"] == "FITS":
             self.BeamMachine = ClassFITSBeam.ClassFITSBeam(self.MS, GD["Beam"])
             self.GiveInstrumentBeam = self.BeamMachine.evaluateBeam
+            self.GiveInstrumentBeams = self.BeamMachine.evaluateBeams
 
             # self.DtBeamDeg = GD["Beam"]["FITSParAngleIncrement"]
             # print>>log, "  Estimating FITS beam model every %5.1f min."%DtBeamMin
@@ -661,10 +673,16 @@ class ClassJones():
         #     ra,dec=RAs[i],DECs[i]
         #     print rad2hmsdms(ra,Type="ra").replace(" ",":"),rad2hmsdms(dec,Type="dec").replace(" ",".")
 
-        DicoBeam = self.EstimateBeam(beam_times, RAs, DECs)
+        DicoBeam = self.EstimateBeam(beam_times, RAs, DECs, ExpandAntennas=False)
 
         return DicoBeam
 
+    def ExpandAntennas(self, Jones):
+        """Expands Jones matrices in antenna-broadcast form (antenna axis of length 1) to one Jones per antenna"""
+        if Jones.shape[2] == 1 and self.MS.na > 1:
+            Jones = np.require(np.repeat(Jones, self.MS.na, axis=2), dtype=np.complex64, requirements="C")
+        return Jones
+
     def GiveVisToJonesChanMapping(self, FreqDomains):
         NChanJones = FreqDomains.shape[0]
         MeanFreqJonesChan = (FreqDomains[:, 0]+FreqDomains[:, 1])/2.
@@ -672,7 +690,12 @@ class ClassJones():
             (self.MS.NSPWChan, 1))-MeanFreqJonesChan.reshape((1, NChanJones)))
         return np.argmin(DFreq, axis=1)
 
-    def EstimateBeam(self, TimesBeam, RA, DEC,progressBar=True, quiet=False):
+    def EstimateBeam(self, TimesBeam, RA, DEC,progressBar=True, quiet=False, ExpandAntennas=True):
+        """
+        Evaluates beam Jones matrices for the time intervals given by TimesBeam, in directions RA, DEC.
+        Beam models that are the same for all antennas return Jones with an antenna axis of length 1: this is
+        kept as is if ExpandAntennas is False (e.g. for caching), else expanded to one Jones per antenna.
+        """
         TimesBeam = np.float64(np.array(TimesBeam))
         T0s = TimesBeam[:-1].copy()
         T1s = TimesBeam[1:].copy()
@@ -688,47 +711,31 @@ class ClassJones():
         if not quiet:
             print>>log,"VisToJonesChanMapping: %s"%DicoBeam["VisToJonesChanMapping"]
 
-
-        DicoBeam["Jones"]=np.zeros((Tm.size,NDir,self.MS.na,FreqDomains.shape[0],2,2),dtype=np.complex64)
-        DicoBeam["t0"]=np.zeros((Tm.size,),np.float64)
-        DicoBeam["t1"]=np.zeros((Tm.size,),np.float64)
-        DicoBeam["tm"]=np.zeros((Tm.size,),np.float64)
-        
+        DicoBeam["t0"]=T0s
+        DicoBeam["t1"]=T1s
+        DicoBeam["tm"]=Tm
         
         rac,decc=self.MS.OriginalRadec
         pBAR= ProgressBar(Title="  Init E-Jones ")#, HeaderSize=10,TitleSize=13)
         if not progressBar: pBAR.disable()
         pBAR.render(0, Tm.size)
-        for itime in range(Tm.size):
-            DicoBeam["t0"][itime]=T0s[itime]
-            DicoBeam["t1"][itime]=T1s[itime]
-            DicoBeam["tm"][itime]=Tm[itime]
-            ThisTime=Tm[itime]
-            Beam=self.GiveInstrumentBeam(ThisTime,RA,DEC)
-            #
-            if self.GD["Beam"]["CenterNorm"]==1:
-                Beam0=self.GiveInstrumentBeam(ThisTime,np.array([rac]),np.array([decc]))
-                Beam0inv= ModLinAlg.BatchInverse(Beam0)
-                nd,_,_,_,_=Beam.shape
-                Ones=np.ones((nd, 1, 1, 1, 1),np.float32)
-                Beam0inv=Beam0inv*Ones
-                Beam= ModLinAlg.BatchDot(Beam0inv, Beam)
-                
- 
-            DicoBeam["Jones"][itime]=Beam
-            NDone=itime+1
-            pBAR.render(NDone,Tm.size)
-
-            DicoBeam["Jones"][itime] = Beam
-
-        nt, nd, na, nch, _, _ = DicoBeam["Jones"].shape
+        # evaluate all times in one go
+        Beam=self.GiveInstrumentBeams(Tm,RA,DEC)
+        if self.GD["Beam"]["CenterNorm"]==1:
+            Beam0=self.GiveInstrumentBeams(Tm,np.array([rac]),np.array([decc]))
+            Beam0inv= ModLinAlg.BatchInverse(Beam0)
+            nt,nd,_,_,_,_=Beam.shape
+            Ones=np.ones((1, nd, 1, 1, 1, 1),np.float32)
+            Beam0inv=Beam0inv*Ones
+            Beam= ModLinAlg.BatchDot(Beam0inv, Beam)
+        pBAR.render(Tm.size,Tm.size)
+
+        DicoBeam["Jones"]=np.complex64(Beam)
+        if ExpandAntennas:
+            DicoBeam["Jones"]=self.ExpandAntennas(DicoBeam["Jones"])
 
         # DicoBeam["Jones"]=np.mean(DicoBeam["Jones"],axis=3).reshape((nt,nd,na,1,2,2))
 
-        # print TimesBeam-TimesBeam[0]
-        # print t0-t1
-        # print DicoBeam["t1"][-1]-DicoBeam["t0"][0]
-
         return DicoBeam
 
     def MergeJones(self, DicoJ0, DicoJ1):
@@ -104,4 +104,11 @@ class ClassLOFARBeam():
 
         return MeanBeam
 
+    def GiveInstrumentBeams(self,times,ra,dec):
+        """Evaluates beam at a number of times. Returns array of shape [ntime,ndir,na,nchan,2,2]"""
+        Beam=np.zeros((len(times),ra.shape[0],self.MS.na,self.NChanJones,2,2),dtype=np.complex)
+        for itime,time in enumerate(times):
+            Beam[itime]=self.GiveInstrumentBeam(time,ra,dec)
+        return Beam
+
 
@@ -34,6 +34,7 @@ log = MyLogger.getLogger("ClassMS")
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Other.CacheManager import CacheManager
 from DDFacet.Array import NpShared
+from DDFacet.Data import ModVisCache
 import sidereal
 from DDFacet.Array import PrintRecArray
 
@@ -115,13 +116,16 @@ class ClassMS():
         # once.
         self._reset_cache = ResetCache
         self._chunk_caches = {}
-        self.maincache = CacheManager(MSname+".F%d.D%d.ddfcache"%(self.Field, self.DDID), reset=ResetCache, cachedir=self.GD["Cache"]["Dir"], nfswarn=True)
+        self._ms_stamp = None
+        self.maincache = CacheManager(MSname+".F%d.D%d.ddfcache"%(self.Field, self.DDID), reset=ResetCache, cachedir=self.GD["Cache"]["Dir"], nfswarn=True,
+                                      budget=self.GD["Cache"]["MaxSize"]*(1<<30))
 
         self.ReadMSInfo(first_ms=first_ms,DoPrint=DoPrint)
         self.LFlaggedStations=[]
         self.DicoSelectOptions = DicoSelectOptions
         self._datapath = self._flagpath = None
         self._start_time = time.time()
+        self._content_keys = self.GD["Cache"]["Keys"] == "content"
 
         try:
             self.LoadLOFAR_ANTENNA_FIELD()
@@ -532,6 +536,49 @@ class ClassMS():
     def getChunkCache (self, row0, row1):
         return self._chunk_caches[row0, row1]
 
+    def getContentKey (self, row0, row1, **kw):
+        """
+        Returns the cache key of a content-keyed cache element (see CacheManager) derived from rows row0:row1 of
+        this MS: the MS, its modification stamp, field, DDID, selection and rows, channel slice, and rephasing.
+        Extra keywords are added to the key.
+        """
+        key = dict(ms=self.MSName, stamp=self.getMSStamp(),
+                   taql=self.TaQL, rows=(row0, row1),
+                   channels=(self.cs_tlc, self.cs_brc, self.cs_inc),
+                   rephase=getattr(self, "NewRadec", None))
+        key.update(kw)
+        return key
+
+    def getMSStamp (self):
+        """
+        Returns the modification stamp of the MS used in content keys (see CacheManager.getPathStamp()), computed
+        once per run. This covers the files holding the data of the MS's columns, but not those of the predict
+        column that DDFacet writes (--Predict-ColName, unless it is the column being imaged), nor table.dat, which
+        casacore rewrites on every write. The (other) column names and row count are returned along with the stamp
+        instead.
+        Note that a predict column sharing a storage manager with other columns can not be left out, and will
+        then invalidate content-keyed caches whenever it is written.
+        """
+        if self._ms_stamp is None:
+            written = set([self.GD["Predict"]["ColName"]]) - set([None, "", self.ColName])
+            t = table(self.MSName, ack=False)
+            colnames, nrows = sorted(set(t.colnames()) - written), t.nrows()
+            # sequence numbers of the storage managers holding only written columns
+            seqnrs = set([ dm["SEQNR"] for dm in t.getdminfo().itervalues()
+                           if len(dm["COLUMNS"]) and set(dm["COLUMNS"]) <= written ])
+            t.close()
+            # storage manager files are named table.fN, table.fN_TSM0, table.fNi, etc.
+            exclude = [ "table.dat" ] + \
+                      [ filename for filename in os.listdir(self.MSName)
+                        if re.match(r"table\.f(\d+)(\D.*)?$", filename) and
+                           int(re.match(r"table\.f(\d+)", filename).group(1)) in seqnrs ]
+            self._ms_stamp = CacheManager.getPathStamp(self.MSName, exclude=exclude), colnames, nrows
+        return self._ms_stamp
+
+    def getChunkCacheDirs (self):
+        """Returns the cache directories of all chunks of this MS"""
+        return [ cache.dirname for cache in self._chunk_caches.itervalues() ]
+
     def GiveChunk (self, DATA, chunk, use_cache=None, read_data=True, sort_by_baseline=False):
         row0, row1 = self._chunk_r0r1[chunk]
         self.cache = self.getChunkCache(row0, row1)
@@ -603,10 +650,14 @@ class ClassMS():
 
             # @o-smirnov: why not that?
             # cache_key = dict(data=self.GD["Data"])
-            cache_key = dict(data=self.GD["Data"],
-                             selection=self.GD["Selection"],
-                             Comp=self.GD["Comp"])
-            metadata_path, metadata_valid = self.cache.checkCache("A0A1UVWT.npz", cache_key, ignore_key=(use_cache=="force"))
+            if self._content_keys:
+                cache_key = self.getContentKey(row0, row1, sort=sort_by_baseline)
+            else:
+                cache_key = dict(data=self.GD["Data"],
+                                 selection=self.GD["Selection"],
+                                 Comp=self.GD["Comp"])
+            metadata_path, metadata_valid = self.cache.checkCache("A0A1UVWT.npz", cache_key, ignore_key=(use_cache=="force"),
+                                                                  content=self._content_keys)
         else:
             metadata_valid = False
         # if cache is valid, we're all good
@@ -654,16 +705,26 @@ class ClassMS():
 
         DATA["uvw"]   = uvw
         visdata = DATA.addSharedArray("data", shape=datashape, dtype=np.complex64)
+        data_format = self.GD["Cache"]["VisDataFormat"]
+        mantissa_bits = self.GD["Cache"]["VisDataMantissaBits"] if data_format == "zlib" else 23
+        packed_flags = bool(self.GD["Cache"]["VisFlagsPacked"])
         if read_data:
             # check cache for visibilities
             if use_cache:
-                datapath, datavalid = self.cache.checkCache("Data.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+                if self._content_keys:
+                    cache_key = self.getContentKey(row0, row1, sort=sort_by_baseline, column=self.ColName,
+                                                   mantissa_bits=mantissa_bits)
+                else:
+                    cache_key = dict(time=self._start_time, mantissa_bits=mantissa_bits)
+                datapath, datavalid = self.cache.checkCache(ModVisCache.DATA_CACHE_NAMES[data_format], cache_key,
+                                                            ignore_key=(use_cache=="force"), content=self._content_keys)
             else:
                 datavalid = False
             # read from cache if available, else from MS
             if datavalid:
                 print>> log, "reading cached visibilities from %s" % datapath
-                visdata[...] = np.load(datapath)
+                ModVisCache.loadVisData(datapath, visdata)
+                ModVisCache.touch(datapath)
                 #self.RotateType=["uvw"]
             else:
                 print>> log, "reading MS visibilities from column %s" % self.ColName
@@ -686,19 +747,28 @@ class ClassMS():
 
                 if use_cache:
                     print>> log, "caching visibilities to %s" % datapath
-                    np.save(datapath, visdata)
-                    self.cache.saveCache("Data.npy")
+                    ModVisCache.saveVisData(datapath, visdata, data_format, mantissa_bits)
+                    self.cache.saveCache(ModVisCache.DATA_CACHE_NAMES[data_format])
         # create flag array (if flagbuf is not None, array uses memory of buffer)
         flags = DATA.addSharedArray("flags", shape=datashape, dtype=np.bool)
         # check cache for flags
         if use_cache:
-            flagpath, flagvalid = self.cache.checkCache("Flags.npy", dict(time=self._start_time), ignore_key=(use_cache=="force"))
+            if self._content_keys:
+                # flags include NaNs in the visibilities, and the selection options (see UpdateFlags)
+                cache_key = self.getContentKey(row0, row1, sort=sort_by_baseline,
+                                               column=self.ColName if read_data else None,
+                                               selection=self.DicoSelectOptions)
+            else:
+                cache_key = dict(time=self._start_time)
+            flagpath, flagvalid = self.cache.checkCache(ModVisCache.FLAG_CACHE_NAMES[packed_flags], cache_key,
+                                                        ignore_key=(use_cache=="force"), content=self._content_keys)
         else:
             flagvalid = False
         # read from cache if available, else from MS
         if flagvalid:
             print>> log, "reading cached flags from %s" % flagpath
-            flags[...] = np.load(flagpath)
+            ModVisCache.loadFlags(flagpath, flags, packed_flags)
+            ModVisCache.touch(flagpath)
         else:
             print>> log, "reading MS flags from column FLAG"
             table_all = table_all or self.GiveMainTable()
@@ -714,8 +784,8 @@ class ClassMS():
             self.UpdateFlags(flags, uvw, visdata, A0, A1, time_all)
             if use_cache:
                 print>> log, "caching flags to %s" % flagpath
-                np.save(flagpath, flags)
-                self.cache.saveCache("Flags.npy")
+                ModVisCache.saveFlags(flagpath, flags, packed_flags)
+                self.cache.saveCache(ModVisCache.FLAG_CACHE_NAMES[packed_flags])
         if table_all:
             table_all.close()
 
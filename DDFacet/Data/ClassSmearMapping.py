@@ -20,7 +20,6 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import numpy as np
 import math
-import itertools
 from DDFacet.Other import MyLogger
 from DDFacet.Array import NpShared
 log = MyLogger.getLogger("ClassSmearMapping")
@@ -38,22 +37,28 @@ class SmearMappingMachine (object):
         self._job_counter = APP.createJobCounter(self.name)
         self._data = self._blockdict = self._sizedict = None
 
-    def _smearmapping_worker(self, DATA, blockdict, sizedict, a0, a1, dPhi, l, channel_mapping, mode):
+    def _smearmapping_worker(self, DATA, blockdict, sizedict, blindex, ibl0, ibl1, dPhi, l, channel_mapping, mode):
+        """Computes the mapping for baselines ibl0:ibl1 of the baseline index (see computeSmearMappingInBackground)"""
         t = ClassTimeIt.ClassTimeIt()
         t.disable()
-        if mode == 1:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping)
-        elif mode == 2:
-            BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping)
-        else:
-            raise ValueError("unknown BDAMode setting %d"%mode)
-
-        t.timeit('compute')
-        if BlocksRowsListBL is not None:
-            key = "%d:%d" % (a0,a1)
-            sizedict[key]  = np.array(BlocksSizesBL)
-            blockdict[key] = np.array(BlocksRowsListBL)
-            t.timeit('store')
+        rows = blindex["rows"]
+        for a0, a1, row0, nrows in blindex["baselines"][ibl0:ibl1]:
+            row_index = rows[row0:row0+nrows]
+            if mode == 1:
+                BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping,
+                                                                              row_index=row_index)
+            elif mode == 2:
+                BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping,
+                                                                          row_index=row_index)
+            else:
+                raise ValueError("unknown BDAMode setting %d"%mode)
+
+            t.timeit('compute')
+            if BlocksRowsListBL is not None:
+                key = "%d:%d" % (a0,a1)
+                sizedict[key]  = np.array(BlocksSizesBL)
+                blockdict[key] = np.array(BlocksRowsListBL)
+                t.timeit('store')
 
     def computeSmearMappingInBackground (self, base_job_id, MS, DATA, radiusDeg, Decorr, channel_mapping, mode):
         l = radiusDeg * np.pi / 180
@@ -62,20 +67,38 @@ class SmearMappingMachine (object):
         self._outdict = shared_dict.create("%s:%s:tmp" %(DATA.path, self.name))
         blockdict = self._outdict.addSubdict("blocks")
         sizedict  = self._outdict.addSubdict("sizes")
-        self._nbl = 0
-        for a0 in xrange(MS.na):
-            for a1 in xrange(MS.na):
-                if a0 != a1:
-                    self._nbl += 1
-                    APP.runJob("%s:%s:%d:%d" % (base_job_id, self.name, a0, a1), self._smearmapping_worker,
-                               counter=self._job_counter, collect_result=False,
-                               args=(DATA.readonly(), blockdict.writeonly(), sizedict.writeonly(), a0, a1, dPhi, l,
-                                     channel_mapping, mode))
+        # build the baseline index in one pass: a stable sort of the rows by baseline number keeps each baseline's
+        # rows in their original (time) order, and makes them a contiguous slice of "rows"
+        A0, A1 = DATA["A0"], DATA["A1"]
+        blnum = np.int64(A0)*MS.na + A1
+        rows = np.argsort(blnum, kind="mergesort")
+        blnum = blnum[rows]
+        ublnum, row0, nrows = np.unique(blnum, return_index=True, return_counts=True)
+        # autocorrelations are not mapped
+        cross = (ublnum/MS.na != ublnum%MS.na)
+        ublnum, row0, nrows = ublnum[cross], row0[cross], nrows[cross]
+        baselines = np.zeros((ublnum.size, 4), np.int64)
+        baselines[:, 0], baselines[:, 1] = ublnum/MS.na, ublnum%MS.na
+        baselines[:, 2], baselines[:, 3] = row0, nrows
+        blindex = self._outdict.addSubdict("index")
+        blindex["rows"] = rows
+        blindex["baselines"] = baselines
+        # split baselines into batches of roughly equal numbers of rows, a few batches per CPU
+        self._njobs = min(ublnum.size, 4*APP.ncpu)
+        cumrows = np.cumsum(nrows)
+        cuts = np.searchsorted(cumrows, np.arange(1, self._njobs)*(cumrows[-1]/float(self._njobs))) if ublnum.size else []
+        cuts = sorted(set([0] + list(cuts) + [ublnum.size]))
+        self._njobs = len(cuts) - 1
+        for ibl0, ibl1 in zip(cuts[:-1], cuts[1:]):
+            APP.runJob("%s:%s:%d" % (base_job_id, self.name, ibl0), self._smearmapping_worker,
+                       counter=self._job_counter, collect_result=False,
+                       args=(DATA.readonly(), blockdict.writeonly(), sizedict.writeonly(), blindex.readonly(),
+                             ibl0, ibl1, dPhi, l, channel_mapping, mode))
 
 
 
     def collectSmearMapping (self, DATA, field):
-        APP.awaitJobCounter(self._job_counter, progress="Mapping %s"%self.name, total=self._nbl, timeout=1)
+        APP.awaitJobCounter(self._job_counter, progress="Mapping %s"%self.name, total=self._njobs, timeout=1)
         self._outdict.reload()
         #self._outdict.save("bda.dict")
         blockdict = self._outdict["blocks"]
@@ -339,11 +362,16 @@ class ClassSmearMapping():
         return OutputMapping, fact
 
 
-def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping):
-
-    A0 = DATA["A0"]
-    A1 = DATA["A1"]
-    row_index = np.where((A0 == a0) & (A1 == a1))[0]
+def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping, row_index=None):
+    """
+    Computes the BDA blocks of baseline a0,a1. row_index gives the rows of that baseline (in time order), if it is
+    already known (see SmearMappingMachine.computeSmearMappingInBackground), else it is looked up in DATA.
+    Returns a flat array of [ch0,ch1,rows...] blocks, an array of block sizes, and the number of blocks.
+    """
+    if row_index is None:
+        A0 = DATA["A0"]
+        A1 = DATA["A1"]
+        row_index = np.where((A0 == a0) & (A1 == a1))[0]
     nrows = row_index.size
     if not nrows:
         return None, None, None
@@ -398,40 +426,26 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping):
     dnu = (C / (2*np.pi)) * dPhi / uv  # delta-nu for each row (i.e. delta-nu corresponding to a phase change of dPhi) 
     fracsizeChanBlock = dnu / dFreq  # max size of averaging block, in fractional channels, for each row
 
-    if True:  # fast-style, maybe not as precise
-        # accumulate delta-phase, and divide by dPhi. Take the floor of that -- that gives us an integer, the time block number
-        # for each row
-        if Duv:
-            rowblock = np.zeros(nrows+1)
-            rowblock[:nrows] = np.int32(delta_phase.cumsum() / dPhi)
-            rowblock[nrows] = -1
-            # rowblock is now an nrows+1 vector of block numbers per each row, with an -1 at the end, e.g. [ 1 1 1 2 2 2 3 -1]
-            # np.roll(rowblock,1) "rolls" this vector to the right, resulting in:                          [-1 1 1 1 2 2 2  3]
-            # now, every position in the array where roll!=rowblock is a starting position for a block.
-            # conveniently (and by construction, thanks to the -1 at the end), this always includes the 0 and the nrows position.
-            blockcut = np.where(np.roll(rowblock,1) != rowblock)[0]
-            nblocks = len(blockcut)
-            # make list of rows slices for each time block. The where() statement above gives us a list of rows at
-            # which the block index has changed, i.e. [0 N1 N2 Nrows]. Convert this into slice objects representing
-            # [0,N1), [N1,N2), ..., [Nx,Nrows)
-            block_slices = [ slice(blockcut[i],blockcut[i+1]) for i in xrange(nblocks-1) ]
-        else:
-            block_slices = [ slice(i,i+1) for i in xrange(nrows) ]
-    else:   # slow-style, more like Cyril used to do it
-        block_slices = []
-        dphtot = row0 = 0
-        # row0 is start of current block; delta_phase[i] is distance of row i+1 wrt row i
-        for row, dph in enumerate(delta_phase):
-            dphtot += dph
-            if dphtot > dPhi:  # if more than critical, then block is [row0,row+1)
-                block_slices.append(slice(row0, row+1))
-                dphtot = 0
-                row0 = row+1
-        # add last block
-        block_slices.append(slice(row0,nrows))
+    # accumulate delta-phase, and divide by dPhi. Take the floor of that -- that gives us an integer, the time block number
+    # for each row
+    if Duv:
+        rowblock = np.zeros(nrows+1)
+        rowblock[:nrows] = np.int32(delta_phase.cumsum() / dPhi)
+        rowblock[nrows] = -1
+        # rowblock is now an nrows+1 vector of block numbers per each row, with an -1 at the end, e.g. [ 1 1 1 2 2 2 3 -1]
+        # np.roll(rowblock,1) "rolls" this vector to the right, resulting in:                          [-1 1 1 1 2 2 2  3]
+        # now, every position in the array where roll!=rowblock is a starting position for a block.
+        # conveniently (and by construction, thanks to the -1 at the end), this always includes the 0 and the nrows position.
+        blockcut = np.where(np.roll(rowblock,1) != rowblock)[0]
+    else:
+        blockcut = np.arange(nrows+1)
+    # time block i is made up of rows [blockcut[i],blockcut[i+1])
+    block_start = blockcut[:-1]
+    block_nrows = blockcut[1:] - blockcut[:-1]
+    ntimeblocks = block_start.size
 
     # now find the minimum (fractional) channel block size for each time block. If this is <1, set to 1
-    fracsizeChanBlockMin = np.array([ max(fracsizeChanBlock[slc].min(), 1) for slc in block_slices ])
+    fracsizeChanBlockMin = np.maximum(np.minimum.reduceat(fracsizeChanBlock, block_start), 1)
 
     # convert that into an integer number of channel blocks for each time block
     numChanBlocks = np.ceil(NChan/fracsizeChanBlockMin)
@@ -441,11 +455,10 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping):
     sizeChanBlock = np.int32(np.ceil(NChan/numChanBlocks))  # per each time block
 
     # now, we only have a small set of possible sizeChanBlock values across all time blocks, and the split into channel
-    # blocks needs to be computed separately for each such channelization
-    uniqueChannelBlockSizes = np.array(list(set(sizeChanBlock)))
+    # blocks needs to be computed separately for each such channelization. channelization_num maps each time block
+    # to its channelization
+    uniqueChannelBlockSizes, channelization_num = np.unique(sizeChanBlock, return_inverse=True)
     num_bs = uniqueChannelBlockSizes.size
-    # reverse mapping: from unique block size, to channelization number
-    channelization_num = dict([ (sz,i) for i,sz in enumerate(uniqueChannelBlockSizes) ])
 
     # now make a mapping: for each possible block size, we have a list of integer (chanblock_number,grid_number) pairs, one per channel.
     # we make chanpairs: a (Nblocksize,Nchan+1,2) array to hold these. We include +1 at the end to form up cuts (below),
@@ -461,36 +474,48 @@ def GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l_max, GridChanMapping):
     # changes will be a (NBlocksize, NChan+1) array with True at every "cut block" position, including always at 0 and NChan
     changes = (chanpairs != np.roll(chanpairs,1,axis=1)).any(axis=2)
 
-    # list of lists: for each blocksize, lists channels where to cut for that blocksize
-    changes_where = [ np.where(changes[bs,:])[0] for bs in xrange(num_bs) ]
-
-    # list of lists: for each blocksize, lists (ch0,ch1) pairs indicating the blocks
-    channel_cuts = [ [ (chwh[i], chwh[i+1]) for i in xrange(len(chwh)-1) ] for chwh in changes_where ]
+    # for each blocksize, the channels where to cut for that blocksize, padded into a (num_bs, max_ncuts) array
+    ncuts = changes.sum(axis=1)
+    cuts = np.zeros((num_bs, ncuts.max()), np.int32)
+    for bs in xrange(num_bs):
+        cuts[bs, :ncuts[bs]] = np.where(changes[bs,:])[0]
 
     # ok, now to form up the list in grand Cyril format: for each time block, for each channel block in that
-    # time block, we need to make a list of [ch0,ch1,rows]
-
-    blocklists = [ [ch0, ch1] + list(row_index[block_slices[iblock]]) for iblock, sz in enumerate(sizeChanBlock)
-                                                                      for ch0, ch1 in channel_cuts[channelization_num[sz]] ]
+    # time block, we need to make a list of [ch0,ch1,rows]. Enumerate the (time block, channel block) pairs in
+    # that order, then fill in the flat output array with fancy indexing
+    nchanblocks = ncuts[channelization_num] - 1
+    NBlocksTotBL = int(nchanblocks.sum())
+    blk_time = np.repeat(np.arange(ntimeblocks), nchanblocks)
+    blk_chan = np.arange(NBlocksTotBL) - np.repeat(np.cumsum(nchanblocks) - nchanblocks, nchanblocks)
+    blk_chz = channelization_num[blk_time]
+    blk_nrows = block_nrows[blk_time]
+
+    # list of blocklist sizes, per block, and the offset of each block in the mega-list
+    BlocksSizesBL = 2 + blk_nrows
+    blk_offset = np.cumsum(BlocksSizesBL) - BlocksSizesBL
+
+    BlocksRowsListBL = np.zeros((BlocksSizesBL.sum(),), np.int32)
+    BlocksRowsListBL[blk_offset] = cuts[blk_chz, blk_chan]
+    BlocksRowsListBL[blk_offset+1] = cuts[blk_chz, blk_chan+1]
+    # element j of the rows of a block is row block_start+j of its time block
+    elem_blk = np.repeat(np.arange(NBlocksTotBL), blk_nrows)
+    elem_j = np.arange(elem_blk.size) - np.repeat(np.cumsum(blk_nrows) - blk_nrows, blk_nrows)
+    BlocksRowsListBL[blk_offset[elem_blk]+2+elem_j] = row_index[block_start[blk_time[elem_blk]]+elem_j]
 
 #    print>> log, "baseline %d:%d blocklists %s" % (a0, a1, " ".join([",".join(map(str,bl)) for bl in blocklists]))
 
-    # list of blocklist sizes, per block
-    BlocksSizesBL = [ len(bl) for bl in blocklists ]
-    # total number of blocks
-    NBlocksTotBL = len(BlocksSizesBL)
-    # and concatenate all blocks into a single mega-list
-    BlocksRowsListBL = list(itertools.chain(*blocklists))
-
     return BlocksRowsListBL, BlocksSizesBL, NBlocksTotBL
 
 #BlocksRowsListBL, BlocksSizesBL, _ = GiveBlocksRowsListBL(a0, a1, DATA, dPhi, l, channel_mapping)
 
 #def GiveBlocksRowsListBL_old(a0, a1, DATA, InfoSmearMapping, GridChanMapping):
-def GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping):
-    A0 = DATA["A0"]
-    A1 = DATA["A1"]
-    ind = np.where((A0 == a0) & (A1 == a1))[0]
+def GiveBlocksRowsListBL_old(a0, a1, DATA, dPhi, l, channel_mapping, row_index=None):
+    if row_index is None:
+        A0 = DATA["A0"]
+        A1 = DATA["A1"]
+        ind = np.where((A0 == a0) & (A1 == a1))[0]
+    else:
+        ind = row_index
     #if(ind.size <= 1):
     #    return
     nrows = ind.size
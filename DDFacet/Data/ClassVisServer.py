@@ -26,10 +26,12 @@ import ClassMS
 from DDFacet.Data.ClassStokes import ClassStokes
 from DDFacet.Other import ModColor
 from DDFacet.Other import MyLogger
+from DDFacet.Other.CacheManager import CacheManager
 from functools import reduce
 MyLogger.setSilent(["NpShared"])
 import ClassSmearMapping
 import ClassJones
+import ModVisCache
 from DDFacet.Array import shared_dict
 from DDFacet.Other.AsyncProcessPool import APP
 import DDFacet.cbuild.Gridder._pyGridderSmearPols as _pyGridderSmearPols
@@ -87,15 +89,23 @@ class ClassVisServer():
             self._use_data_cache = None
         self.DATA = None
         self._saved_data = None  # vis data saved here for single-chunk mode
+        # chunks scheduled for loading, in order of processing, as (dictname, label, scheduled) tuples
+        self._chunk_queue = []
+        self._num_chunk_loads = 0
+        self._read_ahead = max(1, self.GD["Data"]["ReadAhead"])
+        self._read_ahead_memory = self.GD["Data"]["ReadAheadMemory"]*(1<<30)
         self.obs_detail = None
         self.Init()
 
         # if True, then skip weights calculation (but do load max-w!)
         self._ignore_vis_weights = False
 
-        # smear mapping machines
-        self._smm_grid = ClassSmearMapping.SmearMappingMachine("BDA.Grid")
-        self._smm_degrid = ClassSmearMapping.SmearMappingMachine("BDA.Degrid")
+        # smear mapping machines, one (gridding, degridding) pair per IO queue. A chunk's mappings are computed by
+        # the IO process loading it, and read-ahead chunks are loaded concurrently on different IO queues, so
+        # each needs its own machines, and thus its own job counters
+        self._smms = [ (ClassSmearMapping.SmearMappingMachine("BDA.Grid.%d" % io),
+                        ClassSmearMapping.SmearMappingMachine("BDA.Degrid.%d" % io))
+                       for io in xrange(self._read_ahead) ]
         self._put_vis_column_job_id = self._put_vis_column_label = None
 
 
@@ -122,6 +132,8 @@ class ClassVisServer():
         # max chunk shape accumulated here
         self._chunk_shape = [0, 0, 0]
 
+        CacheManager.total_budget = self.GD["Cache"]["MaxTotalSize"]*(1<<30)
+
         for msspec in self.MSList:
             if type(msspec) is not str:
                 msname, ddid, field, column = msspec
@@ -152,6 +164,10 @@ class ClassVisServer():
         size = reduce(lambda x, y: x * y, self._chunk_shape)
         print >>log, "shape of data/flag buffer will be %s (%.2f Gel)" % (
             self._chunk_shape, size / float(2 ** 30))
+        # rough upper bound on the shared memory taken up by a loaded chunk: visibilities, flags, weights, and
+        # per-row uvw/times/antennas
+        nrow, nchan, _ = self._chunk_shape
+        self._chunk_nbytes = size*9 + nrow*(nchan*4 + 64)
 
         if not self.ListMS:
             print>>log, ModColor.Str("--Data-MS does not specify any valid Measurement Set(s)")
@@ -162,8 +178,8 @@ class ClassVisServer():
         # main cache is initialized from main cache of first MS
         if ".txt" in self.GD["Data"]["MS"]:
             # main cache is initialized from main cache of the MSList
-            from DDFacet.Other.CacheManager import CacheManager
-            self.maincache = self.cache = CacheManager("%s.ddfcache"%self.GD["Data"]["MS"], cachedir=self.GD["Cache"]["Dir"], reset=self.GD["Cache"]["Reset"])
+            self.maincache = self.cache = CacheManager("%s.ddfcache"%self.GD["Data"]["MS"], cachedir=self.GD["Cache"]["Dir"], reset=self.GD["Cache"]["Reset"],
+                                                       budget=self.GD["Cache"]["MaxSize"]*(1<<30))
         else:
             # main cache is initialized from main cache of first MS
             self.maincache = self.cache = self.ListMS[0].maincache
@@ -366,9 +382,18 @@ class ClassVisServer():
         if self.nTotalChunks > 1 and self.DATA is not None:
             self.DATA.delete()
             self.DATA = None
+        self._discardChunkQueue()
         self.iCurrentMS = 0
         self.iCurrentChunk = -1
 
+    def _discardChunkQueue(self):
+        """Waits for any chunks still being loaded in the background, and discards them"""
+        for dictname, label, scheduled in self._chunk_queue:
+            if scheduled:
+                APP.awaitJobResults(dictname)
+                shared_dict.attach(dictname).delete()
+        self._chunk_queue = []
+
 
     def startVisPutColumnInBackground(self, DATA, field, column, likecol="DATA"):
         iMS, iChunk = DATA["iMS"], DATA["iChunk"]
@@ -393,42 +418,63 @@ class ClassVisServer():
 
     def startChunkLoadInBackground(self, last_cycle=False):
         """
-        Called in main process. Increments chunk counter, initiates chunk load in background thread.
+        Called in main process. Initiates loading of the next chunk(s) in background I/O processes. Up to
+        --Data-ReadAhead chunks are loaded ahead (concurrently, on separate I/O processes), as long as they
+        fit into --Data-ReadAheadMemory. In the last cycle chunks are loaded one at a time on the first I/O
+        queue, so that they are ordered with respect to the jobs writing out visibilities.
+        Returns None if we get past the last chunk, else returns the label of the last chunk scheduled.
+        """
+        depth = 1 if last_cycle else self._read_ahead
+        label = None
+        while len(self._chunk_queue) < depth:
+            # one chunk can always be scheduled, further ones only if they fit into the memory budget
+            if self._chunk_queue and self._read_ahead_memory:
+                nchunks = len(self._chunk_queue) + 1 + (self.DATA is not None)
+                if nchunks*self._chunk_nbytes > self._read_ahead_memory:
+                    break
+            label = self._scheduleNextChunk(last_cycle)
+            if label is None:
+                break
+        return label
+
+    def _scheduleNextChunk(self, last_cycle):
+        """
+        Increments chunk counter, initiates chunk load in background thread.
         Returns None if we get past the last chunk, else returns the chunk label.
         """
-        while True:
+        while self.iCurrentMS < len(self.ListMS):
             # advance chunk pointer
             self.iCurrentChunk += 1
             ms = self.ListMS[self.iCurrentMS]
             # go to next MS?
             if self.iCurrentChunk >= ms.numChunks():
                 self.iCurrentMS += 1
-                # no more MSs -- return None
-                if self.iCurrentMS >= len(self.ListMS):
-                    self._next_chunk_name = None
-                    self.iCurrentMS = 0
-                    self.iCurrentChunk = -1
-                    return None
                 # go back up to first chunk of next MS
                 self.iCurrentChunk = -1
                 continue
-            self._next_chunk_name = "DATA:%d:%d" % (self.iCurrentMS, self.iCurrentChunk)
-            self._next_chunk_label = "%d.%d" % (self.iCurrentMS + 1, self.iCurrentChunk + 1)
+            dictname = "DATA:%d:%d" % (self.iCurrentMS, self.iCurrentChunk)
+            label = "%d.%d" % (self.iCurrentMS + 1, self.iCurrentChunk + 1)
             # null chunk? skip to next chunk, unless we're in the last major cycle
             if not self._ignore_vis_weights and not last_cycle:
                 self.awaitWeights()
                 if self.VisWeights[self.iCurrentMS][self.iCurrentChunk]["null"]:
-                    print>>log, ModColor.Str("chunk %s is null, skipping"%self._next_chunk_label)
+                    print>>log, ModColor.Str("chunk %s is null, skipping"%label)
                     continue
             # ok, now we're good to load
-            print>>log, "scheduling loading of chunk %s" % self._next_chunk_label
+            print>>log, "scheduling loading of chunk %s" % label
             # in single-chunk mode, DATA may already be loaded, in which case we do nothing
-            if self.nTotalChunks > 1 or self.DATA is None:
-                # tell the IO thread to start loading the chunk
-                APP.runJob(self._next_chunk_name, self._handler_LoadVisChunk,
-                           args=(self._next_chunk_name, self.iCurrentMS, self.iCurrentChunk), 
-                           io=0)#,serial=True)
-            return self._next_chunk_label
+            scheduled = self.nTotalChunks > 1 or self.DATA is None
+            if scheduled:
+                # tell an IO process to start loading the chunk. Read-ahead chunks go round-robin over the IO queues
+                io = 0 if last_cycle else self._num_chunk_loads % self._read_ahead
+                self._num_chunk_loads += 1
+                APP.runJob(dictname, self._handler_LoadVisChunk,
+                           args=(dictname, self.iCurrentMS, self.iCurrentChunk, io),
+                           io=io)#,serial=True)
+            self._chunk_queue.append((dictname, label, scheduled))
+            return label
+        # no more MSs -- return None
+        return None
 
     def collectLoadedChunk(self, start_next=True, last_cycle=False):
         # previous data dict can now be discarded from shm
@@ -436,18 +482,19 @@ class ClassVisServer():
             self.DATA.delete()
             self.DATA = None
         # if no next chunk scheduled, we're at end
-        if not self._next_chunk_name:
+        if not self._chunk_queue:
             return "EndOfObservation"
+        dictname, label, scheduled = self._chunk_queue.pop(0)
         # in single-chunk mode, only read the MS once, then keep it forever,
         # but re-copy visibility data from original data
-        if self.nTotalChunks == 1 and self.DATA is not None and "data" in self.DATA:
+        if not scheduled and "data" in self.DATA:
             np.copyto(self.DATA["data"], self._saved_data)
-        else:
+        elif scheduled:
             # await completion of data loading jobs (which, presumably, includes smear mapping)
-            APP.awaitJobResults(self._next_chunk_name, timing="Reading %s"%self._next_chunk_label )
+            APP.awaitJobResults(dictname, timing="Reading %s"%label)
             # reload the data dict -- background thread will now have populated it
-            self.DATA = shared_dict.attach(self._next_chunk_name)
-            self.DATA["label"] = self._next_chunk_label
+            self.DATA = shared_dict.attach(dictname)
+            self.DATA["label"] = label
             # in single-chunk mode, keep a copy of the data array
             if self.nTotalChunks == 1 and "data" in self.DATA and self._saved_data is None:
                 self._saved_data = self.DATA["data"].copy()
@@ -463,14 +510,16 @@ class ClassVisServer():
         if self.DATA is not None:
             self.DATA.delete()
             self.DATA = None
+        self._discardChunkQueue()
 
 
-    def _handler_LoadVisChunk(self, dictname, iMS, iChunk):
+    def _handler_LoadVisChunk(self, dictname, iMS, iChunk, io=0):
         """
         Called in IO thread to load a data chunk
         Args:
             null_data: if True, then we don't want to read the visibility data at all, but rather just want to make
                 a null buffer of the same shape as the visibility data.
+            io: the I/O queue the chunk is loaded on
         """
         DATA = shared_dict.create(dictname)
         DATA["iMS"]    = iMS
@@ -483,6 +532,10 @@ class ClassVisServer():
                      read_data=bool(self.ColName), sort_by_baseline=self.GD["Data"]["Sort"])
         # update cache to match MSs current chunk cache
         self.cache = ms.cache
+        # keep the visibility caches of all MSs within budget, evicting the least recently used chunks
+        if self._use_data_cache and self.GD["Cache"]["VisDataBudget"]:
+            ModVisCache.trimCache([ dirname for ms1 in self.ListMS for dirname in ms1.getChunkCacheDirs() ],
+                                  self.GD["Cache"]["VisDataBudget"]*(1<<30), keep=ms.cache.dirname)
 
 
         times = DATA["times"]
@@ -525,7 +578,7 @@ class ClassVisServer():
         if DATA["sort_index"] is not None and DATA["Weights"] is not 1:
             DATA["Weights"] = DATA["Weights"][DATA["sort_index"]]
 
-        self.computeBDAInBackground(dictname, ms, DATA,
+        self.computeBDAInBackground(dictname, ms, DATA, io=io,
             ChanMappingGridding=DATA["ChanMapping"],
             ChanMappingDeGridding=DATA["ChanMappingDegrid"])
 
@@ -536,7 +589,7 @@ class ClassVisServer():
             data += (self.AddNoiseJy/np.sqrt(2.))*(np.random.randn(*data.shape)+1j*np.random.randn(*data.shape))
 
         # load results of smear mapping computation
-        self.collectBDA(dictname, DATA)
+        self.collectBDA(dictname, DATA, io=io)
 
     def setFacetMachine(self, FacetMachine):
         self.FacetMachine = FacetMachine
@@ -551,21 +604,27 @@ class ClassVisServer():
         self.FacetShape = sh2
         self.CellSizeRad = cell
 
-    def collectBDA(self, base_job_id, DATA):
-        """Called in I/O thread. Waits for BDA computation to complete (if any), then populates dict"""
+    def collectBDA(self, base_job_id, DATA, io=0):
+        """
+        Called in I/O thread. Waits for BDA computation to complete (if any), then populates dict.
+        io is the I/O queue the chunk is loaded on, which selects the smear mapping machines.
+        """
+        smm_grid, smm_degrid = self._smms[io]
         if "BDA.Grid" not in DATA:
-            FinalMapping, fact = self._smm_grid.collectSmearMapping(DATA, "BDA.Grid")
+            FinalMapping, fact = smm_grid.collectSmearMapping(DATA, "BDA.Grid")
             print>> log, ModColor.Str("  Effective compression [grid]  :   %.2f%%" % fact, col="green")
             np.save(file(self._bda_grid_cachename, 'w'), FinalMapping)
             self.cache.saveCache("BDA.Grid")
         if "BDA.Degrid" not in DATA:
-            FinalMapping, fact = self._smm_degrid.collectSmearMapping(DATA, "BDA.Degrid")
+            FinalMapping, fact = smm_degrid.collectSmearMapping(DATA, "BDA.Degrid")
             print>> log, ModColor.Str("  Effective compression [degrid]:   %.2f%%" % fact, col="green")
             DATA["BDA.Degrid"] = FinalMapping
             np.save(file(self._bda_degrid_cachename, 'w'), FinalMapping)
             self.cache.saveCache("BDA.Degrid")
 
-    def computeBDAInBackground(self, base_job_id, ms, DATA, ChanMappingGridding=None, ChanMappingDeGridding=None):
+    def computeBDAInBackground(self, base_job_id, ms, DATA, ChanMappingGridding=None, ChanMappingDeGridding=None,
+                               io=0):
+        smm_grid, smm_degrid = self._smms[io]
 
         GD=copy.deepcopy(self.GD)
         CriticalCacheParms=dict(Data=GD["Data"],
@@ -574,10 +633,20 @@ class ClassVisServer():
                                 DataSelection=GD["Selection"],
                                 Sorting=GD["Data"]["Sort"])
         del CriticalCacheParms["Data"]["ColName"],CriticalCacheParms["DataSelection"]["FlagAnts"]
+        content_keys = self.GD["Cache"]["Keys"] == "content"
+        if content_keys:
+            # the mappings depend on the chunk's metadata, the channel mappings and the gridding FoV
+            row0, row1 = ms.getChunkRow0Row1()[DATA["iChunk"]]
+            CriticalCacheParms = ms.getContentKey(row0, row1,
+                                                  sort=GD["Data"]["Sort"],
+                                                  selection=CriticalCacheParms["DataSelection"],
+                                                  comp=GD["Comp"],
+                                                  chanmapping=(ChanMappingGridding, ChanMappingDeGridding),
+                                                  fov=(self.CellSizeRad, self.FacetShape, self.FullImShape))
         
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompGridMode"]:
-            self._bda_grid_cachename, valid = self.cache.checkCache("BDA.Grid",CriticalCacheParms)
+            self._bda_grid_cachename, valid = self.cache.checkCache("BDA.Grid",CriticalCacheParms,content=content_keys)
             if valid:
                 print>> log, "  using cached BDA mapping %s" % self._bda_grid_cachename
                 DATA["BDA.Grid"] = np.load(self._bda_grid_cachename)
@@ -588,12 +657,12 @@ class ClassVisServer():
                     _, _, nx, ny = self.FullImShape
                 mode = self.GD["Comp"]["BDAMode"]
                 FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
-                self._smm_grid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
+                smm_grid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
                                                           (1. - self.GD["Comp"]["GridDecorr"]),
                                                           ChanMappingGridding, mode)
 
         if True: # always True for now, non-BDA gridder is not maintained # if self.GD["Comp"]["CompDeGridMode"]:
-            self._bda_degrid_cachename, valid = self.cache.checkCache("BDA.Degrid",CriticalCacheParms)
+            self._bda_degrid_cachename, valid = self.cache.checkCache("BDA.Degrid",CriticalCacheParms,content=content_keys)
 
             if valid:
                 print>> log, "  using cached BDA mapping %s" % self._bda_degrid_cachename
@@ -605,7 +674,7 @@ class ClassVisServer():
                     _, _, nx, ny = self.FullImShape
                 mode = self.GD["Comp"]["BDAMode"]
                 FOV = self.CellSizeRad * nx * (np.sqrt(2.) / 2.) * 180. / np.pi
-                self._smm_degrid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
+                smm_degrid.computeSmearMappingInBackground(base_job_id, ms, DATA, FOV,
                                                           (1. - self.GD["Comp"]["DegridDecorr"]),
                                                           ChanMappingDeGridding, mode)
 
@@ -666,12 +735,28 @@ class ClassVisServer():
             APP.runJob("VisWeights", self._CalcWeights_handler, io=0, singleton=True, event=self._calcweights_event)
         # APP.awaitEvents(self._calcweights_event)
 
+    def _giveWeightsCacheKey(self):
+        """
+        Returns the cache key of the imaging weights and wmax, and whether it is content-keyed (--Cache-Keys).
+        Since weighting is done on a common uv-grid, every weight depends on all the MSs.
+        """
+        if self.GD["Cache"]["Keys"] != "content":
+            return dict([(section, self.GD[section]) for section
+                         in ("Data", "Selection", "Freq", "Image", "Weight")]), False
+        image = self.GD["Image"].copy()
+        del image["SidelobeSearchWindow"]
+        return dict(ms=[ ms.getContentKey(0, ms.F_nrows, chunks=ms.getChunkRow0Row1()) for ms in self.ListMS ],
+                    sort=self.GD["Data"]["Sort"],
+                    selection=self.GD["Selection"],
+                    freq=self.GD["Freq"],
+                    image=image,
+                    weight=self.GD["Weight"]), True
+
     def _CalcWeights_handler(self):
         self._weight_dict = shared_dict.create("VisWeights")
         # check for wmax in cache
-        cache_keys = dict([(section, self.GD[section]) for section
-              in ("Data", "Selection", "Freq", "Image", "Weight")])
-        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys)
+        cache_keys, content_keys = self._giveWeightsCacheKey()
+        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys, content=content_keys)
         if wmax_valid:
             self._weight_dict["wmax"] = cPickle.load(open(wmax_path))
         # check cache first
@@ -680,7 +765,8 @@ class ClassVisServer():
             msweights = self._weight_dict.addSubdict(iMS)
             for ichunk, (row0, row1) in enumerate(MS.getChunkRow0Row1()):
                 msw = msweights.addSubdict(ichunk)
-                path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys)
+                path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys,
+                                                                      content=content_keys)
                 have_all_weights = have_all_weights and valid
                 msw["cachepath"] = path
                 if valid:
@@ -967,9 +1053,8 @@ class ClassVisServer():
     def _CalcWeights_serial(self):
         self._weight_dict = shared_dict.create("VisWeights")
         # check for wmax in cache
-        cache_keys = dict([(section, self.GD[section]) for section
-                           in ("Data", "Selection", "Freq", "Image", "Weight")])
-        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys)
+        cache_keys, content_keys = self._giveWeightsCacheKey()
+        wmax_path, wmax_valid = self.maincache.checkCache("wmax", cache_keys, content=content_keys)
         if wmax_valid:
             self._weight_dict["wmax"] = cPickle.load(open(wmax_path))
         # check cache first
@@ -978,7 +1063,8 @@ class ClassVisServer():
             msweights = self._weight_dict.addSubdict(iMS)
             for ichunk, (row0, row1) in enumerate(MS.getChunkRow0Row1()):
                 msw = msweights.addSubdict(ichunk)
-                path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys)
+                path, valid = MS.getChunkCache(row0, row1).checkCache("ImagingWeights.npy", cache_keys,
+                                                                      content=content_keys)
                 have_all_weights = have_all_weights and valid
                 msw["cachepath"] = path
                 if valid:
@@ -0,0 +1,193 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+"""
+On-disk formats for the per-chunk visibility and flag caches (see ClassMS.ReadData).
+
+Visibilities are stored either as a plain .npy file, which is memory-mapped and copied straight into the shared
+data array on reading, or as a sequence of independently compressed row blocks. In the latter case the float32
+mantissas can be rounded to fewer bits first (lossy), and the bytes are shuffled so that zlib sees the slowly
+varying exponent bytes together.
+
+Flags are stored either as a plain .npy file, or packed 8 per byte.
+
+trimCache() implements a size budget over the caches of several MSs, evicting least recently used items first.
+"""
+
+import os
+import os.path
+import zlib
+import struct
+import cPickle
+import numpy as np
+
+from DDFacet.Other import MyLogger
+from DDFacet.Other.CacheManager import CacheManager
+log = MyLogger.getLogger("ModVisCache")
+
+# magic string at the start of block-compressed files
+ZBLOCK_MAGIC = "DDFZBLK1"
+# uncompressed size of a compression block
+ZBLOCK_SIZE = 64<<20
+
+# cache element names of the visibility and flag caches, per format
+DATA_CACHE_NAMES = dict(npy="Data.npy", zlib="Data.zblk")
+FLAG_CACHE_NAMES = {False: "Flags.npy", True: "Flags.bits.npy"}
+
+
+def _roundMantissa(A, nbits):
+    """Rounds float32 array A (in place) to nbits mantissa bits. Non-finite values are left alone."""
+    drop = 23-nbits
+    if drop <= 0:
+        return A
+    bits = A.view(np.uint32)
+    finite = np.isfinite(A)
+    rounded = (bits + np.uint32(1<<(drop-1))) & np.uint32(~((1<<drop)-1) & 0xFFFFFFFF)
+    bits[finite] = rounded[finite]
+    return A
+
+
+def _rowBlocks(nrows, rowsize):
+    step = max(1, ZBLOCK_SIZE/max(rowsize, 1))
+    return [ (i, min(i+step, nrows)) for i in xrange(0, nrows, step) ]
+
+
+def saveVisData(path, visdata, fmt="npy", mantissa_bits=23, level=1):
+    """Saves visibilities to the cache element at path, in the given format ("npy" or "zlib")"""
+    if fmt == "npy":
+        np.save(file(path, "w"), visdata)
+        return
+    if fmt != "zlib":
+        raise ValueError("unknown visibility cache format '%s'" % fmt)
+    nrows = visdata.shape[0]
+    rowsize = visdata[0:1].nbytes
+    index = []
+    with open(path, "w") as f:
+        f.write(ZBLOCK_MAGIC)
+        for row0, row1 in _rowBlocks(nrows, rowsize):
+            # complex64 -> pairs of float32, rounded, then byte-shuffled
+            block = visdata[row0:row1].copy().view(np.float32)
+            _roundMantissa(block, mantissa_bits)
+            shuffled = block.view(np.uint8).reshape((-1, 4)).T.copy()
+            buf = zlib.compress(shuffled.data, level)
+            index.append((row0, row1, f.tell(), len(buf)))
+            f.write(buf)
+        offset = f.tell()
+        cPickle.dump(dict(shape=visdata.shape, dtype=visdata.dtype.str, mantissa_bits=mantissa_bits, blocks=index), f, 2)
+        f.write(struct.pack("<Q", offset))
+    print>>log, "compressed %.2f GB of visibilities into %.2f GB" % (visdata.nbytes/float(1<<30),
+                                                                      os.path.getsize(path)/float(1<<30))
+
+
+def loadVisData(path, out):
+    """Reads cached visibilities from path into array out (e.g. the shared data array of a chunk)"""
+    with open(path) as f:
+        magic = f.read(len(ZBLOCK_MAGIC))
+        if magic != ZBLOCK_MAGIC:
+            f.close()
+            # plain .npy file: map it and copy straight into the output array, without an intermediate copy
+            np.copyto(out, np.load(path, mmap_mode="r"))
+            return out
+        f.seek(-8, os.SEEK_END)
+        offset, = struct.unpack("<Q", f.read(8))
+        f.seek(offset)
+        header = cPickle.load(f)
+        if tuple(header["shape"]) != out.shape or np.dtype(header["dtype"]) != out.dtype:
+            raise RuntimeError("cached visibilities in %s have shape %s, expected %s" % (path, header["shape"], out.shape))
+        for row0, row1, offset, nbytes in header["blocks"]:
+            f.seek(offset)
+            shuffled = np.frombuffer(zlib.decompress(f.read(nbytes)), np.uint8).reshape((4, -1))
+            out[row0:row1] = shuffled.T.copy().reshape(-1).view(out.dtype).reshape(out[row0:row1].shape)
+    return out
+
+
+def saveFlags(path, flags, packed=False):
+    """Saves flags to the cache element at path, optionally packed 8 to a byte"""
+    if packed:
+        np.save(file(path, "w"), np.packbits(flags.reshape(-1)))
+    else:
+        np.save(file(path, "w"), flags)
+
+
+def loadFlags(path, out, packed=False):
+    """Reads cached flags from path into array out"""
+    mm = np.load(path, mmap_mode="r")
+    if not packed:
+        np.copyto(out, mm)
+        return out
+    # unpack in blocks, to avoid a full-size uint8 temporary
+    flat = out.reshape(-1)
+    step = ZBLOCK_SIZE/8
+    for i in xrange(0, mm.size, step):
+        bits = np.unpackbits(mm[i:i+step])
+        i0 = i*8
+        n = min(bits.size, flat.size-i0)
+        flat[i0:i0+n] = bits[:n]
+    return out
+
+
+def touch(path):
+    """Marks a cache element as recently used"""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def trimCache(dirnames, budget, keep=None):
+    """
+    Enforces a size budget (in bytes) on the visibility and flag caches found in the given cache directories.
+    Least recently used elements (see touch()) are deleted first, along with their hash files, so that the
+    corresponding cache manager will consider them invalid and re-make them. Elements in directory 'keep' are
+    never evicted.
+    """
+    names = set(DATA_CACHE_NAMES.values() + FLAG_CACHE_NAMES.values())
+    items = []
+    for dirname in dirnames:
+        try:
+            filenames = os.listdir(dirname)
+        except OSError:
+            continue
+        # content-keyed caches hold several versions of each element (see CacheManager.getContentName())
+        for filename in filenames:
+            if filename not in names and not any([ CacheManager.isContentName(filename, name) for name in names ]):
+                continue
+            path = os.path.join(dirname, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            items.append((st.st_mtime, st.st_size, path, dirname))
+    total = sum([ item[1] for item in items ])
+    if total <= budget:
+        return
+    for _, size, path, dirname in sorted(items):
+        if dirname == keep:
+            continue
+        print>>log, "visibility cache is %.2f GB, over budget of %.2f GB: evicting %s" % (total/float(1<<30),
+                                                                                         budget/float(1<<30), path)
+        for p in path+".hash", path:
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+        total -= size
+        if total <= budget:
+            break
@@ -19,7 +19,6 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 import numpy as np 
-from scipy.interpolate import interp1d
 import pandas as pd
 from pyrap import quanta as qa
 import datetime
@@ -97,8 +96,12 @@ class PointingProvider(object):
             print>> log, "Read pointing error solutions from %s" % pointing_errs_file
 
     def _init_interpolator(self):
-        """ Initializes dictionary keyed on antenna, correlation and RA, DEC with solution interpolators """
-        self._interp_offsets = {}
+        """
+        Initializes the stacked interpolation table. The time-sorted solutions of every (antenna, correlation)
+        pair are concatenated into one table, each pair being a segment of it. Times are offset by segment
+        number times the total time span, so that a single searchsorted locates any number of (antenna, time)
+        queries in their own segments (see offsets())
+        """
         mjd2utc = lambda x: datetime.datetime.utcfromtimestamp(qa.quantity(str(x)+'s').to_unix_time())
         if self.sols_filename == "" or not self.sols_filename:
             print>>log, "Initializing pointing solutions to 0.0, 0.0 for stations %s" % ",".join(set(self._raw_offsets["#ANT"]))
@@ -106,29 +109,38 @@ class PointingProvider(object):
             print>>log, "Pointing solutions span %s to %s UTC" % (mjd2utc(self._raw_offsets.min()["TIME"]),
                                                                   mjd2utc(self._raw_offsets.max()["TIME"]))
             print>>log, "Pointing solutions contain solutions for stations %s" % ",".join(set(self._raw_offsets["#ANT"]))
-        for a in set(self._raw_offsets["#ANT"]):
-            self._interp_offsets[a] = {c: {} for c in self._ptcorr_labels}
+        self._tab_t0 = float(self._raw_offsets["TIME"].min())
+        self._tab_span = float(self._raw_offsets["TIME"].max()) - self._tab_t0 + 1.
+        self._interp_offsets = {}
+        tab_t, tab_ra, tab_dec, seg_start, seg_end = [], [], [], [], []
+        nrow = 0
+        for a in sorted(set(self._raw_offsets["#ANT"])):
+            self._interp_offsets[a] = {}
             self._min_time_ant[a] = self._raw_offsets.where(self._raw_offsets["#ANT"] == a).min()["TIME"]
             self._max_time_ant[a] = self._raw_offsets.where(self._raw_offsets["#ANT"] == a).max()["TIME"]
 
-            for f in ["XX", "YY"] if self._feed_type == "linear" else ["RR", "LL"]:
+            for f in self._ptcorr_labels:
                 sel = self._raw_offsets.where(np.logical_and(self._raw_offsets["#ANT"] == a,
                                                              self._raw_offsets["POL"] == f)).dropna()
+                if len(sel) < 2:
+                    raise InvalidPointingSolutions("Need at least two solutions to interpolate station %s feed %s" % (a, f))
                 sel_sorted = sel.sort_values("TIME")
-                self._interp_offsets[a][f]["RA"] = interp1d(sel["TIME"],
-                                                            sel["RA_ERR(deg)"],
-                                                            kind=PointingProvider.__AVAILABLE_INTERPOLATORS[self._interp_mode],
-                                                            bounds_error=False,
-                                                            fill_value=(sel_sorted["RA_ERR(deg)"].iloc[0], sel_sorted["RA_ERR(deg)"].iloc[-1]))
-                self._interp_offsets[a][f]["DEC"] = interp1d(sel["TIME"],
-                                                             sel["DEC_ERR(deg)"],
-                                                             kind=PointingProvider.__AVAILABLE_INTERPOLATORS[self._interp_mode],
-                                                             bounds_error=False,
-                                                             fill_value=(sel_sorted["DEC_ERR(deg)"].iloc[0], sel_sorted["DEC_ERR(deg)"].iloc[-1]))
-                
+                iseg = len(seg_start)
+                self._interp_offsets[a][f] = iseg
+                tab_t.append(iseg * self._tab_span + (sel_sorted["TIME"].values - self._tab_t0))
+                tab_ra.append(sel_sorted["RA_ERR(deg)"].values)
+                tab_dec.append(sel_sorted["DEC_ERR(deg)"].values)
+                seg_start.append(nrow)
+                nrow += len(sel_sorted)
+                seg_end.append(nrow)
+
                 print>> log, "Station %s feed %s has interquartile pointing spread of (%.2f, %.2f) deg in RA and (%.2f, %.2f) deg in DECL" % \
                      (a, f, sel.quantile(.25)["RA_ERR(deg)"], sel.quantile(.75)["RA_ERR(deg)"], 
                       sel.quantile(.25)["DEC_ERR(deg)"], sel.quantile(.75)["DEC_ERR(deg)"])
+        self._tab_t = np.concatenate(tab_t).astype(np.float64)
+        self._tab_radec = np.array([np.concatenate(tab_ra), np.concatenate(tab_dec)], np.float64).T.copy()
+        self._seg_start = np.array(seg_start, np.int64)
+        self._seg_end = np.array(seg_end, np.int64)
     
     @property
     def sols_filename(self):
@@ -148,6 +160,47 @@ class PointingProvider(object):
         self._interp_mode = value
         self._init_interpolator()
         
+    def offsets(self, antenna_names, time, corrs=None):
+        """
+        Gets interpolated pointing offsets for several antennas and times in one go
+
+        Arguments:
+        antenna_names: list of antenna/station names as they appear in the ::ANTENNA subtable
+        time: ndarray of mean Julian date time values (UTC) as read from TIME
+        corrs: list of correlations (XX, YY or RR, LL depending on feed type of measurement). Default is both.
+
+        Returns ndarray of shape [ncorr, nant, ntime, 2] of (RA, DEC) offsets in degrees. Antennas without
+        solutions get 0.0 offsets. Outside of the solution interval, the nearest solution is used.
+        """
+        if corrs is None:
+            corrs = self._ptcorr_labels
+        time = np.atleast_1d(np.asarray(time, np.float64)).ravel()
+        out = np.zeros((len(corrs), len(antenna_names), time.size, 2), np.float64)
+        missing = [ a for a in antenna_names if a not in self._interp_offsets ]
+        if missing:
+            print>>log, "No pointing solutions for station(s) %s, assuming 0.0" % ",".join(missing)
+        extrap = [ a for a in antenna_names if a in self._interp_offsets and
+                   np.any((time < self._min_time_ant[a]) | (time > self._max_time_ant[a])) ]
+        if extrap:
+            print>>log, "Warning: extrapolating pointing errors for station(s) %s." % ",".join(extrap)
+        for icorr, corr in enumerate(corrs):
+            if corr not in self._ptcorr_labels:
+                raise KeyError("No interpolated solutions for correlation %s. This is a bug." % corr)
+            iant = np.array([ i for i, a in enumerate(antenna_names) if a in self._interp_offsets ], np.int64)
+            if not iant.size:
+                continue
+            seg = np.array([ self._interp_offsets[antenna_names[i]][corr] for i in iant ], np.int64).reshape((-1, 1))
+            start, end = self._seg_start[seg], self._seg_end[seg]
+            # position in the stacked table, clamped to the segment: extrapolation uses the nearest solution
+            q = seg * self._tab_span + (time.reshape((1, -1)) - self._tab_t0)
+            q = np.clip(q, self._tab_t[start], self._tab_t[end-1])
+            i0 = np.clip(np.searchsorted(self._tab_t, q, side="right") - 1, start, end-2)
+            t0, t1 = self._tab_t[i0], self._tab_t[i0+1]
+            dt = t1 - t0
+            w = np.where(dt > 0, (q - t0) / np.where(dt > 0, dt, 1.), 0.)[..., np.newaxis]
+            out[icorr, iant] = self._tab_radec[i0] * (1. - w) + self._tab_radec[i0+1] * w
+        return out
+
     def __get_offset(self, antenna_name, time, corr):
         """ 
         Gets interpolated pointing offset 
@@ -157,20 +210,8 @@ class PointingProvider(object):
         time: float / ndarray of mean Julian date time values (UTC) as read from TIME
         corr: XX, YY or RR, LL depending on feed type of measurement
         """
-        if antenna_name not in self._interp_offsets.keys():
-            print>>log, "No pointing solutions for station %s, assuming 0.0" % antenna_name
-            return np.array([np.zeros_like(time), np.zeros_like(time)])
-        num_extrap = np.sum(np.logical_or(time < self._min_time_ant[antenna_name],
-                                          time > self._max_time_ant[antenna_name]))
-
-        if num_extrap > 0:
-            print>>log, "Warning: extrapolating %.2f%% pointing errors for antenna %s." % \
-                    ((num_extrap / float(time.size) * 100.0), antenna_name)
-        if corr not in self._interp_offsets[antenna_name].keys():
-            raise KeyError("No interpolated solutions for correlation %s. This is a bug." % corr)
-        ra = self._interp_offsets[antenna_name][corr]["RA"](time)
-        dec = self._interp_offsets[antenna_name][corr]["DEC"](time) 
-        return np.array([ra, dec])
+        radec = self.offsets([antenna_name], time, [corr])[0, 0]
+        return radec.T.reshape((2,) + np.shape(time))
     
     def offset_XX(self, antenna_name, time):
         """
@@ -89,7 +89,8 @@ namespace DDF {
 		    const py::list& LSmearing,
 		    const py::array_t<int32_t, py::array::c_style>& np_ChanMapping,
 		    const py::array_t<uint16_t, py::array::c_style>& LDataCorrFormat,
-		    const py::array_t<uint16_t, py::array::c_style>& LExpectedOutStokes
+		    const py::array_t<uint16_t, py::array::c_style>& LExpectedOutStokes,
+		    int nthreads
 		    )
   {
     using svec = vector<string>;
@@ -113,7 +114,7 @@ namespace DDF {
       }
     #define callgridder(stokesgrid, nVisPol) \
       {\
-      gridder::gridder<readcorr, mulaccum, stokesgrid>(np_grid, vis, uvw, flags, weights, sumwt, bool(dopsf), Lcfs, LcfsConj, WInfos, increment, freqs, Lmaps, LJones, SmearMapping, Sparsification, LOptimisation,LSmearing,np_ChanMapping, expstokes); \
+      gridder::gridder<readcorr, mulaccum, stokesgrid>(np_grid, vis, uvw, flags, weights, sumwt, bool(dopsf), Lcfs, LcfsConj, WInfos, increment, freqs, Lmaps, LJones, SmearMapping, Sparsification, LOptimisation,LSmearing,np_ChanMapping, expstokes, nthreads); \
       done=true;\
       }
     using namespace DDF::gridder::policies;
@@ -250,7 +251,9 @@ namespace DDF {
     m.def("pyAccumulateWeightsOntoGridNoSem",
 	  &pyAccumulateWeightsOntoGridNoSem);
     m.def("pyGridderWPol",
-	  &pyGridderWPol);
+	  &pyGridderWPol,
+	  "Grids visibilities onto one facet. With nthreads>1, the facet is gridded by that many threads, "
+	  "each owning disjoint strips of the grid");
     m.def("pyDeGridderWPol",
 	  &pyDeGridderWPol,
 	  py::return_value_policy::take_ownership);
@@ -187,7 +187,65 @@ namespace DDF {
 	ptrSumJonesChan=py::array_t<double, py::array::c_style>(LJones[18]).mutable_data(0);
 
 	ReWeightSNR=LJones[19].cast<double>();
+
+	if (LJones.size()>20)
+	  {
+	  auto npJonesTable = py::array_t<dcmplx, py::array::c_style>(LJones[20]);
+	  ptrJonesTable = npJonesTable.data(0);
+	  for (int i=0; i<3; ++i)
+	    JonesTableDims[i] = size_t(npJonesTable.shape(i));
+	  ptrJonesTableWeights = py::array_t<double, py::array::c_style>(LJones[21]).data(0);
+	  ptrJonesTableTimeMapping = py::array_t<int, py::array::c_style>(LJones[22]).data(0);
+	  ptrJonesTableChanMapping = py::array_t<int, py::array::c_style>(LJones[23]).data(0);
+	  }
+	}
+      }
+
+    void JonesServer::setJonesProducts()
+      {
+      BB=(abs(J0[0])*abs(J1[0])+abs(J0[3])*abs(J1[3]))/2.;
+      BB*=BB;
+      J0H=J0.hermitian();
+      J1H=J1.hermitian();
+      }
+
+    bool JonesServer::updateJonesFromTable(size_t irow, size_t visChan, bool baseline_changed, bool EstimateWeight)
+      {
+      int i_t=ptrJonesTableTimeMapping[irow];
+      int i_chan=ptrJonesTableChanMapping[visChan];
+      if (!baseline_changed && CurrentJones_Table_Time==i_t && CurrentJones_Table_Chan==i_chan)
+	return false;
+      CurrentJones_Table_Time=i_t;
+      CurrentJones_Table_Chan=i_chan;
+
+      // the weights only get re-estimated when the killMS solutions change, as in updateJones()
+      bool kMS_changed=false;
+      if (ApplyJones_killMS)
+	{
+	int i_t_kMS=ptrTimeMappingJonesMatrices[irow];
+	int i_chan_kMS=ptrVisToJonesChanMapping_killMS[visChan];
+	kMS_changed = baseline_changed || CurrentJones_kMS_Time!=i_t_kMS || CurrentJones_kMS_Chan!=i_chan_kMS;
+	CurrentJones_kMS_Time=i_t_kMS;
+	CurrentJones_kMS_Chan=i_chan_kMS;
 	}
+
+      size_t off0=(size_t(i_t)*JonesTableDims[1] + size_t(CurrentJones_ant0))*JonesTableDims[2] + size_t(i_chan);
+      size_t off1=(size_t(i_t)*JonesTableDims[1] + size_t(CurrentJones_ant1))*JonesTableDims[2] + size_t(i_chan);
+      const dcmplx *pJ0=ptrJonesTable+4*off0, *pJ1=ptrJonesTable+4*off1;
+      J0=dcMat(pJ0[0], pJ0[1], pJ0[2], pJ0[3]);
+      J1=dcMat(pJ1[0], pJ1[1], pJ1[2], pJ1[3]);
+
+      if (kMS_changed && EstimateWeight)
+	{
+	// per antenna: |g|, |g(t+1)-g|+|g(t-1)-g| and |g| of the last correlation
+	const double *w0=ptrJonesTableWeights+3*off0, *w1=ptrJonesTableWeights+3*off1;
+	double Rij=(w1[0]*w0[1]+w0[0]*w1[1])*ReWeightSNR;
+	WeightVaryJJ  = 1./(1.+Rij*Rij);
+	if ((w0[0]*w1[0]>2.) || (w0[2]*w1[2]>2.)) WeightVaryJJ=0.;
+	}
+
+      setJonesProducts();
+      return true;
       }
 
     bool JonesServer::updateJones(size_t irow, size_t visChan, const double *uvwPtr, bool EstimateWeight, bool DoApplyAlphaRegIn){
@@ -202,6 +260,9 @@ namespace DDF {
       CurrentJones_ant0 = i_ant0;
       CurrentJones_ant1 = i_ant1;
 
+      if (ptrJonesTable)
+	return updateJonesFromTable(irow, visChan, baseline_changed, EstimateWeight);
+
       if (ApplyJones_Beam)
         {
 	int i_t=ptrTimeMappingJonesMatrices_Beam[irow];
@@ -284,10 +345,7 @@ namespace DDF {
 	  J1=J1kMS.times(J1);
 	  }
 
-	BB=(abs(J0[0])*abs(J1[0])+abs(J0[3])*abs(J1[3]))/2.;
-	BB*=BB;
-	J0H=J0.hermitian();
-	J1H=J1.hermitian();
+	setJonesProducts();
         return true;
 	}
       return false;
@@ -298,6 +356,7 @@ namespace DDF {
       CurrentJones_ant0=CurrentJones_ant1=-1;
       CurrentJones_Beam_Time=CurrentJones_Beam_Chan=-1;
       CurrentJones_kMS_Time=CurrentJones_kMS_Chan=-1;
+      CurrentJones_Table_Time=CurrentJones_Table_Chan=-1;
       }
   }
 }
@@ -99,7 +99,19 @@ namespace DDF {
 	int CurrentJones_ant0;
 	int CurrentJones_ant1;
 
+	/* Optional table of the combined Jones matrices of this facet's directions, precomputed once per chunk
+	   (see --DDESolutions-JonesTable). Indexed by [time interval][antenna][channel block], with row to
+	   time interval and visibility channel to channel block mappings. */
+	const dcmplx *ptrJonesTable=nullptr;
+	const double *ptrJonesTableWeights=nullptr;
+	const int *ptrJonesTableTimeMapping=nullptr, *ptrJonesTableChanMapping=nullptr;
+	size_t JonesTableDims[3];
+	int CurrentJones_Table_Time=-1;
+	int CurrentJones_Table_Chan=-1;
+
 	void NormJones(dcMat &J0, const double *uvwPtr) const;
+	bool updateJonesFromTable(size_t irow, size_t visChan, bool baseline_changed, bool EstimateWeight);
+	void setJonesProducts();
 	static dcMat GiveJones(const fcmplx *ptrJonesMatrices, const int *JonesDims,
 	  const float *ptrCoefs, int i_t, int i_ant0, int i_dir, int iChJones,
 	  int Mode);
@@ -28,6 +28,8 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #include <vector>
 #include <string>
 #include <algorithm>
+#include <thread>
+#include <atomic>
 #include "JonesServer.h"
 #include "Stokes.h"
 #include "DecorrelationHelper.h"
@@ -65,6 +67,43 @@ namespace DDF {
 	  Vis[3] += VisMeas[3]*Weight;
 	}
     }
+
+    /* A BDA block reduced to what the convolution onto the grid needs */
+    struct GridItem
+      {
+      const fcmplx *cf;  /* first kernel sample for this block's oversampling offset */
+      int gridChan, locx, locy, supx, supy;
+      dcMat vis;         /* Stokes visibilities */
+      };
+
+    /* Destinations of the weight sums accumulated over blocks */
+    struct GridSums
+      {
+      double *sumwt, *sumjones, *sumjoneschan;
+      };
+
+    /* Convolves one block onto grid rows [y0,y1). Rows of the support outside this range are skipped, so that a
+       block straddling two tiles is gridded by the owners of both, each one doing its own rows. */
+    inline void gridItem(const GridItem &item, fcmplx *griddata, int nGridX, int nGridY, int nGridPol,
+			size_t nVisPol, int y0, int y1)
+      {
+      const int sy0 = max(-item.supy, y0-item.locy);
+      const int sy1 = min(item.supy, y1-1-item.locy);
+      if (sy0>sy1) return;
+      const int ncfx = 2*item.supx+1;
+      for (size_t ipol=0; ipol<nVisPol; ++ipol)
+	{
+	if (ipol>=size_t(nGridPol)) continue;
+	const size_t goff = size_t((item.gridChan*nGridPol + int(ipol)) * nGridX*nGridY);
+	const dcmplx VisVal = item.vis[ipol];
+	const fcmplx* __restrict__ cf0 = item.cf + (sy0+item.supy)*ncfx;
+	fcmplx* __restrict__ gridPtr = griddata + goff + (item.locy+sy0)*nGridX + item.locx;
+	for (int sy=sy0; sy<=sy1; ++sy, gridPtr+=nGridX)
+	  for (int sx=-item.supx; sx<=item.supx; ++sx)
+	    gridPtr[sx] += VisVal * dcmplx(*cf0++);
+	}
+      }
+
     template<policies::ReadCorrType readcorr, policies::MulaccumType mulaccum, policies::StokesGridType stokesgrid>
     void gridder(py::array_t<std::complex<float>, py::array::c_style>& grid,
 		const py::array_t<std::complex<float>, py::array::c_style>& vis,
@@ -85,7 +124,8 @@ namespace DDF {
 		const py::list& LOptimisation,
 		const py::list& LSmearing,
 		const py::array_t<int, py::array::c_style>& np_ChanMapping,
-		const vector<string> &expstokes)
+		const vector<string> &expstokes,
+		int nthreads)
       {
       auto nVisPol = expstokes.size();
       DDEs::DecorrelationHelper decorr(LSmearing, uvw);
@@ -134,7 +174,7 @@ namespace DDF {
       /* total size is in two words */
       const size_t NTotBlocks = size_t(MappingBlock[0]) + (size_t(MappingBlock[1])<<32);
       const int *NRowBlocks = MappingBlock+2;
-      const int *StartRow = MappingBlock+2+NTotBlocks;
+      const int *StartRow0 = MappingBlock+2+NTotBlocks;
 
       /* in sparsification mode, the Sparsification argument is an array of length NTotBlocks flags. */
       /* Only blocks with a True flag will be gridded. */
@@ -147,6 +187,15 @@ namespace DDF {
 	sparsificationFlag = Sparsification.data(0);
 	}
 
+      /* the W-plane kernels, converted once rather than per block */
+      const int nWPlanes = int(NwPlanes);
+      vector<py::array_t<complex<float>, py::array::c_style>> cfsPlanes, cfsConjPlanes;
+      for (int iw=0; iw<nWPlanes; ++iw)
+	{
+	cfsPlanes.push_back(py::array_t<complex<float>, py::array::c_style>(Lcfs[size_t(iw)]));
+	cfsConjPlanes.push_back(py::array_t<complex<float>, py::array::c_style>(LcfsConj[size_t(iw)]));
+	}
+
       CorrectionCalculator Corrcalc(LOptimisation);
 
       /* ######################################################## */
@@ -164,204 +213,313 @@ namespace DDF {
 //      if( !facet )
 //        cerr<<"BDAJones grid mode "<<JS.DoApplyJones<<endl<<endl;
 
-      vector<double> ThisSumJonesChan(nVisChan),      // accumulates sum of w*decorr*decorr*||M||
-                     ThisSumSqWeightsChan(nVisChan);  // accumulates sum of w*decorr*decorr
-
       const int *p_ChanMapping=np_ChanMapping.data(0);
-      for (size_t iBlock=0; iBlock<NTotBlocks; iBlock++)
-	{
-        JS.resetJonesServerCounter();
-	const int NRowThisBlock=NRowBlocks[iBlock]-2;
-	const size_t chStart = size_t(StartRow[0]),
-		    chEnd   = size_t(StartRow[1]);
-	const int *Row = StartRow+2;
-	/* advance pointer to next blocklist */
-	StartRow += NRowBlocks[iBlock];
 
+      /* Goes through blocks [iBlock0,iBlock1), accumulating their weights into sums, and passes each block that
+	 lands on the grid to emit() as a GridItem */
+      auto processBlocks = [&](size_t iBlock0, size_t iBlock1, const int *StartRow, DDEs::JonesServer &JS,
+			       CorrectionCalculator &Corrcalc, GridSums &sums, auto &&emit)
+	{
+	vector<double> ThisSumJonesChan(nVisChan),      // accumulates sum of w*decorr*decorr*||M||
+		       ThisSumSqWeightsChan(nVisChan);  // accumulates sum of w*decorr*decorr
 
-	if (sparsificationFlag && !sparsificationFlag[iBlock])
-	  continue;
+	for (size_t iBlock=iBlock0; iBlock<iBlock1; iBlock++)
+	  {
+	  JS.resetJonesServerCounter();
+	  const int NRowThisBlock=NRowBlocks[iBlock]-2;
+	  const size_t chStart = size_t(StartRow[0]),
+		      chEnd   = size_t(StartRow[1]);
+	  const int *Row = StartRow+2;
+	  /* advance pointer to next blocklist */
+	  StartRow += NRowBlocks[iBlock];
 
-	dcMat Vis(0,0,0,0); // this is what will get gridded in the end
 
-	for (size_t visChan=0; visChan<nVisChan; ++visChan)
-	  ThisSumJonesChan[visChan] = ThisSumSqWeightsChan[visChan] = 0;
+	  if (sparsificationFlag && !sparsificationFlag[iBlock])
+	    continue;
 
-	double DeCorrFactor = decorr.get(FreqMean0, Row[NRowThisBlock/2]);
+	  dcMat Vis(0,0,0,0); // this is what will get gridded in the end
 
-	double visChanMean=0., FreqMean=0;
-	double ThisWeight=0., ThisSumJones=0., ThisSumSqWeights=0.;
-	int NVisThisblock=0;
-	double Umean=0, Vmean=0, Wmean=0;
+	  for (size_t visChan=0; visChan<nVisChan; ++visChan)
+	    ThisSumJonesChan[visChan] = ThisSumSqWeightsChan[visChan] = 0;
 
-	dcMat VisMeas(DeCorrFactor,0,0,DeCorrFactor);
-	bool have_psf = false;
+	  double DeCorrFactor = decorr.get(FreqMean0, Row[NRowThisBlock/2]);
 
-	for (auto inx=0; inx<NRowThisBlock; inx++)
-	  {
-	  const size_t irow = size_t(Row[inx]);
-	  if (irow>nrows) continue;
-	  const double* __restrict__ uvwPtr = uvwdata + irow*3;
-	  const double U=uvwPtr[0];
-	  const double V=uvwPtr[1];
-	  const double W=uvwPtr[2];
-	  const double angle = -2.*PI*(U*l0+V*m0+W*n0)/C;
-	  JS.WeightVaryJJ=1.;
-          Corrcalc.update();
-
-	  for (size_t visChan=chStart; visChan<chEnd; ++visChan)
-	    {
-	    size_t doff = size_t((irow*nVisChan + visChan) * nVisCorr);
-	    const float *imgWtPtr = weightsdata + irow*nVisChan + visChan;
+	  double visChanMean=0., FreqMean=0;
+	  double ThisWeight=0., ThisSumJones=0., ThisSumSqWeights=0.;
+	  int NVisThisblock=0;
+	  double Umean=0, Vmean=0, Wmean=0;
 
-	    /* We can do that since all flags in 4-pols are equalised in ClassVisServer */
-	    if (flagsdata[doff]) continue;
+	  dcMat VisMeas(DeCorrFactor,0,0,DeCorrFactor);
+	  bool have_psf = false;
 
-	    dcmplx corr = dopsf ? 1 : Corrcalc.getCorr(Pfreqs, visChan, angle);
-
-	    if (JS.DoApplyJones==1)
+	  for (auto inx=0; inx<NRowThisBlock; inx++)
+	    {
+	    const size_t irow = size_t(Row[inx]);
+	    if (irow>nrows) continue;
+	    const double* __restrict__ uvwPtr = uvwdata + irow*3;
+	    const double U=uvwPtr[0];
+	    const double V=uvwPtr[1];
+	    const double W=uvwPtr[2];
+	    const double angle = -2.*PI*(U*l0+V*m0+W*n0)/C;
+	    JS.WeightVaryJJ=1.;
+	    Corrcalc.update();
+
+	    for (size_t visChan=chStart; visChan<chEnd; ++visChan)
 	      {
-	      // update Jones term in all cases. If updated, or no psf yet precomputed, do it now
-	      if( (JS.updateJones(irow, visChan, uvwPtr, true, true) || !have_psf) && dopsf )
-	        {
-	        VisMeas = (JS.J0).times(JS.J1H); // precompute for the PSF case
-    	        VisMeas = (JS.J0H.times(VisMeas)).times(JS.J1);
-    	        VisMeas.scale(DeCorrFactor);
-    	        have_psf = true;
-                }
-	      }
+	      size_t doff = size_t((irow*nVisChan + visChan) * nVisCorr);
+	      const float *imgWtPtr = weightsdata + irow*nVisChan + visChan;
+
+	      /* We can do that since all flags in 4-pols are equalised in ClassVisServer */
+	      if (flagsdata[doff]) continue;
+
+	      dcmplx corr = dopsf ? 1 : Corrcalc.getCorr(Pfreqs, visChan, angle);
+
+	      if (JS.DoApplyJones==1)
+		{
+		// update Jones term in all cases. If updated, or no psf yet precomputed, do it now
+		if( (JS.updateJones(irow, visChan, uvwPtr, true, true) || !have_psf) && dopsf )
+		  {
+		  VisMeas = (JS.J0).times(JS.J1H); // precompute for the PSF case
+		  VisMeas = (JS.J0H.times(VisMeas)).times(JS.J1);
+		  VisMeas.scale(DeCorrFactor);
+		  have_psf = true;
+		  }
+		}
+
+	      // in PSF mode, VisMeas is precomputed (in the if clause above, or before the row loop) and doesn't change
+	      if (!dopsf)
+		readcorr(visdata+doff, VisMeas);
+
+	      const double FWeight = imgWtPtr[0]*JS.WeightVaryJJ;
+	      const dcmplx Weight   = FWeight*corr;
+	      const double FWeightDecorr = FWeight*DeCorrFactor*DeCorrFactor;
+	      ThisSumSqWeights += FWeightDecorr;
+	      ThisSumSqWeightsChan[visChan] += FWeightDecorr;
+
+	      if (JS.DoApplyJones==1)
+		{
+		if( !dopsf )
+		  VisMeas = (JS.J0H.times(VisMeas)).times(JS.J1);
+		mulaccum(VisMeas, Weight, Vis);
+		/*Compute per channel and overall approximate matrix sqroot:*/
+		ThisSumJones += JS.BB*FWeightDecorr;
+		ThisSumJonesChan[visChan] += JS.BB*FWeightDecorr;
+		}
+	      else /* Don't apply Jones */
+		mulaccum(VisMeas, Weight, Vis);
+
+	      /*###################### Averaging #######################*/
+	      Umean += U + W*Cu;
+	      Vmean += V + W*Cv;
+	      Wmean += W;
+	      FreqMean+=Pfreqs[visChan];
+	      ThisWeight+=FWeight;
+
+	      visChanMean+=p_ChanMapping[visChan];
+	      ++NVisThisblock;
+	      }/*endfor vischan*/
+	    }/*endfor RowThisBlock*/
+
+	  if (NVisThisblock==0) continue;
+
+	  visChanMean/=NVisThisblock;
+	  Umean/=NVisThisblock;
+	  Vmean/=NVisThisblock;
+	  Wmean/=NVisThisblock;
+	  FreqMean/=NVisThisblock;
+
+	  if (JS.DoApplyJones==2)
+	    {
+	    double uvw_mean[] = { Umean, Vmean, Wmean };
+	    JS.updateJones(Row[NRowThisBlock/2], (chStart+chEnd)/2, uvw_mean, 1, 1);
+	    if (dopsf)
+	      Vis = ((JS.J0).times(Vis)).times(JS.J1H);
+	    Vis = (JS.J0H.times(Vis)).times(JS.J1);
+	    ThisSumJones = ThisSumSqWeights*JS.BB;
+	    for (size_t visChan=chStart; visChan<chEnd; ++visChan)
+	      ThisSumJonesChan[visChan] = ThisSumSqWeightsChan[visChan]*JS.BB;
+	    }
 
-            // in PSF mode, VisMeas is precomputed (in the if clause above, or before the row loop) and doesn't change
-	    if (!dopsf)
-	      readcorr(visdata+doff, VisMeas);
+	  const int gridChan = p_ChanMapping[chStart];
+	  const double diffChan=visChanMean-gridChan;
+	  if(abs(diffChan)>1e-6)
+	    {
+	    printf("gridder: probably there is a problem in the BDA mapping: (ChanMean, gridChan, diff)=(%lf, %i, %lf)\n",visChanMean,gridChan,diffChan);
+	    for (size_t visChan=chStart; visChan<chEnd; ++visChan)
+	      printf("%d ", gridChan-p_ChanMapping[visChan]);
+	    printf("\n");
+	    }
 
-	    const double FWeight = imgWtPtr[0]*JS.WeightVaryJJ;
-	    const dcmplx Weight   = FWeight*corr;
-	    const double FWeightDecorr = FWeight*DeCorrFactor*DeCorrFactor;
-	    ThisSumSqWeights += FWeightDecorr;
-	    ThisSumSqWeightsChan[visChan] += FWeightDecorr;
+	  /* ################################################ */
+	  /* ######## Convert correlations to stokes ######## */
+	  GridItem item;
+	  item.vis = stokesgrid(Vis);
 
-	    if (JS.DoApplyJones==1)
-	      {
-	      if( !dopsf )
-	        VisMeas = (JS.J0H.times(VisMeas)).times(JS.J1);
-	      mulaccum(VisMeas, Weight, Vis);
-	      /*Compute per channel and overall approximate matrix sqroot:*/
-	      ThisSumJones += JS.BB*FWeightDecorr;
-	      ThisSumJonesChan[visChan] += JS.BB*FWeightDecorr;
-//  	      if(facet==0 && visChan==0)
-//                std::fprintf(stderr,"F%dB%dR%d weight %f jones %f %f BB %f wsq %f sj %f\n",facet,iBlock,irow,FWeight,JS.J0.v[0].real(),JS.J0.v[0].imag(),
-//				JS.BB,FWeightSq,ThisSumJonesChan[0]);
-	      }
-	    else /* Don't apply Jones */
-	      mulaccum(VisMeas, Weight, Vis);
-
-	    /*###################### Averaging #######################*/
-	    Umean += U + W*Cu;
-	    Vmean += V + W*Cv;
-	    Wmean += W;
-	    FreqMean+=Pfreqs[visChan];
-	    ThisWeight+=FWeight;
-
-	    visChanMean+=p_ChanMapping[visChan];
-	    ++NVisThisblock;
-	    }/*endfor vischan*/
-	  }/*endfor RowThisBlock*/
-
-	if (NVisThisblock==0) continue;
-
-	visChanMean/=NVisThisblock;
-	Umean/=NVisThisblock;
-	Vmean/=NVisThisblock;
-	Wmean/=NVisThisblock;
-	FreqMean/=NVisThisblock;
-
-        if (JS.DoApplyJones==2)
-            {
-            double uvw_mean[] = { Umean, Vmean, Wmean };
-            JS.updateJones(Row[NRowThisBlock/2], (chStart+chEnd)/2, uvw_mean, 1, 1);
-            if (dopsf)
-              Vis = ((JS.J0).times(Vis)).times(JS.J1H);
-            Vis = (JS.J0H.times(Vis)).times(JS.J1);
-            ThisSumJones = ThisSumSqWeights*JS.BB;
-            for (size_t visChan=chStart; visChan<chEnd; ++visChan)
-                ThisSumJonesChan[visChan] = ThisSumSqWeightsChan[visChan]*JS.BB;
-            }
-
-	const int gridChan = p_ChanMapping[chStart];
-	const double diffChan=visChanMean-gridChan;
-	if(abs(diffChan)>1e-6)
-	  {
-	  printf("gridder: probably there is a problem in the BDA mapping: (ChanMean, gridChan, diff)=(%lf, %i, %lf)\n",visChanMean,gridChan,diffChan);
-	  for (size_t visChan=chStart; visChan<chEnd; ++visChan)
-	    printf("%d ", gridChan-p_ChanMapping[visChan]);
-	  printf("\n");
-	  }
+	  /* ################################################ */
+	  /* ############## Start Gridding visibility ####### */
+	  if (gridChan<0 || gridChan>=nGridChan) continue;
 
-	/* ################################################ */
-	/* ######## Convert correlations to stokes ######## */
-	const dcMat stokes_vis(stokesgrid(Vis));
+	  const double recipWvl = FreqMean / C;
 
-	/* ################################################ */
-	/* ############## Start Gridding visibility ####### */
-	if (gridChan<0 || gridChan>=nGridChan) continue;
+	  /* ############## W-projection #################### */
+	  const int iwplane = int(lrint((NwPlanes-1)*abs(Wmean)*(WaveRefWave*recipWvl)/wmax));
+	  if (iwplane>=NwPlanes) continue;
 
-	const double recipWvl = FreqMean / C;
+	  const auto &cfs = (Wmean>0) ? cfsPlanes[size_t(iwplane)] : cfsConjPlanes[size_t(iwplane)];
+	  const int nConvX = int(cfs.shape(0));
+	  const int nConvY = int(cfs.shape(1));
+	  const int supx = (nConvX/OverS-1)/2;
+	  const int supy = (nConvY/OverS-1)/2;
+	  const int SupportCF=nConvX/OverS;
+	  const fcmplx * cfsdata = cfs.data(0);
 
-	/* ############## W-projection #################### */
-	const int iwplane = int(lrint((NwPlanes-1)*abs(Wmean)*(WaveRefWave*recipWvl)/wmax));
-	if (iwplane>=NwPlanes) continue;
+	  const double posx = uvwScale_p[0]*Umean*recipWvl + offset_p[0];
+	  const double posy = uvwScale_p[1]*Vmean*recipWvl + offset_p[1];
 
-	auto cfs=py::array_t<complex<float>, py::array::c_style>(
-	  (Wmean>0) ? Lcfs[iwplane] : LcfsConj[iwplane]);
-	const int nConvX = int(cfs.shape(0));
-	const int nConvY = int(cfs.shape(1));
-	const int supx = (nConvX/OverS-1)/2;
-	const int supy = (nConvY/OverS-1)/2;
-	const int SupportCF=nConvX/OverS;
-	const fcmplx * cfsdata = cfs.data(0);
+	  const int locx = int(lrint(posx));    /* location in grid */
+	  const int locy = int(lrint(posy));
 
-	const double posx = uvwScale_p[0]*Umean*recipWvl + offset_p[0];
-	const double posy = uvwScale_p[1]*Vmean*recipWvl + offset_p[1];
+	  /* Only use visibility point if the full support is within grid. */
+	  if (locx-supx<0 || locx+supx>=nGridX || locy-supy<0 || locy+supy>=nGridY)
+	    continue;
 
-	const int locx = int(lrint(posx));    /* location in grid */
-	const int locy = int(lrint(posy));
+	  const int offx = int(lrint((locx-posx)*OverS) + (nConvX-1)/2); /* location in */
+	  const int offy = int(lrint((locy-posy)*OverS) + (nConvY-1)/2); /* oversampling */
 
-	/* Only use visibility point if the full support is within grid. */
-	if (locx-supx<0 || locx+supx>=nGridX || locy-supy<0 || locy+supy>=nGridY)
-	  continue;
+	  const int io = offy - supy*OverS;
+	  const int jo = offx - supx*OverS;
+	  const int cfoff = (io*OverS + jo)*SupportCF*SupportCF;
 
-	const int offx = int(lrint((locx-posx)*OverS) + (nConvX-1)/2); /* location in */
-	const int offy = int(lrint((locy-posy)*OverS) + (nConvY-1)/2); /* oversampling */
+	  item.cf = cfsdata + cfoff;
+	  item.gridChan = gridChan;
+	  item.locx = locx;
+	  item.locy = locy;
+	  item.supx = supx;
+	  item.supy = supy;
+	  emit(item);
 
-	const int io = offy - supy*OverS;
-	const int jo = offx - supx*OverS;
-	const int cfoff = (io*OverS + jo)*SupportCF*SupportCF;
-
-	for (size_t ipol=0; ipol<nVisPol; ++ipol)
-	  {
-	  if (ipol>=size_t(nGridPol)) continue;
-	  const size_t goff = size_t((gridChan*nGridPol + ipol) * nGridX*nGridY);
-	  const dcmplx VisVal =stokes_vis[ipol];
-	  const fcmplx* __restrict__ cf0 = cfsdata + cfoff;
-	  fcmplx* __restrict__ gridPtr = griddata + goff + (locy-supy)*nGridX + locx;
-	  for (int sy=-supy; sy<=supy; ++sy, gridPtr+=nGridX)
-	    for (int sx=-supx; sx<=supx; ++sx)
-	      gridPtr[sx] += VisVal * dcmplx(*cf0++);
-	  sumWtPtr[ipol+gridChan*nGridPol] += ThisWeight;
-	  if (JS.DoApplyJones)
+	  for (size_t ipol=0; ipol<nVisPol; ++ipol)
 	    {
-	    JS.ptrSumJones[gridChan]+=ThisSumJones;
-	    JS.ptrSumJones[gridChan+nGridChan]+=ThisSumSqWeights;
-
-	    for(size_t visChan=chStart; visChan<chEnd; visChan++)
+	    if (ipol>=size_t(nGridPol)) continue;
+	    sums.sumwt[ipol+gridChan*nGridPol] += ThisWeight;
+	    if (JS.DoApplyJones)
 	      {
-	      JS.ptrSumJonesChan[visChan]+=ThisSumJonesChan[visChan];
-	      JS.ptrSumJonesChan[nVisChan+visChan]+=ThisSumSqWeightsChan[visChan];
+	      sums.sumjones[gridChan]+=ThisSumJones;
+	      sums.sumjones[gridChan+nGridChan]+=ThisSumSqWeights;
+
+	      for(size_t visChan=chStart; visChan<chEnd; visChan++)
+		{
+		sums.sumjoneschan[visChan]+=ThisSumJonesChan[visChan];
+		sums.sumjoneschan[nVisChan+visChan]+=ThisSumSqWeightsChan[visChan];
+		}
 	      }
+	    } /* end for ipol */
+	  } /*end for Block*/
+	};
+
+      if (nthreads<=1 || NTotBlocks<2)
+	{
+	/* single-threaded: grid each block as soon as it is reduced */
+	GridSums sums = { sumWtPtr, JS.DoApplyJones ? JS.ptrSumJones : nullptr,
+			  JS.DoApplyJones ? JS.ptrSumJonesChan : nullptr };
+	processBlocks(0, NTotBlocks, StartRow0, JS, Corrcalc, sums,
+		      [&](const GridItem &item) { gridItem(item, griddata, nGridX, nGridY, nGridPol, nVisPol, 0, nGridY); });
+	return;
+	}
+
+      /* Multithreaded mode. First the blocks are reduced to GridItems, in parallel over contiguous runs of blocks,
+	 each thread with its own JonesServer and weight sums. Then the grid is cut into strips of rows, and each
+	 strip is gridded by one thread, from the items whose support overlaps it. Items straddling two strips are
+	 gridded by both owners, each doing its own rows, so that no two threads ever write the same grid row. Items
+	 are kept in block order throughout, hence the grid comes out identical to the single-threaded one. */
+      const size_t nRuns = min(NTotBlocks, size_t(nthreads)*8);
+      vector<size_t> RunStart(nRuns+1);
+      vector<const int *> RunStartRow(nRuns);
+	{
+	/* cut runs so as to have similar numbers of rows in each */
+	size_t totrows = 0;
+	for (size_t iBlock=0; iBlock<NTotBlocks; iBlock++)
+	  totrows += size_t(NRowBlocks[iBlock]);
+	const int *StartRow = StartRow0;
+	size_t iBlock=0, rows=0;
+	for (size_t irun=0; irun<nRuns; irun++)
+	  {
+	  RunStart[irun] = iBlock;
+	  RunStartRow[irun] = StartRow;
+	  const size_t endrows = (totrows*(irun+1))/nRuns;
+	  while (iBlock<NTotBlocks && (rows<endrows || iBlock==RunStart[irun]))
+	    {
+	    rows += size_t(NRowBlocks[iBlock]);
+	    StartRow += NRowBlocks[iBlock];
+	    iBlock++;
 	    }
-	  } /* end for ipol */
-	} /*end for Block*/
+	  }
+	RunStart[nRuns] = NTotBlocks;
+	}
+
+      const size_t nSumWt = size_t(nGridChan*nGridPol);
+      vector<vector<GridItem>> RunItems(nRuns);
+      vector<vector<double>> ThreadSumWt(size_t(nthreads), vector<double>(nSumWt, 0.)),
+			    ThreadSumJones(size_t(nthreads), vector<double>(2*size_t(nGridChan), 0.)),
+			    ThreadSumJonesChan(size_t(nthreads), vector<double>(2*nVisChan, 0.));
+      std::atomic<size_t> nextRun(0);
+      auto reduceWorker = [&](size_t ithread)
+	{
+	DDEs::JonesServer ThisJS(JS);
+	CorrectionCalculator ThisCorrcalc(Corrcalc);
+	GridSums sums = { ThreadSumWt[ithread].data(), ThreadSumJones[ithread].data(), ThreadSumJonesChan[ithread].data() };
+	for (size_t irun=nextRun++; irun<nRuns; irun=nextRun++)
+	  {
+	  auto &items = RunItems[irun];
+	  processBlocks(RunStart[irun], RunStart[irun+1], RunStartRow[irun], ThisJS, ThisCorrcalc, sums,
+			[&](const GridItem &item) { items.push_back(item); });
+	  }
+	};
+      vector<std::thread> threads;
+      for (size_t ithread=1; ithread<size_t(nthreads); ithread++)
+	threads.emplace_back(reduceWorker, ithread);
+      reduceWorker(0);
+      for (auto &thread: threads)
+	thread.join();
+      threads.clear();
+
+      for (size_t ithread=0; ithread<size_t(nthreads); ithread++)
+	{
+	for (size_t i=0; i<nSumWt; i++)
+	  sumWtPtr[i] += ThreadSumWt[ithread][i];
+	if (JS.DoApplyJones)
+	  {
+	  for (size_t i=0; i<2*size_t(nGridChan); i++)
+	    JS.ptrSumJones[i] += ThreadSumJones[ithread][i];
+	  for (size_t i=0; i<2*nVisChan; i++)
+	    JS.ptrSumJonesChan[i] += ThreadSumJonesChan[ithread][i];
+	  }
+	}
+
+      /* bin items into strips, by the rows their support covers */
+      const int nStrips = min(nGridY, nthreads*4);
+      const int stripHeight = (nGridY+nStrips-1)/nStrips;
+      vector<vector<const GridItem *>> StripItems((size_t(nStrips)));
+      for (const auto &items: RunItems)
+	for (const auto &item: items)
+	  for (int istrip=(item.locy-item.supy)/stripHeight; istrip<=(item.locy+item.supy)/stripHeight; istrip++)
+	    StripItems[size_t(istrip)].push_back(&item);
+
+      std::atomic<int> nextStrip(0);
+      auto gridWorker = [&]()
+	{
+	for (int istrip=nextStrip++; istrip<nStrips; istrip=nextStrip++)
+	  {
+	  const int y0 = istrip*stripHeight, y1 = min(nGridY, y0+stripHeight);
+	  for (const GridItem *item: StripItems[size_t(istrip)])
+	    gridItem(*item, griddata, nGridX, nGridY, nGridPol, nVisPol, y0, y1);
+	  }
+	};
+      for (int ithread=1; ithread<nthreads; ithread++)
+	threads.emplace_back(gridWorker);
+      gridWorker();
+      for (auto &thread: threads)
+	thread.join();
       } /* end */
     }
 }
@@ -31,6 +31,11 @@ from astropy.io import fits
 from astropy.wcs import WCS
 from DDFacet.report_version import report_version
 
+# FITS files are made of blocks of this size
+FITS_BLOCK_SIZE = 2880
+# data types (without byte order) that ClassCasaimage can stream plane by plane, see setdata()
+STREAMABLE_TYPES = ("f4", "f8", "i2", "i4", "i8")
+
 def FileToArray(FileName,CorrT):
     """ Read a FITS FileName file to an array """
     hdu=fits.open(FileName)
@@ -130,8 +135,19 @@ class ClassCasaimage():
         if self.fmean is not None:
             self.header['RESTFRQ'] = self.fmean
 
-    def setdata(self, dataIn, CorrT=False):
+    def setdata(self, dataIn, CorrT=False, Stream=False):
+        """
+        Sets the image data. If Stream is True, dataIn is only referenced (it may be e.g. a shared
+        array): ToFits() will then write it out one plane at a time, flipping and transposing planes
+        as it goes, rather than making a flipped copy of the whole cube here.
+        """
         #print>>log, "  ----> put data in casa image %s"%self.ImageName
+        self.imageFlipped = CorrT
+        if Stream and np.dtype(dataIn.dtype).str[1:] in STREAMABLE_TYPES:
+            self.data = None
+            self._stream_data = dataIn
+            return
+        self._stream_data = None
 
         data=dataIn.copy()
         if CorrT:
@@ -141,17 +157,54 @@ class ClassCasaimage():
                     #Need to place stokes data in increasing order because of the linear spacing assumption used in FITS
                     stokes_slice_id = self.Stokes.index(self.sorted_stokes[pol])
                     data[ch,pol]=dataIn[ch][stokes_slice_id][::-1].T
-        self.imageFlipped = CorrT
         self.data = data
 
     def ToFits(self):
         FileOut=self.ImageName+".fits"
-        hdu = fits.PrimaryHDU(header=self.header,data=self.data)
         if os.path.exists(FileOut):
             os.unlink(FileOut)
+        if getattr(self, "_stream_data", None) is not None:
+            return self._streamToFits(FileOut)
+        hdu = fits.PrimaryHDU(header=self.header,data=self.data)
         print>>log, "  ----> Save image data as FITS file %s"%FileOut
         hdu.writeto(FileOut)
 
+    def _streamToFits(self, FileOut):
+        """
+        Writes the referenced data array (see setdata) to FileOut plane by plane. The header is made
+        for a dummy array of the right type and rank, then given the real axis sizes, and the file is
+        allocated to its full size before the planes are written in place. Memory use is then one
+        image plane, whatever the size of the cube.
+        """
+        dataIn=self._stream_data
+        nch,npol,nx,ny=dataIn.shape
+        hdu = fits.PrimaryHDU(header=self.header,data=np.zeros((1,1,1,1),dataIn.dtype))
+        header = hdu.header
+        # FITS axes are in reverse order with respect to numpy's
+        if self.imageFlipped:
+            nx,ny=ny,nx
+        for iaxis,size in enumerate((ny,nx,npol,nch)):
+            header["NAXIS%d"%(iaxis+1)] = size
+        print>>log, "  ----> Stream image data to FITS file %s"%FileOut
+        header.tofile(FileOut)
+        dtype=np.dtype(dataIn.dtype).newbyteorder(">")
+        with open(FileOut, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            offset=f.tell()
+            nbytes=dataIn.size*dtype.itemsize
+            # data section is padded with zeros to a multiple of the FITS block size
+            f.truncate(offset+((nbytes+FITS_BLOCK_SIZE-1)//FITS_BLOCK_SIZE)*FITS_BLOCK_SIZE)
+            f.seek(offset)
+            for ch in range(nch):
+                for pol in range(npol):
+                    if self.imageFlipped:
+                        #Need to place stokes data in increasing order because of the linear spacing assumption used in FITS
+                        stokes_slice_id = self.Stokes.index(self.sorted_stokes[pol])
+                        plane=dataIn[ch,stokes_slice_id][::-1].T
+                    else:
+                        plane=dataIn[ch,pol]
+                    f.write(np.ascontiguousarray(plane,dtype=dtype).data)
+
     def setBeam(self,beam,beamcube=None):
         """
         Add Fitted beam info to FITS header, expects triple for beam:
@@ -179,6 +232,7 @@ class ClassCasaimage():
     def close(self):
         #print>>log, "  ----> Closing %s"%self.ImageName
         del(self.data)
+        self._stream_data = None
         del(self.header)
         #print>>log, "  ----> Closed %s"%self.ImageName
 
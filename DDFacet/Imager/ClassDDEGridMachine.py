@@ -289,6 +289,128 @@ def testGrid():
     pylab.show()
 
 
+def GiveJonesDirections(GD, lmShift, DicoJonesMatrices):
+    """
+    Returns the killMS direction, killMS interpolation weights and beam direction that apply to a facet
+    centred at lmShift
+    """
+    l0, m0 = lmShift
+    idir_kMS = 0
+    w_kMS = np.array([], np.float32)
+    d0 = GD["DDESolutions"]["Scale"]*np.pi/180
+    gamma = GD["DDESolutions"]["gamma"]
+    if "DicoJones_killMS" in DicoJonesMatrices:
+        DicoClusterDirs = DicoJonesMatrices["DicoJones_killMS"]["Dirs"]
+        lc = DicoClusterDirs["l"]
+        mc = DicoClusterDirs["m"]
+        sI = DicoClusterDirs["I"]
+        d = np.sqrt((l0-lc)**2+(m0-mc)**2)
+        idir_kMS = np.argmin(d)
+
+        w = sI/(1.+d/d0)**gamma
+        w /= np.sum(w)
+        w[w < (0.2*w.max())] = 0
+        ind = np.argsort(w)[::-1]
+        w[ind[3::]] = 0
+        w /= np.sum(w)
+        w_kMS = w
+
+    idir_Beam = 0
+    if "DicoJones_Beam" in DicoJonesMatrices:
+        DicoClusterDirs = DicoJonesMatrices["DicoJones_Beam"]["Dirs"]
+        lc = DicoClusterDirs["l"]
+        mc = DicoClusterDirs["m"]
+        d = np.sqrt((l0-lc)**2+(m0-mc)**2)
+        idir_Beam = np.argmin(d)
+
+    return idir_kMS, w_kMS, idir_Beam
+
+
+def BuildJonesTables(GD, DicoJonesMatrices, ListLMShift, degridder=False):
+    """
+    Precomputes the combined (killMS x beam) Jones matrices of a chunk for a set of facets (see
+    --DDESolutions-JonesTable), so that the gridders or degridders look them up rather than every facet
+    recomputing them for every visibility. The matrices only depend on the facet's (killMS, beam) directions,
+    so facets sharing both directions share a table.
+
+    Returns None if the tables cannot be used with the current settings (Krigging interpolation, or amplitude
+    scaling, which depends on uvw), else a dict of arrays:
+        TimeMapping:  row -> time interval, i.e. a distinct pair of (killMS, beam) solution intervals
+        ChanMapping:  visibility channel -> channel block, i.e. a distinct pair of (killMS, beam) Jones channels
+        Jones:k:b:    combined Jones of killMS direction k and beam direction b, [interval, antenna, block, 4]
+        Weights:k:b:  killMS amplitude, its variation between adjacent intervals, and amplitude of the last
+                      correlation (for --DDESolutions-ReWeightSNR), [interval, antenna, block, 3]
+    """
+    Mode = GD["DDESolutions"]["DDModeDeGrid" if degridder else "DDModeGrid"]
+    ScaleAmp = GD["DDESolutions"]["ScaleAmpDeGrid" if degridder else "ScaleAmpGrid"]
+    if GD["DDESolutions"]["Type"] != "Nearest" or ScaleAmp:
+        return None
+    ApplyAmp, ApplyPhase = "A" in Mode, "P" in Mode
+
+    # per source of solutions: Jones, row -> interval and channel -> Jones channel mappings
+    Sources = []
+    for key in "DicoJones_killMS", "DicoJones_Beam":
+        if key in DicoJonesMatrices:
+            DicoJones = DicoJonesMatrices[key]
+            Sources.append((DicoJones["Jones"]["Jones"], np.int64(DicoJones["TimeMapping"]),
+                            np.int64(DicoJones["Jones"]["VisToJonesChanMapping"])))
+        else:
+            Sources.append(None)
+    nrows = max([ len(s[1]) for s in Sources if s is not None ])
+    nchan = max([ len(s[2]) for s in Sources if s is not None ])
+    na = set([ s[0].shape[2] for s in Sources if s is not None ])
+    if len(na) != 1:
+        return None
+    na = na.pop()
+
+    def distinct_pairs(index_kMS, index_Beam):
+        """Maps each element of index_kMS,index_Beam to a distinct pair, returns the pairs and the mapping"""
+        n_Beam = index_Beam.max()+1
+        pairs, mapping = np.unique(index_kMS*n_Beam + index_Beam, return_inverse=True)
+        return pairs//n_Beam, pairs % n_Beam, np.int32(mapping)
+    zero_rows, zero_chans = np.zeros(nrows, np.int64), np.zeros(nchan, np.int64)
+    it_kMS, it_Beam, TimeMapping = distinct_pairs(Sources[0][1] if Sources[0] else zero_rows,
+                                                  Sources[1][1] if Sources[1] else zero_rows)
+    ich_kMS, ich_Beam, ChanMapping = distinct_pairs(Sources[0][2] if Sources[0] else zero_chans,
+                                                    Sources[1][2] if Sources[1] else zero_chans)
+    Tables = dict(TimeMapping=TimeMapping, ChanMapping=ChanMapping)
+
+    Dirs = set([ GiveJonesDirections(GD, lmShift, DicoJonesMatrices)[::2] for lmShift in ListLMShift ])
+    for idir_kMS, idir_Beam in sorted(Dirs):
+        nt, nch = len(it_kMS), len(ich_kMS)
+        J = np.zeros((nt, na, nch, 4), np.complex128)
+        J[..., 0] = J[..., 3] = 1
+        Weights = np.zeros((nt, na, nch, 3), np.float64)
+        if Sources[0]:
+            JonesRaw = np.complex128(Sources[0][0][:, idir_kMS].reshape(Sources[0][0].shape[:1]+(na, -1, 4)))
+            Jones = JonesRaw.copy()
+            if not ApplyAmp:
+                absJones = np.abs(Jones)
+                Jones[absJones != 0] /= absJones[absJones != 0]
+            if not ApplyPhase:
+                Jones = np.complex128(np.abs(Jones))
+            # the variation is taken with respect to the raw Jones of the adjacent intervals, as the gridder does
+            t = np.arange(Jones.shape[0])
+            t_p1, t_m1 = np.minimum(t+1, t[-1]), np.maximum(t-1, 0)
+            W = np.zeros(Jones.shape[:3]+(3,), np.float64)
+            W[..., 0] = np.abs(Jones[..., 0])
+            W[..., 1] = np.abs(JonesRaw[t_p1, ..., 0]-Jones[..., 0]) + np.abs(JonesRaw[t_m1, ..., 0]-Jones[..., 0])
+            W[..., 2] = np.abs(Jones[..., 3])
+            J = Jones[it_kMS][:, :, ich_kMS]
+            Weights = W[it_kMS][:, :, ich_kMS]
+        if Sources[1]:
+            JB = np.complex128(Sources[1][0][:, idir_Beam].reshape(Sources[1][0].shape[:1]+(na, -1, 4)))
+            JB = JB[it_Beam][:, :, ich_Beam]
+            # J = J_kMS.J_Beam
+            J = np.stack([J[..., 0]*JB[..., 0]+J[..., 1]*JB[..., 2],
+                          J[..., 0]*JB[..., 1]+J[..., 1]*JB[..., 3],
+                          J[..., 2]*JB[..., 0]+J[..., 3]*JB[..., 2],
+                          J[..., 2]*JB[..., 1]+J[..., 3]*JB[..., 3]], axis=-1)
+        Tables["Jones:%d:%d" % (idir_kMS, idir_Beam)] = np.ascontiguousarray(J)
+        Tables["Weights:%d:%d" % (idir_kMS, idir_Beam)] = np.ascontiguousarray(Weights)
+    return Tables
+
+
 class ClassDDEGridMachine():
 
     def __init__(self,
@@ -485,7 +607,12 @@ class ClassDDEGridMachine():
                                               lmShift=self.lmShift,
                                               cf_dict=cf_dict,
                                               compute_cf=compute_cf,
-                                              IDFacet=self.IDFacet)
+                                              IDFacet=self.IDFacet,
+                                              library=self.GD["Cache"]["CFLibrary"] or None,
+                                              AdaptivePhaseError=self.GD["CF"]["AdaptiveNw"] and
+                                                                 self.GD["CF"]["AdaptivePhaseError"])
+        # with --CF-AdaptiveNw, the number of w-planes is picked per facet
+        self.Nw = self.WTerm.Nw
         T.timeit("2")
         self.ifzfCF = self.WTerm.ifzfCF
 
@@ -555,38 +682,8 @@ class ClassDDEGridMachine():
         Apply_Beam = ("DicoJones_Beam" in DicoJonesMatrices)
 
 
-        l0,m0=self.lmShift
-        idir_kMS=0
-        w_kMS=np.array([],np.float32)
         InterpMode=self.GD["DDESolutions"]["Type"]
-        d0=self.GD["DDESolutions"]["Scale"]*np.pi/180
-        gamma=self.GD["DDESolutions"]["gamma"]
-        if Apply_killMS:
-            DicoClusterDirs=DicoJonesMatrices["DicoJones_killMS"]["Dirs"]
-            lc=DicoClusterDirs["l"]
-            mc=DicoClusterDirs["m"]
-            sI=DicoClusterDirs["I"]
-            d=np.sqrt((l0-lc)**2+(m0-mc)**2)
-            idir_kMS=np.argmin(d)
-            # print rad2hmsdms(DicoClusterDirs["ra"][idir_kMS],Type="ra"), rad2hmsdms(DicoClusterDirs["dec"][idir_kMS])
-            
-            w=sI/(1.+d/d0)**gamma
-            w/=np.sum(w)
-            w[w<(0.2*w.max())]=0
-            ind=np.argsort(w)[::-1]
-            w[ind[3::]]=0
-            w/=np.sum(w)
-            w_kMS=w
-#            print>>log,("kMS",self.IDFacet,lc.shape,idir_kMS)
-
-        idir_Beam = 0
-        if Apply_Beam:
-            DicoClusterDirs = DicoJonesMatrices["DicoJones_Beam"]["Dirs"]
-            lc = DicoClusterDirs["l"]
-            mc = DicoClusterDirs["m"]
-            d = np.sqrt((l0-lc)**2+(m0-mc)**2)
-            idir_Beam = np.argmin(d)
-#            print>>log,("Beam",self.IDFacet,lc.shape,idir_Beam)
+        idir_kMS, w_kMS, idir_Beam = GiveJonesDirections(self.GD, self.lmShift, DicoJonesMatrices)
 
         # pylab.clf()
         # pylab.scatter(lc,mc,c=w)
@@ -659,9 +756,23 @@ class ClassDDEGridMachine():
 
         return ParamJonesList
 
+    def GiveJonesTableList(self, DicoJonesMatrices):
+        """
+        Returns the entries of the chunk's Jones table (see BuildJonesTables) for this facet, to be appended to
+        the Jones parameters of the BDA gridder and degridder. Returns an empty list if there is no table.
+        """
+        JonesTable = DicoJonesMatrices.get("JonesTable")
+        if JonesTable is None:
+            return []
+        idir_kMS, _, idir_Beam = GiveJonesDirections(self.GD, self.lmShift, DicoJonesMatrices)
+        return [JonesTable["Jones:%d:%d" % (idir_kMS, idir_Beam)],
+                JonesTable["Weights:%d:%d" % (idir_kMS, idir_Beam)],
+                JonesTable["TimeMapping"],
+                JonesTable["ChanMapping"]]
+
     def put(self, times, uvw, visIn, flag, A0A1, W=None,
             PointingID=0, DoNormWeights=True, DicoJonesMatrices=None,
-            freqs=None, DoPSF=0, ChanMapping=None, ResidueGrid=None, sparsification=None):
+            freqs=None, DoPSF=0, ChanMapping=None, ResidueGrid=None, sparsification=None, nthreads=1):
         """
         Gridding routine, wraps external python extension C gridder
         Args:
@@ -678,6 +789,7 @@ class ClassDDEGridMachine():
             DoPSF:
             ChanMapping:
             ResidueGrid:
+            nthreads: number of threads used by the BDA gridder (each thread owns its own strips of the grid)
         Returns:
 
         """
@@ -755,6 +867,8 @@ class ClassDDEGridMachine():
             LSumJonesChan=[self.SumJonesChan]
             ParamJonesList=self.GiveParamJonesList(DicoJonesMatrices,times,A0,A1,uvw,gridder=True)
             ParamJonesList=ParamJonesList+LApplySol+LSumJones+LSumJonesChan+[np.float32(self.GD["DDESolutions"]["ReWeightSNR"])]
+            if self.GD["RIME"]["BackwardMode"] == "BDA-grid":
+                ParamJonesList += self.GiveJonesTableList(DicoJonesMatrices)
 
         #T2= ClassTimeIt.ClassTimeIt("Gridder")
         #T2.disable()
@@ -792,7 +906,8 @@ class ClassDDEGridMachine():
                                           self.LSmear,
                                           np.int32(ChanMapping),
                                           np.array(self.DataCorrelationFormat).astype(np.uint16),
-                                          np.array(self.ExpectedOutputStokes).astype(np.uint16))
+                                          np.array(self.ExpectedOutputStokes).astype(np.uint16),
+                                          nthreads)
 
             T.timeit("gridder")
             T.timeit("grid %d" % self.IDFacet)
@@ -893,6 +1008,17 @@ class ClassDDEGridMachine():
             if not(Jones.flags.c_contiguous):
                 raise NameError("Jones has to be contiguous")
 
+    def modelImageToGrid(self, ModelImage):
+        """Fourier transforms a facet model image (as returned by ClassImToGrid.GiveModelTessel) into
+        a degridding grid. Returns None if the model image is empty, in which case there is nothing to degrid."""
+        if np.max(np.abs(ModelImage)) == 0:
+            return None
+        if self.GD["RIME"]["Precision"]=="S":
+            Cast=np.complex64
+        elif self.GD["RIME"]["Precision"]=="D":
+            Cast=np.complex128
+        return np.complex64(self.getFFTWMachine().fft(Cast(ModelImage)))
+
     def get(self, 
             times, 
             uvw, 
@@ -923,13 +1049,9 @@ class ClassDDEGridMachine():
 
 
         if TranformModelInput == "FT":
-            if np.max(np.abs(ModelImage)) == 0:
+            Grid = self.modelImageToGrid(ModelImage)
+            if Grid is None:
                 return vis
-            if self.GD["RIME"]["Precision"]=="S": 
-                Cast=np.complex64
-            elif self.GD["RIME"]["Precision"]=="D": 
-                Cast=np.complex128
-            Grid = np.complex64(self.getFFTWMachine().fft(Cast(ModelImage)))
 
         if freqs.size > 1:
             df = freqs[1::] - freqs[0:-1]
@@ -996,6 +1118,8 @@ class ClassDDEGridMachine():
                 DicoJonesMatrices, times, A0, A1, uvw, degridder=True)
             ParamJonesList = ParamJonesList+LApplySol+LSumJones+LSumJonesChan + \
                 [np.float32(self.GD["DDESolutions"]["ReWeightSNR"])]
+            if self.GD["RIME"]["ForwardMode"] == "BDA-degrid":
+                ParamJonesList += self.GiveJonesTableList(DicoJonesMatrices)
 
         T.timeit("3")
         #print vis
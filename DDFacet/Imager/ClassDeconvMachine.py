@@ -50,6 +50,7 @@ import numexpr
 from DDFacet.Imager import ClassImageNoiseMachine
 from DDFacet.Data import ClassStokes
 from DDFacet.Imager import ClassGainMachine
+from DDFacet.Imager.ClassProductGraph import ClassProductGraph
 from DDFacet.Data.PointingProvider import PointingProvider
 # from astropy import wcs
 # from astropy.io import fits
@@ -163,6 +164,8 @@ class ClassImagerDeconv():
         AsyncProcessPool.init(ncpu=self.GD["Parallel"]["NCPU"],
                               affinity=self.GD["Parallel"]["Affinity"],
                               parent_affinity=self.GD["Parallel"]["MainProcessAffinity"],
+                              num_io_processes=max(1, self.GD["Data"]["ReadAhead"]),
+                              trace_file=self.GD["Debug"]["Trace"] and "%s.trace.json" % self.GD["Output"]["Name"],
                               verbose=self.GD["Debug"]["APPVerbose"],
                               pause_on_start=self.GD["Debug"]["PauseWorkers"])
 
@@ -1046,7 +1049,8 @@ class ClassImagerDeconv():
             print>> log, "applying a sparsification factor of %f to data for dirty image" % sparsify
         
         # if running in NMajor=0 mode, then we simply want to subtract/predict the model probably
-        self.GiveDirty(psf=True, sparsify=sparsify, last_cycle=(NMajor==0))
+        with APP.tracePhase("major cycle 0: gridding"):
+            self.GiveDirty(psf=True, sparsify=sparsify, last_cycle=(NMajor==0))
 
         # Polarization clean is not going to be supported. We can only make dirty maps
         if self.VS.StokesConverter.RequiredStokesProducts() != ['I']:
@@ -1121,7 +1125,8 @@ class ClassImagerDeconv():
 
             self.DeconvMachine.Update(self.DicoDirty)
 
-            repMinor, continue_deconv, update_model = self.DeconvMachine.Deconvolve()
+            with APP.tracePhase("minor cycle %d" % iMajor):
+                repMinor, continue_deconv, update_model = self.DeconvMachine.Deconvolve()
             try:
                 self.FacetMachine.ToCasaImage(self.DeconvMachine.LabelIslandsImage,
                                               ImageName="%s.labelIslands%2.2i"%(self.BaseName,iMajor),Fits=True,
@@ -1203,6 +1208,8 @@ class ClassImagerDeconv():
             current_model_freqs = np.array([])
             ModelImage = None
             HasWrittenModel=False
+            # the pass over the data (degridding, then gridding of each chunk) is traced as a major cycle phase
+            t0_major = time.time()
             while True:
                 # note that collectLoadedChunk() will destroy the current DATA dict, so we must make sure
                 # the gridding jobs of the previous chunk are finished
@@ -1292,6 +1299,7 @@ class ClassImagerDeconv():
             self.FacetMachine.releaseModelImage()
             # create new residual image
             self.DicoDirty = self.FacetMachine.FacetsToIm(NormJones=True)
+            APP.traceEvent("major cycle %d: degridding/gridding" % iMajor, "phase", t0_major, time.time())
 
             self.DicoDirty["LastMask"] = self.MaskMachine.CurrentMask
 
@@ -1675,24 +1683,15 @@ class ClassImagerDeconv():
     def _saveImage_worker (self, sd, field, ImageName, delete=False,
                            Fits=True, beam=None, beamcube=None, Freqs=None,
                            Stokes=None):
-        """Worker function to save an image to disk, and optionally to delete it"""
+        """Worker function to save an image to disk, and optionally to delete it.
+        The image is streamed to disk straight from the shared dict, so the worker does not hold a copy of it."""
         image = sd[field]
         self.FacetMachine.ToCasaImage(image, ImageName=ImageName, Fits=Fits, beam=beam, beamcube=beamcube,
-                                      Freqs=Freqs, Stokes=Stokes)
+                                      Freqs=Freqs, Stokes=Stokes, Stream=True)
         if delete:
 #            print>> log, "releasing %s image" % field
             sd.delete_item(field)
 
-    def _delSharedImage_worker(self, sd, *args):
-        """Worker function to delete an imaged from the shared dict. Enqueued after that image is no longer useful."""
-        for field in args:
-            if field in sd:
- #               print>>log, "releasing %s image" % field
-                sd.delete_item(field)
-
-
-
-    
     def RestoreAndShift(self):
         dirty_cachepath = self.VS.maincache.getElementPath("LastResidual")
         #dirty_cachepath = self.VS.maincache.getElementPath("Dirty")
@@ -1799,459 +1798,179 @@ class ClassImagerDeconv():
         # @cyriltasse: maybe there's a quicker way to check?
         havenorm = self.MeanJonesNorm is not None and (self.MeanJonesNorm != 1).any()
 
-        T = ClassTimeIt.ClassTimeIt()
-        T.disable()
-
         # Make a SharedDict of images to save the intermediate images for when we need them.
-        # SharedDict because we'll have a job on the I/O queue doing the actual saving.
-        # Since these images and cubes can take a lot of SHM, we will also schedule I/O jobs to delete them
-        # after we don't need them anymore.
+        # SharedDict because we'll have jobs on the I/O queue doing the actual saving, and convolution jobs on the
+        # workers. The product graph works out which images each requested product needs, runs the convolutions of
+        # independent products in parallel, and schedules I/O jobs to delete images once nothing else needs them,
+        # since these images and cubes can take a lot of SHM.
 
         _images = shared_dict.create("OutputImages")
-        _final_RMS = {}
-        def sqrtnorm():
-            label = 'sqrtnorm'
-            if label not in _images:
-                if havenorm:
-                    a = self.MeanJonesNorm 
-                else:
-                    a=np.array([1])
-                out = _images.addSharedArray(label, a.shape, a.dtype)
-                numexpr.evaluate('sqrt(a)', out=out)
-            return _images[label]
-        def sqrtnormcube():
-            label = 'sqrtnormcube'
-            if label not in _images:
-                if havenorm:
-                    a = self.JonesNorm
-                else:
-                    a=np.array([1])
-#                a = self.JonesNorm if havenorm else np.array([1])
-                out = _images.addSharedArray(label, a.shape, a.dtype)
-                numexpr.evaluate('sqrt(a)', out=out)
-            return _images[label]
-        def smooth_sqrtnorm():
-            label = 'smooth_sqrtnorm'
-            if label not in _images:
-                if havenorm:
-                    if self.FacetMachine.MeanSmoothJonesNorm is None:
-                        a = self.MeanJonesNorm 
-                    else:
-                        print>>log,ModColor.Str("Using the freq-averaged smooth beam to normalise the apparent images",col="blue")
-                        a=self.FacetMachine.MeanSmoothJonesNorm
-                else:
-                    a=np.array([1])
-                out = _images.addSharedArray(label, a.shape, a.dtype)
-                numexpr.evaluate('sqrt(a)', out=out)
-            return _images[label]
-        def smooth_sqrtnormcube():
-            label = 'smooth_sqrtnormcube'
-            if label not in _images:
-                if havenorm:
-                    if self.FacetMachine.MeanSmoothJonesNorm is None:
-                        a = self.JonesNorm 
-                    else:
-                        print>>log,ModColor.Str("Using the smooth beam to normalise the apparent images",col="blue")
-                        a=self.FacetMachine.SmoothJonesNorm
-                else:
-                    a=np.array([1])
-#                a = self.JonesNorm if havenorm else np.array([1])
-                out = _images.addSharedArray(label, a.shape, a.dtype)
-                numexpr.evaluate('sqrt(a)', out=out)
-            return _images[label]
-        def appres():
-            return self.DicoDirty["MeanImage"]
-        def intres():
-            label = 'intres'
-            if label not in _images:
-                if havenorm:
-                    a, b = appres(), smooth_sqrtnorm()
-                    out = _images.addSharedArray(label, a.shape, a.dtype)
-                    numexpr.evaluate('a/b', out=out)
-                    out[~np.isfinite(out)] = 0
-                else:
-                    _images[label] = appres()
-            return _images[label]
-        def apprescube():
-            return self.DicoDirty["ImageCube"]
-        def intrescube():
-            label = 'intrescube'
-            if label not in _images:
-                if havenorm:
-                    a, b = apprescube(), smooth_sqrtnormcube()
-                    out = _images.addSharedArray(label, a.shape, a.dtype)
-                    numexpr.evaluate('a/b', out=out)
-                    out[~np.isfinite(out)] = 0
-                else:
-                    _images[label] = apprescube()
-            return _images[label]
-        def appmodel():
-            label = 'appmodel'
-            if label not in _images:
-                if havenorm:
-                    a, b = intmodel(), smooth_sqrtnorm()
-                    out = _images.addSharedArray(label, a.shape, a.dtype)
-                    numexpr.evaluate('a*b', out=out)
-                else:
-                    _images[label] = intmodel()
-            return _images[label]
-        def intmodel():
-            label = 'intmodel'
-            if label not in _images:
-                out=ModelMachine.GiveModelImage(RefFreq)
-                if havenorm:
-                    a, b, c = out, sqrtnorm(), smooth_sqrtnorm()
-                    numexpr.evaluate('a*b/c', out=out)
-                _images[label] = out
-            return _images[label]
-        def appmodelcube():
-            label = 'appmodelcube'
-            if label not in _images:
-                if havenorm:
-                    a, b = intmodelcube(), smooth_sqrtnormcube()
-                    out = _images.addSharedArray(label, a.shape, a.dtype)
-                    numexpr.evaluate('a*b', out=out)
-                else:
-                    _images[label] = intmodelcube()
-            return _images[label]
-        def intmodelcube():
-            label = 'intmodelcube'
-            if label not in _images:
-                shape = list(ModelMachine.ModelShape)
-                shape[0] = len(self.VS.FreqBandCenters)
-                out = _images.addSharedArray(label, shape, np.float32)
-                ModelMachine.GiveModelImage(self.VS.FreqBandCenters, out=out)
-                if havenorm:
-                    a, b, c = out, sqrtnormcube(), smooth_sqrtnormcube()
-                    numexpr.evaluate('a*b/c', out=out)
-            return _images[label]
-        def appconvmodel():
-            label = 'appconvmodel'
-            if label not in _images:
-                if havenorm:
-                    out = _images.addSharedArray(label, appmodel().shape, np.float32)
-                    ModFFTW.ConvolveGaussian(shareddict={"in": appmodel(),
-                                                         "out": out},
-                                             field_in = "in",
-                                             field_out = "out",
-                                             ch = 0,
-                                             CellSizeRad=self.CellSizeRad,
-                                             GaussPars_ch=self.PSFGaussParsAvg)
-                    T.timeit(label)
-                else:
-                    _images[label] = intconvmodel()
-            return _images[label]
-        def intconvmodel():
-            label = 'intconvmodel'
-            if label not in _images:
-                out = _images.addSharedArray(label, intmodel().shape,
-                                             np.float32)
-                ModFFTW.ConvolveGaussian(shareddict={"in": intmodel(),
-                                                     "out": out},
-                                         field_in = "in",
-                                         field_out = "out",
-                                         ch = 0,
-                                         CellSizeRad=self.CellSizeRad,
-                                         GaussPars_ch=self.PSFGaussParsAvg)
-                T.timeit(label)
-            return _images[label]
-        def appconvmodelcube():
-            label = 'appconvmodelcube'
-            if label not in _images:
-                if havenorm:
-                    out = _images.addSharedArray(label, appmodelcube().shape, np.float32)
-                    ModFFTW.ConvolveGaussianParallel(shareddict=_images,
-                                                     field_in = "appmodelcube",
-                                                     field_out = label,
-                                                     CellSizeRad=self.CellSizeRad,
-                                                     GaussPars=self.PSFGaussPars)
-                    T.timeit(label)
-                else:
-                    _images[label] = intconvmodelcube()
-            return _images[label]
-        def intconvmodelcube():
-            label = 'intconvmodelcube'
-            if label not in _images:
-                out = _images.addSharedArray(label, intmodelcube().shape, np.float32)
-                ModFFTW.ConvolveGaussianParallel(shareddict=_images,
-                                                 field_in = "intmodelcube",
-                                                 field_out =label,
-                                                 CellSizeRad=self.CellSizeRad,
-                                                 GaussPars=self.PSFGaussPars)
-
-                ModFFTW.ConvolveGaussianParallel(_images, 'intmodelcube', label,
-                                                 CellSizeRad=self.CellSizeRad, GaussPars=self.PSFGaussPars)
-                T.timeit(label)
-            return _images[label]
-        def posintmod():
-            label = 'posintmod'
-            if label not in _images:
-                _images.addSharedArray(label, intmodel().shape, np.float32)
-                _images[label] = ModelMachine.FreqMachine.Iref.reshape(intmodel().shape)
-            return _images[label]
-        def give_final_RMS():
-            try:
-                return _final_RMS["RMS"]
-            except:
-                _final_RMS["RMS"] = np.std(intres().ravel())
-                return _final_RMS["RMS"]
-        def weighted_alphamap():
-            label = 'weighted_alphamap'
-            if label not in _images:
-                _images.addSharedArray(label, intmodel().shape, np.float32)
-                # compute the RMS of the final residual
-                RMS = give_final_RMS()
-                # get the RMS threshold
-                RMSthreshold = self.GD["Output"]["alphathreshold"]
-                _images[label] = ModelMachine.GiveSpectralIndexMap(threshold=RMS*RMSthreshold)
-                _images['posintmod'] = ModelMachine.FreqMachine.Iref.reshape(intmodel().shape)
-            return _images[label]
-        def alphamap():
-            label = 'alphamap'
-            if label not in _images:
-                _images.addSharedArray(label, intmodel().shape, np.float32)
-                
-                # ##############################
-                # # Reverting for issue458
-                #_images[label] = ModelMachine.FreqMachine.alpha_map.reshape(intmodel().shape)
-                _images[label] = ModelMachine.GiveSpectralIndexMap()
-                # ##############################
-
-            return _images[label]
-        def alphaconvmap():
-            label = 'alphaconvmap'
-            if label not in _images:
-                # Get weighted alpha map
-                a = _images.addSharedArray('alphaconvmap', weighted_alphamap().shape, np.float32)
-                # Convolve with Gaussian
-                ModFFTW.ConvolveGaussian(shareddict={"in": weighted_alphamap(),
-                                                     "out": a},
-                                         field_in = "in",
-                                         field_out = "out",
-                                         ch = 0,
-                                         CellSizeRad=self.CellSizeRad,
-                                         GaussPars_ch=self.PSFGaussParsAvg)
-
-                # Get positive part of restored image
-                b = _images.addSharedArray('posconvmod', alphamap().shape, np.float32)
-                ModFFTW.ConvolveGaussian(shareddict={"in": alphamap(),
-                                                     "out": b},
-                                         field_in = "in",
-                                         field_out = "out",
-                                         ch = 0,
-                                         CellSizeRad=self.CellSizeRad,
-                                         GaussPars_ch=self.PSFGaussParsAvg)
-
-                c = intconvmodel()
-                # Get mask based on restored image and positive restored image
-                RMS = give_final_RMS()
-                RMSmaskfact = self.GD["Output"]["alphamaskthreshold"]
-                I1 = c[0, 0, :, :] > RMSmaskfact*RMS
-                I2 = b[0, 0, :, :] > RMSmaskfact*RMS
-                IC = I1 & I2
-                I = np.argwhere(IC)
-                #print I.size
-                ix = I[:,0]
-                iy = I[:,1]
-                d = np.zeros_like(a)
-                d[0, 0, ix, iy] = a[0, 0, ix, iy]/b[0, 0, ix, iy]
-                #print a.min(), a.max()
-                _images.addSharedArray(label, alphamap().shape, np.float32)
-                _images[label] = d
-                T.timeit(label)
-            return _images[label]
+        graph = ClassProductGraph(_images, name="restore")
+        Stokes = self.VS.StokesConverter.RequiredStokesProducts()
+
+        def sqrt(label, a):
+            out = _images.addSharedArray(label, a.shape, a.dtype)
+            numexpr.evaluate('sqrt(a)', out=out)
+            return out
+        def divide(label, a, b):
+            out = _images.addSharedArray(label, a.shape, a.dtype)
+            numexpr.evaluate('a/b', out=out)
+            out[~np.isfinite(out)] = 0
+            return out
+        def multiply(label, a, b):
+            out = _images.addSharedArray(label, a.shape, a.dtype)
+            numexpr.evaluate('a*b', out=out)
+            return out
+        def add(label, a, b):
+            out = _images.addSharedArray(label, a.shape, a.dtype)
+            numexpr.evaluate('a+b', out=out)
+            return out
+        def smooth_norm(cube):
+            if self.FacetMachine.MeanSmoothJonesNorm is None:
+                return self.JonesNorm if cube else self.MeanJonesNorm
+            print>>log,ModColor.Str("Using the %ssmooth beam to normalise the apparent images" %
+                                    ("" if cube else "freq-averaged "),col="blue")
+            return self.FacetMachine.SmoothJonesNorm if cube else self.FacetMachine.MeanSmoothJonesNorm
+        def intmodel(*norms):
+            out = ModelMachine.GiveModelImage(RefFreq)
+            if norms:
+                a, (b, c) = out, norms
+                numexpr.evaluate('a*b/c', out=out)
+            return out
+        def intmodelcube(*norms):
+            shape = list(ModelMachine.ModelShape)
+            shape[0] = len(self.VS.FreqBandCenters)
+            out = _images.addSharedArray('intmodelcube', shape, np.float32)
+            ModelMachine.GiveModelImage(self.VS.FreqBandCenters, out=out)
+            if norms:
+                a, (b, c) = out, norms
+                numexpr.evaluate('a*b/c', out=out)
+            return out
+
+        graph.addExternal("appres", self.DicoDirty, "MeanImage")
+        graph.addExternal("apprescube", self.DicoDirty, "ImageCube")
+        if havenorm:
+            graph.addImage("sqrtnorm", lambda: sqrt("sqrtnorm", self.MeanJonesNorm))
+            graph.addImage("sqrtnormcube", lambda: sqrt("sqrtnormcube", self.JonesNorm))
+            graph.addImage("smooth_sqrtnorm", lambda: sqrt("smooth_sqrtnorm", smooth_norm(False)))
+            graph.addImage("smooth_sqrtnormcube", lambda: sqrt("smooth_sqrtnormcube", smooth_norm(True)))
+            graph.addImage("intres", lambda a, b: divide("intres", a, b), deps=["appres", "smooth_sqrtnorm"])
+            graph.addImage("intrescube", lambda a, b: divide("intrescube", a, b),
+                           deps=["apprescube", "smooth_sqrtnormcube"])
+            graph.addImage("intmodel", intmodel, deps=["sqrtnorm", "smooth_sqrtnorm"])
+            graph.addImage("appmodel", lambda a, b: multiply("appmodel", a, b), deps=["intmodel", "smooth_sqrtnorm"])
+            graph.addImage("intmodelcube", intmodelcube, deps=["sqrtnormcube", "smooth_sqrtnormcube"])
+            graph.addImage("appmodelcube", lambda a, b: multiply("appmodelcube", a, b),
+                           deps=["intmodelcube", "smooth_sqrtnormcube"])
+        else:
+            graph.addAlias("intres", "appres")
+            graph.addAlias("intrescube", "apprescube")
+            graph.addImage("intmodel", intmodel)
+            graph.addAlias("appmodel", "intmodel")
+            graph.addImage("intmodelcube", intmodelcube)
+            graph.addAlias("appmodelcube", "intmodelcube")
+        # convolved models: these are the expensive products, run as parallel jobs
+        graph.addConvolution("intconvmodel", "intmodel", self.CellSizeRad, [self.PSFGaussParsAvg], np.float32)
+        graph.addConvolution("intconvmodelcube", "intmodelcube", self.CellSizeRad, self.PSFGaussPars, np.float32)
+        if havenorm:
+            graph.addConvolution("appconvmodel", "appmodel", self.CellSizeRad, [self.PSFGaussParsAvg], np.float32)
+            graph.addConvolution("appconvmodelcube", "appmodelcube", self.CellSizeRad, self.PSFGaussPars, np.float32)
+        else:
+            graph.addAlias("appconvmodel", "intconvmodel")
+            graph.addAlias("appconvmodelcube", "intconvmodelcube")
+        graph.addImage("apprestored", lambda a, b: add("apprestored", a, b), deps=["appres", "appconvmodel"])
+        graph.addImage("intrestored", lambda a, b: add("intrestored", a, b), deps=["intres", "intconvmodel"])
+        # mixed-flux restored image
+        # (apparent noise + intrinsic model) if intrinsic model is available
+        # (apparent noise + apparent model) otherwise, (JonesNorm ~= 1)
+        graph.addImage("mixrestored", lambda a, b: add("mixrestored", a, b),
+                       deps=["appres", "intconvmodel" if havenorm else "appconvmodel"])
+        graph.addImage("apprestoredcube", lambda a, b: add("apprestoredcube", a, b),
+                       deps=["apprescube", "appconvmodelcube"])
+        graph.addImage("intrestoredcube", lambda a, b: add("intrestoredcube", a, b),
+                       deps=["intrescube", "intconvmodelcube"])
+        # ##############################
+        # # Reverting for issue458: the alpha map is not convolved (see ClassModelMachine.GiveSpectralIndexMap)
+        graph.addImage("alphamap", lambda: ModelMachine.GiveSpectralIndexMap())
+        # ##############################
+
+        # list of products to save, in order
+        saves = []
+        def save(label, ImageName, cube=False, beam=False):
+            kwargs = dict(ImageName="%s.%s" % (self.BaseName, ImageName), Fits=True, Stokes=Stokes)
+            if beam:
+                kwargs["beam"] = self.FWHMBeamAvg
+                if cube:
+                    kwargs["beamcube"] = self.FWHMBeam
+            if cube:
+                kwargs["Freqs"] = self.VS.FreqBandCenters
+            saves.append((label, kwargs))
 
         # norm
         if havenorm and ("S" in self._saveims or "s" in self._saveims):
-            sqrtnorm()
-            APP.runJob("save:sqrtnorm", self._saveImage_worker, io=0, args=( _images.readonly(), "sqrtnorm",),
-                            kwargs=dict( ImageName="%s.fluxscale"%(self.BaseName),
-                                          Fits=True,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("sqrtnorm", "fluxscale")
         # apparent-flux residuals
         if "r" in self._saveims:
-            appres()
-            APP.runJob("save:appres", self._saveImage_worker, io=0, args=( self.DicoDirty.readonly(), "MeanImage",),
-                            kwargs=dict( ImageName="%s.app.residual"%(self.BaseName),
-                                          Fits=True,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("appres", "app.residual")
         # intrinsic-flux residuals
         if havenorm and "R" in self._saveims:
-            intres()
-            APP.runJob("save:intres", self._saveImage_worker, io=0, args=( _images.readonly(), "intres",),
-                            kwargs=dict(ImageName="%s.int.residual"%(self.BaseName),Fits=True,
-                                          Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("intres", "int.residual")
         # apparent-flux model
         if "m" in self._saveims:
-            appmodel()
-            APP.runJob("save:appmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "appmodel",),
-                       kwargs=dict(ImageName="%s.app.model" % self.BaseName, Fits=True,
-                                   Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("appmodel", "app.model")
         # intrinsic-flux model
         if havenorm and "M" in self._saveims:
-            intmodel()
-            APP.runJob("save:intmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "intmodel",),
-                       kwargs=dict(ImageName="%s.int.model" % self.BaseName, Fits=True,
-                                   Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("intmodel", "int.model")
         # convolved-model image in apparent flux
         if "c" in self._saveims:
-            appconvmodel()
-            APP.runJob("save:appconvmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "appconvmodel",),
-                       kwargs=dict(ImageName="%s.app.convmodel" % self.BaseName, Fits=True,
-                                   beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("appconvmodel", "app.convmodel", beam=True)
         # convolved-model image in intrinsic flux
         if havenorm and "C" in self._saveims:
-            intconvmodel()
-            APP.runJob("save:intconvmodel", self._saveImage_worker, io=0, args=(_images.readonly(), "intconvmodel",),
-                       kwargs=dict(ImageName="%s.int.convmodel" % self.BaseName, Fits=True,
-                                   beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-
+            save("intconvmodel", "int.convmodel", beam=True)
         # norm cube
         if havenorm and ("S" in self._savecubes or "s" in self._savecubes):
-            sqrtnormcube()
-            APP.runJob("save:sqrtnormcube", self._saveImage_worker, io=0, args=(_images.readonly(), "sqrtnormcube",),
-                       kwargs=dict(ImageName="%s.cube.fluxscale" % (self.BaseName), Fits=True,
-                                   Freqs=self.VS.FreqBandCenters,
-                                   Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("sqrtnormcube", "cube.fluxscale", cube=True)
         # apparent-flux restored image
         if "i" in self._saveims:
-            _images["apprestored"] = appres()
-            _images["apprestored"] += appconvmodel()
-            APP.runJob("save:apprestored", self._saveImage_worker, io=0, args=(_images.readonly(), "apprestored",),
-                       kwargs=dict(ImageName="%s.app.restored" % self.BaseName, Fits=True,
-                                   beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("apprestored", "app.restored", beam=True)
         # intrinsic-flux restored image
         if havenorm and "I" in self._saveims:
-            _images["intrestored"] = intres()
-            _images["intrestored"] += intconvmodel()
-            APP.runJob("save:intrestored", self._saveImage_worker, io=0, args=(_images.readonly(), "intrestored",),
-                       kwargs=dict(ImageName="%s.int.restored" % self.BaseName, Fits=True,
-                                   beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-
-        # # intrinsic-flux restored image
-        # if havenorm and self.DoSmoothBeam:
-        #     if self.FacetMachine.SmoothJonesNorm is None:
-        #         print>> log, ModColor.Str("You requested a restored imaged but the smooth beam is not in there")
-        #         print>> log, ModColor.Str("  so just not doing it")
-        #     else:
-        #         a, b, c = appres(), appconvmodel(), self.FacetMachine.MeanSmoothJonesNorm
-        #         out = _images.addSharedArray('smoothrestored', a.shape, a.dtype)
-        #         numexpr.evaluate('(a+b)/sqrt(c)', out=out)
-        #         APP.runJob("save:smoothrestored", self._saveImage_worker, io=0,
-        #                    args=(_images.readwrite(), "smoothrestored",), kwargs=dict(
-        #                 ImageName="%s.smooth.int.restored" % self.BaseName, Fits=True, delete=True,
-        #                 beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-
+            save("intrestored", "int.restored", beam=True)
         # mixed-flux restored image
-        # (apparent noise + intrinsic model) if intrinsic model is available
-        # (apparent noise + apparent model) otherwise, (JonesNorm ~= 1)
         if "x" in self._saveims:
-            a, b = (appres(), intconvmodel()) if havenorm else \
-                   (appres(), appconvmodel())
-            out = _images.addSharedArray('mixrestored', a.shape, a.dtype)
-            numexpr.evaluate('a+b', out=out)
-            APP.runJob("save:mixrestored", self._saveImage_worker, io=0, args=(_images.readwrite(), "mixrestored",),
-                       kwargs=dict(
-                           ImageName="%s.restored" % self.BaseName, Fits=True, delete=True,
-                           beam=self.FWHMBeamAvg, Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-
+            save("mixrestored", "restored", beam=True)
         # Alpha image
         if "A" in self._saveims and self.VS.MultiFreqMode:
-            # ##############################
-            # # Reverting for issue458
-            # _images['alphaconvmap'] = alphaconvmap()
-            # APP.runJob("save:alphaconv", self._saveImage_worker, io=0, args=(_images.readwrite(), 'alphaconvmap',), kwargs=dict(
-            #     ImageName="%s.alphaconv" % self.BaseName, Fits=True, delete=True, beam=self.FWHMBeamAvg,
-            #     Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-            # ##############################
-            _images['alphamap'] = alphamap()
-            APP.runJob("save:alpha", self._saveImage_worker, io=0, args=(_images.readwrite(), 'alphamap',), kwargs=dict(
-                ImageName="%s.alpha" % self.BaseName, Fits=True, delete=True, beam=self.FWHMBeamAvg,
-                Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-
-        #  done saving images -- schedule a job to delete them all from the dict to save RAM
-        APP.runJob("del:images", self._delSharedImage_worker, io=0, args=[_images.readwrite()] + list(_images.keys()))
+            save("alphamap", "alpha", beam=True)
 
         # now form up cubes
         # apparent-flux model cube
         if "m" in self._savecubes:
-            appmodelcube()
-            APP.runJob("save:appmodelcube", self._saveImage_worker, io=0, args=(_images.readonly(), "appmodelcube", ),
-                       kwargs=dict(ImageName="%s.cube.app.model" % self.BaseName, Fits=True,
-                                   Freqs=self.VS.FreqBandCenters,
-                                   Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("appmodelcube", "cube.app.model", cube=True)
         # intrinsic-flux model cube
         if havenorm and "M" in self._savecubes:
-            intmodelcube()
-            APP.runJob("save:intmodelcube", self._saveImage_worker, io=0, args=(_images.readonly(), "intmodelcube",),
-                       kwargs=dict(ImageName="%s.cube.int.model" % self.BaseName, Fits=True,
-                                   Freqs=self.VS.FreqBandCenters,
-                                   Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("intmodelcube", "cube.int.model", cube=True)
         # convolved-model cube in apparent flux
         if "c" in self._savecubes:
-            appconvmodelcube()
-            APP.runJob("save:appconvmodelcube", self._saveImage_worker, io=0,
-                       args=(_images.readonly(), "appconvmodelcube",),
-                       kwargs=dict(ImageName="%s.cube.app.convmodel" % self.BaseName, Fits=True,
-                                   beam=self.FWHMBeamAvg, beamcube=self.FWHMBeam, Freqs=self.VS.FreqBandCenters,
-                                   Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-        #  can delete this one now
-        if set(["i", "I"]).intersection(self._savecubes) == set():
-            APP.runJob("del:appmodelcube", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "appmodelcube"])
-        else: pass # needed again later on
+            save("appconvmodelcube", "cube.app.convmodel", cube=True, beam=True)
         # convolved-model cube in intrinsic flux
         if havenorm and "C" in self._savecubes:
-            intconvmodelcube()
-            APP.runJob("save:intconvmodelcube", self._saveImage_worker, io=0, args=( _images.readwrite(), "intconvmodelcube",), kwargs=dict(ImageName="%s.cube.int.convmodel"%self.BaseName,Fits=True,
-                beam=self.FWHMBeamAvg,beamcube=self.FWHMBeam,Freqs=self.VS.FreqBandCenters,
-                Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-
-
+            save("intconvmodelcube", "cube.int.convmodel", cube=True, beam=True)
         # intrinsic-flux restored image cube
         if havenorm and "I" in self._savecubes:
-            a, b = intrescube(), intconvmodelcube()
-            out = _images.addSharedArray('intrestoredcube', a.shape, a.dtype)
-            numexpr.evaluate('a+b', out=out)
-            APP.runJob("save:intrestoredcube", self._saveImage_worker, io=0,
-                       args=(_images.readwrite(), "intrestoredcube",), kwargs=dict(
-                    ImageName="%s.cube.int.restored" % self.BaseName, Fits=True, delete=True,
-                    beam=self.FWHMBeamAvg, beamcube=self.FWHMBeam, Freqs=self.VS.FreqBandCenters,
-                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-        APP.runJob("del:intcubes", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "intconvmodelcube", "intrestoredcube"])
-
-        #  can delete this one now
-        if set(["i", "I"]).intersection(self._savecubes) == set():
-            APP.runJob("del:intmodelcube", self._delSharedImage_worker, io=0,
-                       args=[_images.readwrite(), "intmodelcube"])
-        else: pass  # needed again later on
-        # convolved-model cube in intrinsic flux
-
+            save("intrestoredcube", "cube.int.restored", cube=True, beam=True)
         # apparent-flux residual cube
         if "r" in self._savecubes:
-            APP.runJob("save:apprescube", self._saveImage_worker, io=0, args=( self.DicoDirty.readonly(), "ImageCube",),
-                       kwargs=dict(ImageName="%s.cube.app.residual"%(self.BaseName),Fits=True,
-                                Freqs=self.VS.FreqBandCenters,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
+            save("apprescube", "cube.app.residual", cube=True)
         # apparent-flux restored image cube
         if "i" in self._savecubes:
-            a, b = apprescube(), appconvmodelcube()
-            out = _images.addSharedArray('apprestoredcube', a.shape, a.dtype)
-            numexpr.evaluate('a+b', out=out)
-            APP.runJob("save:apprestoredcube", self._saveImage_worker, io=0,
-                       args=(_images.readwrite(), "apprestoredcube",), kwargs=dict(
-                    ImageName="%s.cube.app.restored" % self.BaseName, Fits=True, delete=True,
-                    beam=self.FWHMBeamAvg, beamcube=self.FWHMBeam, Freqs=self.VS.FreqBandCenters,
-                    Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-            
-        #  can delete this one now
-        APP.runJob("del:appcubes", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "appconvmodelcube", "apprescube"])
+            save("apprestoredcube", "cube.app.restored", cube=True, beam=True)
         # intrinsic-flux residual cube
         if havenorm and "R" in self._savecubes:
-            intrescube()
-            APP.runJob("save:intrescube", self._saveImage_worker, io=0, args=( _images.readonly(), "intrescube",),
-                       kwargs=dict(ImageName="%s.cube.int.residual"%(self.BaseName),Fits=True,
-                                   Freqs=self.VS.FreqBandCenters,Stokes=self.VS.StokesConverter.RequiredStokesProducts()))
-        #  can delete this one now
-        APP.runJob("del:sqrtnormcube", self._delSharedImage_worker, io=0, args=[_images.readwrite(), "sqrtnormcube"])
-
-        APP.awaitJobResults(["save:*", "del:*"])
+            save("intrescube", "cube.int.residual", cube=True)
+
+        graph.Build(saves, self._saveImage_worker)
+        APP.awaitJobResults(["restore:save:*", "restore:del:*"])
 
     def testDegrid(self):
         import pylab
@@ -30,9 +30,9 @@ from DDFacet.Other.progressbar import ProgressBar
 import cPickle
 import atexit
 import traceback
-from matplotlib.path import Path
 import numpy.random
 from DDFacet.ToolsDir import ModCoord
+from DDFacet.ToolsDir import ModFacetMask
 from DDFacet.Array import NpShared
 from DDFacet.Array import shared_dict
 from DDFacet.ToolsDir import ModFFTW
@@ -42,6 +42,7 @@ from DDFacet.Other import ModColor
 from DDFacet.ToolsDir.ModToolBox import EstimateNpix
 from DDFacet.ToolsDir.GiveEdges import GiveEdges
 from DDFacet.Imager.ClassImToGrid import ClassImToGrid
+from DDFacet.Imager import ModCF
 from DDFacet.cbuild.Gridder import _pyGridderSmearPols
 from DDFacet.Data.ClassStokes import ClassStokes
 #from DDFacet.Array import NpParallel
@@ -131,6 +132,7 @@ class ClassFacetMachine():
 
         self._facet_grids = self._CF = self.DATA = None
         self._grid_job_id = self._fft_job_id = self._degrid_job_id = None
+        self._jones_table_disabled = False
         self._smooth_job_label=None
 
         # create semaphores if not already created
@@ -138,6 +140,10 @@ class ClassFacetMachine():
 
         # this is used to store model images in shared memory, for the degridder
         self._model_dict = None
+        # version counter of the model image (bumped by setModelImage()), and the key of
+        # the model grids currently held in self._model_dict (see set_model_grid())
+        self._model_version = 0
+        self._model_grid_key = None
         # this is used to store NormImage in shared memory, for the degridder
         self._norm_dict = None
 
@@ -638,6 +644,10 @@ class ClassFacetMachine():
             print>>log,"max w=%.6g from MS (--CF-wmax=0)"%wmax
         # subprocesses will place W-terms etc. here. Reset this first.
         self._CF = shared_dict.create("CFPSF" if self.DoPSF else "CF")
+        # W-kernels are looked up in (and added to) the W-kernel library by the workers. Open it here, so that its
+        # directory is created once
+        if self.GD["Cache"]["CFLibrary"]:
+            print>>log,"using W-kernel library %s" % ModCF.GiveWKernelLibrary(self.GD["Cache"]["CFLibrary"]).dirname
         # check if w-kernels, spacial weights, etc. are cached
 
         if self.GD["Cache"]["CF"]:
@@ -645,7 +655,9 @@ class ClassFacetMachine():
                             ImagerMainFacet=self.GD["Image"], 
                             Facets=self.GD["Facets"], 
                             RIME=self.GD["RIME"],
-                            DDESolutions={"DDSols":self.GD["DDESolutions"]["DDSols"]})
+                            DDESolutions={"DDSols":self.GD["DDESolutions"]["DDSols"]},
+                            # the cached CFs leave out the W-kernels when they are in a library
+                            CFLibrary=self.GD["Cache"]["CFLibrary"])
             cachename = self._cf_cachename = "CF"
             # in oversize-PSF mode, make separate cache for PSFs
             if self.DoPSF and self.Oversize != 1:
@@ -653,19 +665,86 @@ class ClassFacetMachine():
                 cachekey["Oversize"] = self.Oversize
             # check cache
             cachepath, cachevalid = self.VS.maincache.checkCache(cachename, cachekey, directory=True)
+            # spatial weights only depend on the facet layout, so they are cached separately, keyed on the layout
+            swname = self._sw_cachename = "FacetSWPSF" if self.DoPSF else "FacetSW"
+            swpath, swvalid = self.VS.maincache.checkCache(swname, self._giveFacetLayoutKey(), directory=True,
+                                                           content=True)
         else:
             print>>log,ModColor.Str("Explicitly not caching nor using cache for the Convolution Function")
             cachepath, cachevalid="",False
+            swpath, swvalid = "", False
             
         # up to workers to load/save cache
         for iFacet in self.DicoImager.iterkeys():
             facet_dict = self._CF.addSubdict(iFacet)
             APP.runJob("%s.InitCF.f%s"%(self._app_id, iFacet), self._initcf_worker,
-                            args=(iFacet, facet_dict.readwrite(), cachepath, cachevalid, wmax))
+                            args=(iFacet, facet_dict.readwrite(), cachepath, cachevalid, wmax, swpath, swvalid),
+                            cost=self._facetJobCost(iFacet))
+        APP.flushJobs()
         #workers_res=APP.awaitJobResults("%s.InitCF.*"%self._app_id, progress="Init CFs")
 
 
-    def _initcf_worker (self, iFacet, facet_dict, cachepath, cachevalid, wmax):
+    def _facetJobCost(self, iFacet):
+        """Relative cost of a per-facet job, used to schedule the largest facets first: the padded facet pixel count"""
+        return self.DicoImager[iFacet]["NpixFacetPadded"]**2
+
+    def _facetGridThreads(self, iFacet):
+        """Number of threads the gridder uses for a facet, see --Parallel-GridThreads"""
+        if self.DicoImager[iFacet]["NpixFacetPadded"] < self.GD["Parallel"]["GridThreadsMinNpix"]:
+            return 1
+        return max(self.GD["Parallel"]["GridThreads"] or APP.ncpu // len(self.DicoImager), 1)
+
+    def _giveFacetLayoutKey(self):
+        """Returns the cache key of the spatial weights: the facet layout they are computed from"""
+        return dict(Version=1, Corners=self.CornersImageTot,
+                    Facets=[ (self.DicoImager[iFacet]["NpixFacetPadded"], self.DicoImager[iFacet]["lmExtentPadded"],
+                              self.DicoImager[iFacet]["Polygon"]) for iFacet in sorted(self.DicoImager.keys()) ])
+
+    def _giveSpatialWeight(self, iFacet):
+        """Computes the spatial weight of a facet: its tessel mask, clipped to the image and smoothed"""
+        FacetInfo = self.DicoImager[iFacet]
+        Npix = FacetInfo["NpixFacetPadded"]
+        l0, l1, m0, m1 = FacetInfo["lmExtentPadded"]
+        polygons = [FacetInfo["Polygon"], self.CornersImageTot]
+
+        #NB: this spatial weighting is a bit arbitrary.... 
+        #it may be better to do something like Montage's background
+        #normalization (http://montage.ipac.caltech.edu/docs/algorithms.html#background)
+        # Gaussian of sigma 10, on the grid of ModFFTW.GiveGauss (of spacing Npix/(Npix-1))
+        Sig = 10.*(Npix-1)/Npix
+        runs = ModFacetMask.GiveConvexRuns(polygons, l0, l1, m0, m1, Npix)
+        if runs is not None:
+            sw = ModFacetMask.SmoothRuns(runs[0], runs[1], Sig)
+        else:
+            # not convex: FFT-convolve the mask
+            sw = np.float32(ModFacetMask.GiveFacetMask(polygons, l0, l1, m0, m1, Npix).reshape((1, 1, Npix, Npix)))
+            # already happening in parallel so make sure the FFT library doesn't spawn its own threads
+            sw = ModFFTW.ConvolveGaussian(shareddict = {"in": sw, "out": sw},
+                                          field_in = "in",
+                                          field_out = "out",
+                                          ch = 0,
+                                          CellSizeRad=1,
+                                          GaussPars_ch=(10, 10, 0))
+            sw = sw.reshape((Npix, Npix))
+        sw /= np.max(sw)
+        ## Will speedup degridding NB: will it?
+        sw[sw<1e-3] = 0.
+        return sw
+
+    def _initsw(self, iFacet, facet_dict, swpath, swvalid):
+        """Loads the spatial weight of a facet from the cache (if valid), or computes it and saves it to the cache"""
+        path = "%s/%s.npy" % (swpath, iFacet)
+        if swvalid:
+            try:
+                facet_dict["SW"] = np.load(path, mmap_mode="r")
+                return
+            except Exception as e:
+                print>>log, "Error loading %s (%s), will re-generate" % (path, e)
+        facet_dict["SW"] = sw = self._giveSpatialWeight(iFacet)
+        if swpath:
+            np.save(path, sw)
+
+    def _initcf_worker (self, iFacet, facet_dict, cachepath, cachevalid, wmax, swpath="", swvalid=False):
         """Worker method of InitParal"""
         path = "%s/%s.npz" % (cachepath, iFacet)
         T=ClassTimeIt.ClassTimeIt("_initcf_worker")
@@ -675,6 +754,12 @@ class ClassFacetMachine():
                 npzfile = np.load(file(path))
                 for key, value in npzfile.iteritems():
                     facet_dict[key] = value
+                # spatial weights are cached separately
+                if "SW" not in facet_dict:
+                    self._initsw(iFacet, facet_dict, swpath, swvalid)
+                # with a W-kernel library, the cache only holds the spatial weights: get the kernels from the library
+                if "W" not in facet_dict:
+                    self._createGridMachine(iFacet, cf_dict=facet_dict, compute_cf=True, wmax=facet_dict["wmax"])
                 # validate dict
                 ClassDDEGridMachine.ClassDDEGridMachine.verifyCFDict(facet_dict, self.GD["CF"]["Nw"])
                 return "cached",path,iFacet
@@ -684,42 +769,8 @@ class ClassFacetMachine():
                 print>>log, "Error loading %s, will re-generate"%path
                 facet_dict.delete()
         # ok, regenerate the terms at this point
-        FacetInfo = self.DicoImager[iFacet]
-        # Create smoothned facet tessel mask:
-        Npix = FacetInfo["NpixFacetPadded"]
-        l0, l1, m0, m1 = FacetInfo["lmExtentPadded"]
-        X, Y = np.mgrid[l0:l1:Npix * 1j, m0:m1:Npix * 1j]
-        XY = np.dstack((X, Y))
-        XY_flat = XY.reshape((-1, 2))
-        vertices = FacetInfo["Polygon"]
-        mpath = Path(vertices)  # the vertices of the polygon
-        mask_flat = mpath.contains_points(XY_flat)
-        mask = mask_flat.reshape(X.shape)
-        mpath = Path(self.CornersImageTot)
-        mask_flat2 = mpath.contains_points(XY_flat)
-        mask2 = mask_flat2.reshape(X.shape)
-        mask[mask2 == 0] = 0
-
-        #NB: this spatial weighting is a bit arbitrary.... 
-        #it may be better to do something like Montage's background
-        #normalization (http://montage.ipac.caltech.edu/docs/algorithms.html#background)
-        GaussPars = (10, 10, 0)
-
-        # compute spatial weight term
-        sw = np.float32(mask.reshape((1, 1, Npix, Npix)))
-
-        # already happening in parallel so make sure the FFT library doesn't spawn its own threads
-        sw = ModFFTW.ConvolveGaussian(shareddict = {"in": sw, "out": sw},
-                                      field_in = "in",
-                                      field_out = "out",
-                                      ch = 0,
-                                      CellSizeRad=1,
-                                      GaussPars_ch=GaussPars)
-        sw = sw.reshape((Npix, Npix))
-        sw /= np.max(sw)
-        ## Will speedup degridding NB: will it?
-        sw[sw<1e-3] = 0.
-        facet_dict["SW"] = sw
+        # Create smoothed facet tessel mask
+        self._initsw(iFacet, facet_dict, swpath, swvalid)
 
         # Initialize a grid machine per iFacet, this will implicitly compute wterm and Sphe
         self._createGridMachine(iFacet, cf_dict=facet_dict, compute_cf=True, wmax=wmax)
@@ -743,6 +794,11 @@ class ClassFacetMachine():
         if not self.IsDDEGridMachineInit:
             workers_res=APP.awaitJobResults("%s.InitCF.*"%self._app_id, progress="Init CFs")
             self._CF.reload()
+            if self.GD["CF"]["AdaptiveNw"]:
+                # the packed w-kernels start with their count: Nw planes and their conjugates
+                Nws = [ int(self._CF[iFacet]["W"][0].real)//2 for iFacet in self.DicoImager.iterkeys() ]
+                print>>log, "adaptive w-planes per facet: %d to %d, %d in total (vs %d with --CF-Nw %d)" % \
+                            (min(Nws), max(Nws), sum(Nws), len(Nws)*self.GD["CF"]["Nw"], self.GD["CF"]["Nw"])
             # mark cache as safe
             for res in workers_res:
                 Type,path,iFacet=res
@@ -751,9 +807,13 @@ class ClassFacetMachine():
                     facet_dict=self._CF[iFacet]
                     d={}
                     for key in facet_dict.keys():
-                        d[key]=facet_dict[key]
+                        # spatial weights are cached separately, and W-kernels already live in the W-kernel
+                        # library, if one is in use
+                        if key != "SW" and (key not in ModCF.WKERNEL_KEYS or not self.GD["Cache"]["CFLibrary"]):
+                            d[key]=facet_dict[key]
                     np.savez(file(path, "w"), **d)
             if self.GD["Cache"]["CF"]:
+                self.VS.maincache.saveCache(self._sw_cachename)
                 self.VS.maincache.saveCache(self._cf_cachename)
             self.IsDDEGridMachineInit = True
 
@@ -781,7 +841,11 @@ class ClassFacetMachine():
             **kw)
 
     def ToCasaImage(self, ImageIn, Fits=True, ImageName=None,
-                    beam=None, beamcube=None, Freqs=None, Stokes=["I"]):
+                    beam=None, beamcube=None, Freqs=None, Stokes=["I"], Stream=False):
+        """
+        Writes ImageIn to a FITS file. With Stream=True the image is written out plane by plane
+        straight from ImageIn (see ClassCasaimage.setdata), so no copy of the cube is made.
+        """
 
         if Freqs is None:
             # if we have a reference frequency, use it
@@ -792,7 +856,7 @@ class ClassFacetMachine():
         self.setCasaImage(ImageName=ImageName, Shape=ImageIn.shape,
                           Freqs=Freqs, Stokes=Stokes)
 
-        self.CasaImage.setdata(ImageIn, CorrT=True)
+        self.CasaImage.setdata(ImageIn, CorrT=True, Stream=Stream)
 
         if Fits:
             if beam is not None:
@@ -837,6 +901,9 @@ class ClassFacetMachine():
         self._model_dict["Image"] = ModelImage
         for iFacet in range(self.NFacets):
             self._model_dict.addSubdict(iFacet)
+        # any model grids computed previously are now stale
+        self._model_version += 1
+        self._model_grid_key = None
         return self._model_dict["Image"]
 
     def releaseModelImage(self):
@@ -844,6 +911,7 @@ class ClassFacetMachine():
         if self._model_dict is not None:
             self._model_dict.delete()
             self._model_dict = None
+        self._model_grid_key = None
 
     def _buildFacetSlice_worker(self, iFacet, facet_grids, facetdict, cfdict, sumjonesnorm, sumweights, W):
         # first normalize by spheroidals - these
@@ -882,7 +950,7 @@ class ClassFacetMachine():
         # weight each of the cube slices and average
         fd["MeanPSF"]  = np.sum(PSFChannel * W, axis=0).reshape((1, npol, n, n))
 
-    def _cutFacetSlice_worker(self, iFacet, DicoImages, nch, NPixMin):
+    def _cutFacetSlice_worker(self, DicoImages, nch, NPixMin, iFacet):
         psf = DicoImages["Facets"][iFacet]["PSF"]
         _, npol, n, n = psf.shape
         for ch in xrange(nch):
@@ -1028,9 +1096,10 @@ class ClassFacetMachine():
             #CubeMeanVariablePSF = np.zeros((NFacets, 1, npol, NPixMin, NPixMin), np.float32)
 
             print>>log, "cutting PSF facet-slices of shape %dx%d" % (NPixMin, NPixMin)
-            for iFacet in facets:
-                APP.runJob("cutpsf:%s" % iFacet, self._cutFacetSlice_worker, args=(iFacet, DicoImages.readonly(), nch, NPixMin))
-            APP.awaitJobResults("cutpsf:*", progress="Cut PSF facet slices")
+            # these are small jobs, so ship them in batches
+            APP.runJobBatch("cutpsf", self._cutFacetSlice_worker, args=(DicoImages.readonly(), nch, NPixMin),
+                            batch_args=[(iFacet,) for iFacet in facets])
+            APP.awaitJobBatch("cutpsf", progress="Cut PSF facet slices")
 
             DicoImages["CentralFacet"] = self.iCentralFacet
             DicoImages["MeanJonesBand"] = []
@@ -1232,6 +1301,11 @@ class ClassFacetMachine():
                 print>>log,ModColor.Str("The sum of the weights are zero for FreqBand #%i, data is all flagged?"%Channel)
                 print>>log,ModColor.Str("  (... will skip normalisation for this FreqBand)")
                 
+        # stitch in parallel, unless the facet images are not in shared memory (see e.g. giveRestoredFacets)
+        nstripes = min(self.GD["Parallel"]["StitchStripes"] or 2*APP.ncpu, NPixOut)
+        if nstripes > 1 and (kind == "Jones-amplitude" or self._hasSharedFacetGrids()):
+            return self._stitchFacetsParallel(kind, ChanSel, nstripes)
+
         pBAR = ProgressBar(Title="Glue facets")
         NFacets=len(self.DicoImager.keys())
         pBAR.render(0, NFacets)
@@ -1291,6 +1365,79 @@ class ClassFacetMachine():
 
         return Image
 
+    def _hasSharedFacetGrids(self):
+        """True if the facet images to be stitched are the shared facet grids"""
+        return self._facet_grids is not None and \
+               all([ self.DicoGridMachine[iFacet].get("Dirty") is self._facet_grids.get(iFacet)
+                     for iFacet in self.DicoImager.keys() ])
+
+    def _stitchFacetsParallel(self, kind, ChanSel, nstripes):
+        """
+        Parallel version of FacetsToIm_Channel. The output image is split into stripes of rows, and each stripe
+        is stitched by a job, from the facets overlapping it, directly into a shared image.
+        """
+        NPixOut = self.OutImShape[-1]
+        stitch_dict = shared_dict.create("%s_Stitch" % self._app_id)
+        Image = stitch_dict.addSharedArray("Image", self.OutImShape, self.stitchedType)
+        facets = []
+        for iFacet in sorted(self.DicoImager.keys()):
+            xc, yc = self.DicoImager[iFacet]["pixCentral"]
+            NpixFacet = self.DicoImager[iFacet]["NpixFacetPadded"]
+            Aedge, Bedge = GiveEdges((xc, yc), NPixOut, (NpixFacet/2, NpixFacet/2), NpixFacet)
+            facets.append((iFacet, Aedge, Bedge,
+                           self.DicoImager[iFacet]["SumWeights"], self.DicoImager[iFacet]["SumJonesNorm"]))
+        grids = self._facet_grids.readonly() if kind != "Jones-amplitude" else None
+        edges = np.linspace(0, NPixOut, nstripes+1).astype(int)
+        for istripe in xrange(nstripes):
+            x0, x1 = edges[istripe], edges[istripe+1]
+            overlapping = [ facet for facet in facets if facet[1][0] < x1 and facet[1][1] > x0 ]
+            APP.runJob("%s.stitch:%d" % (self._app_id, istripe), self._stitchStripe_worker,
+                       args=(x0, x1, kind, ChanSel, stitch_dict.readwrite(), grids, self._CF.readonly(),
+                             self._norm_dict.readonly(), overlapping))
+        APP.awaitJobResults("%s.stitch:*" % self._app_id, progress="Glue facets")
+        # the array stays mapped after its shared memory is released
+        stitch_dict.delete()
+        return Image
+
+    def _stitchStripe_worker(self, x0, x1, kind, ChanSel, stitch_dict, grid_dict, cf_dict, norm_dict, facets):
+        """Worker method of _stitchFacetsParallel. Stitches the given facets into rows x0:x1 of the output image."""
+        Image = stitch_dict["Image"]
+        npol = Image.shape[1]
+        for iFacet, Aedge, Bedge, SumWeights, SumJonesNorm in facets:
+            x0main, x1main, y0main, y1main = Aedge
+            x0facet, x1facet, y0facet, y1facet = Bedge
+            # rows of the facet that fall into the stripe
+            ox0, ox1 = max(x0main, x0), min(x1main, x1)
+            if ox0 >= ox1:
+                continue
+            fx0 = x0facet + ox0 - x0main
+            fx1 = fx0 + ox1 - ox0
+            SpacialWeigth = cf_dict[iFacet]["SW"].T[::-1, :]
+            N = SpacialWeigth.shape[0]
+            # facets are flipped and transposed into the image (see FacetsToIm_Channel), so the block that goes
+            # into the stripe is facet[N-y1facet:N-y0facet, fx0:fx1][::-1, :].T
+            block = slice(N-y1facet, N-y0facet), slice(fx0, fx1)
+            SW = SpacialWeigth[block]
+            if kind != "Jones-amplitude":
+                SPhe = cf_dict[iFacet]["Sphe"][block]
+                InvSPhe = cf_dict[iFacet]["InvSphe"][block]
+                grid = grid_dict[iFacet]
+            for Channel in ChanSel:
+                for pol in xrange(npol):
+                    if kind == "Jones-amplitude":
+                        Im = SW * SumJonesNorm[Channel]
+                    else:
+                        Im = grid[Channel, pol][block].real.copy()
+                        Im *= InvSPhe
+                        Im *= SW
+                        Im /= SumWeights[Channel][pol]*np.sqrt(SumJonesNorm[Channel])
+                        Im[SPhe < 1e-3] = 0
+                    Image[Channel, pol, ox0:ox1, y0main:y1main] += np.real(Im[::-1, :].T)
+        FacetNorm = norm_dict["FacetNorm"][x0:x1]
+        for Channel in ChanSel:
+            for pol in xrange(npol):
+                Image[Channel, pol, x0:x1] /= FacetNorm
+
     # def GiveNormImage(self):
     #     """
     #     Creates a stitched normalization image of the grid-correction function.
@@ -1372,7 +1519,51 @@ class ClassFacetMachine():
             #DATA["Sparsification.Degrid"] = numpy.random.sample(num_blocks) < 1.0 / factor
             #print>> log, "applying sparsification factor of %f to %d BDA degrid blocks, left with %d" % (factor, num_blocks, DATA["Sparsification.Degrid"].sum())
 
-    def _grid_worker(self, iFacet, DATA, cf_dict, griddict):
+    def _giveDicoJonesMatrices(self, DATA, jones_table=None):
+        """Returns the Jones matrices dict the GridMachine wants for a chunk, or None if no Jones are applied"""
+        Apply_killMS = self.GD["DDESolutions"]["DDSols"]
+        Apply_Beam = self.GD["Beam"]["Model"] is not None
+        if not (Apply_killMS or Apply_Beam):
+            return None
+        DicoJonesMatrices = {}
+        if Apply_killMS:
+            DicoJonesMatrices["DicoJones_killMS"] = DATA["killMS"]
+        if Apply_Beam:
+            DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
+        if jones_table is not None and jones_table in DATA:
+            DicoJonesMatrices["JonesTable"] = DATA[jones_table]
+        return DicoJonesMatrices
+
+    def _makeJonesTable(self, DATA, degrid=False):
+        """
+        Precomputes the chunk's Jones matrices for all our facets into DATA (see --DDESolutions-JonesTable),
+        unless already done. Returns the name of the DATA entry, or None if facets compute their own Jones.
+        """
+        if not self.GD["DDESolutions"]["JonesTable"] or self._jones_table_disabled:
+            return None
+        if (self.GD["RIME"]["ForwardMode"] != "BDA-degrid") if degrid else (self.GD["RIME"]["BackwardMode"] != "BDA-grid"):
+            return None
+        DicoJonesMatrices = self._giveDicoJonesMatrices(DATA)
+        if DicoJonesMatrices is None:
+            return None
+        name = "JonesTable.%s.%s" % ("Degrid" if degrid else "Grid", self._app_id)
+        if name in DATA:
+            return name
+        tables = ClassDDEGridMachine.BuildJonesTables(self.GD, DicoJonesMatrices,
+                    [ self.DicoImager[iFacet]["lmShift"] for iFacet in self.DicoImager.keys() ], degridder=degrid)
+        if tables is None:
+            print>>log, ModColor.Str("--DDESolutions-JonesTable does not support Krigging interpolation, amplitude "
+                                     "scaling or different antennas in beam and DD solutions, ignoring it")
+            self._jones_table_disabled = True
+            return None
+        subdict = DATA.addSubdict(name)
+        for key, value in tables.iteritems():
+            subdict[key] = value
+        print>>log, "precomputed Jones table for %d (killMS, beam) directions, %d time intervals, %d channel blocks" % (
+                        (len(tables)-2)/2, tables["TimeMapping"].max()+1, tables["ChanMapping"].max()+1)
+        return name
+
+    def _grid_worker(self, iFacet, DATA, cf_dict, griddict, nthreads=1, jones_table=None):
         T = ClassTimeIt.ClassTimeIt()
         T.disable()
 
@@ -1416,25 +1607,19 @@ class ClassFacetMachine():
         #     GridMachine.setDecorr(uvw_dt, DT, Dnu, SmearMode=DecorrMode)
 
         # Create Jones Matrices Dictionary
-        DicoJonesMatrices = None
-        Apply_killMS = self.GD["DDESolutions"]["DDSols"]
-        Apply_Beam = self.GD["Beam"]["Model"] is not None
-
-        if Apply_killMS or Apply_Beam:
-            DicoJonesMatrices = {}
-        if Apply_killMS:
-            DicoJonesMatrices["DicoJones_killMS"] = DATA["killMS"]
-        if Apply_Beam:
-            DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
-
-        GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
-                        DoNormWeights=False,
-                        DicoJonesMatrices=DicoJonesMatrices,
-                        freqs=freqs, DoPSF=self.DoPSF,
-                        ChanMapping=ChanMapping,
-                        ResidueGrid=griddict[iFacet],
-                        sparsification=DATA.get("Sparsification.Grid")
-                        )
+        DicoJonesMatrices = self._giveDicoJonesMatrices(DATA, jones_table)
+
+        # a multithreaded gridder needs more than the one core this worker is pinned to
+        with APP.allWorkerCores(nthreads > 1):
+            GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
+                            DoNormWeights=False,
+                            DicoJonesMatrices=DicoJonesMatrices,
+                            freqs=freqs, DoPSF=self.DoPSF,
+                            ChanMapping=ChanMapping,
+                            ResidueGrid=griddict[iFacet],
+                            sparsification=DATA.get("Sparsification.Grid"),
+                            nthreads=nthreads
+                            )
         T.timeit("put %s" % iFacet)
 
         T.timeit("Grid")
@@ -1460,15 +1645,19 @@ class ClassFacetMachine():
         self._grid_iMS, self._grid_iChunk = DATA["iMS"], DATA["iChunk"]
         self._grid_job_label = DATA["label"]
         self._grid_job_id = "%s.Grid.%s:" % (self._app_id, self._grid_job_label)
+        nrows = DATA["uvw"].shape[0]
+        jones_table = self._makeJonesTable(DATA)
         for iFacet in self.DicoImager.keys():
             APP.runJob("%sF%d" % (self._grid_job_id, iFacet), self._grid_worker,
                             args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  self._facet_grids.readonly()))
+                                  self._facet_grids.readonly(), self._facetGridThreads(iFacet), jones_table),
+                            cost=self._facetJobCost(iFacet)*nrows)
+        APP.flushJobs()
 
     # ##############################################
     # ##### Smooth beam ############################
-    def _SmoothAverageBeam_worker(self, DATA, iDir):
-        self.AverageBeamMachine.StackBeam(DATA, iDir)
+    def _SmoothAverageBeam_worker(self, DATA, iDirs):
+        self.AverageBeamMachine.StackBeam(DATA, iDirs)
 
     def StackAverageBeam(self, DATA):
         # the FacetMachinePSF does not have an AverageBeamMachine
@@ -1485,10 +1674,12 @@ class ClassFacetMachine():
         # run new set of jobs
         self._smooth_job_label=DATA["label"]
         JobName="StackBeam%sF"%self._smooth_job_label
-        for iDir in range(self.AverageBeamMachine.NDir):
-            APP.runJob("%s%d" % (JobName,iDir), 
+        # each job stacks a block of directions at once
+        NDir=self.AverageBeamMachine.NDir
+        for iBlock,iDirs in enumerate(np.array_split(np.arange(NDir), min(NDir, APP.ncpu))):
+            APP.runJob("%s%d" % (JobName,iBlock), 
                        self._SmoothAverageBeam_worker,
-                       args=(DATA.readonly(), iDir))
+                       args=(DATA.readonly(), iDirs.tolist()))
 
 
     def finaliseSmoothBeam(self):
@@ -1598,7 +1789,8 @@ class ClassFacetMachine():
         for iFacet in self.DicoImager.keys():
             APP.runJob("%sF%d" % (self._fft_job_id, iFacet), self._fft_worker,
                             args=(iFacet, self._CF[iFacet].readonly(), self._facet_grids.readonly()),
-                            )
+                            cost=self._facetJobCost(iFacet))
+        APP.flushJobs()
         # APP.awaitJobResults(self._fft_job_id+"*", progress=("FFT PSF" if self.DoPSF else "FFT"))
 
     def collectFourierTransformResults (self):
@@ -1623,7 +1815,25 @@ class ClassFacetMachine():
             model_dict[iFacet]["FacetGrid"] = ModelGrid
         return ModelGrid
 
-    def set_model_grid (self,ToGrid=True,ApplyNorm=True):
+    def _set_degrid_model_grid_worker(self, iFacet, model_dict, cf_dict, ChanSel):
+        """Computes the Fourier-transformed model grid of a facet, exactly as _degrid_worker would,
+        and stores it in the model dict, for reuse by the degridders of all subsequent chunks."""
+        ModelIm = self._set_model_grid_worker(iFacet, model_dict, cf_dict, ChanSel)
+        GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict)
+        Grid = GridMachine.modelImageToGrid(ModelIm)
+        # an empty facet is marked as such, and not degridded at all
+        model_dict[iFacet]["Empty"] = Grid is None
+        if Grid is not None:
+            model_dict[iFacet]["DegridGrid"] = Grid
+        return {"iFacet": iFacet}
+
+    def set_model_grid (self,ToGrid=True,ApplyNorm=True,ChanSel=None,Degrid=False):
+        """Computes per-facet model grids from the current model image, and stores them in the model dict.
+
+        If Degrid=True, the grids are the FFT'd facet models expected by the degridder (ToGrid and ApplyNorm
+        are then ignored). Grids are only recomputed if the model image (see setModelImage()), the channel
+        selection or the grid kind has changed since the last call, so calling this once per chunk is cheap.
+        """
         self.awaitInitCompletion()
 
         #modeldict_path=self._model_dict.path
@@ -1632,18 +1842,33 @@ class ClassFacetMachine():
 
         # create FacetNorm in shared dict if not exist
         self.BuildFacetNormImage()
-        nch,_,_,_=self._model_dict["Image"].shape
-        ChanSel=range(nch)
+        if ChanSel is None:
+            nch,_,_,_=self._model_dict["Image"].shape
+            ChanSel=range(nch)
         ToSHMDict=True
-        
+
+        # grids already computed for this model?
+        grid_key = (self._model_version, bool(Degrid), ToGrid, ApplyNorm, tuple(ChanSel))
+        if grid_key == self._model_grid_key:
+            return
+        self._model_grid_key = None
+
         self._set_model_grid_job_id = "%s.MakeGridModel:" % (self._app_id)
         
         for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._set_model_grid_job_id, iFacet), 
-                       self._set_model_grid_worker,
-                       args=(iFacet, self._model_dict.readwrite(), self._CF[iFacet].readonly(),
-                             ChanSel,ToSHMDict,ToGrid,ApplyNorm))
+            if Degrid:
+                APP.runJob("%sF%d" % (self._set_model_grid_job_id, iFacet),
+                           self._set_degrid_model_grid_worker,
+                           args=(iFacet, self._model_dict.readwrite(), self._CF[iFacet].readonly(), ChanSel),
+                           cost=self._facetJobCost(iFacet))
+            else:
+                APP.runJob("%sF%d" % (self._set_model_grid_job_id, iFacet),
+                           self._set_model_grid_worker,
+                           args=(iFacet, self._model_dict.readwrite(), self._CF[iFacet].readonly(),
+                                 ChanSel,ToSHMDict,ToGrid,ApplyNorm),
+                           cost=self._facetJobCost(iFacet))
         APP.awaitJobResults(self._set_model_grid_job_id + "*", progress="Make model grids")
+        self._model_grid_key = grid_key
 
 
     # #####################################################"
@@ -1729,8 +1954,14 @@ class ClassFacetMachine():
     # #####################################################"
 
     # DeGrid worker that is called by Multiprocessing.Process
-    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict):
-        ModelGrid = self._set_model_grid_worker(iFacet, modeldict, cf_dict, ChanSel)
+    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict, cached_grid=False, jones_table=None):
+        if cached_grid:
+            # model grid precomputed by set_model_grid(Degrid=True)
+            if modeldict[iFacet]["Empty"]:
+                return {"iFacet": iFacet}
+            ModelGrid, TranformModelInput = modeldict[iFacet]["DegridGrid"], ""
+        else:
+            ModelGrid, TranformModelInput = self._set_model_grid_worker(iFacet, modeldict, cf_dict, ChanSel), "FT"
 
         # Create a new GridMachine
         GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict,
@@ -1749,16 +1980,7 @@ class ClassFacetMachine():
         ChanMapping = DATA["ChanMappingDegrid"]
 
         # Create Jones Matrices Dictionary
-        DicoJonesMatrices = None
-        Apply_killMS = self.GD["DDESolutions"]["DDSols"]
-        Apply_Beam = self.GD["Beam"]["Model"] is not None
-
-        if Apply_killMS or Apply_Beam:
-            DicoJonesMatrices = {}
-        if Apply_killMS:
-            DicoJonesMatrices["DicoJones_killMS"] = DATA["killMS"]
-        if Apply_Beam:
-            DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
+        DicoJonesMatrices = self._giveDicoJonesMatrices(DATA, jones_table)
 
         DecorrMode = self.GD["RIME"]["DecorrMode"]
         if 'F' in DecorrMode or "T" in DecorrMode:
@@ -1775,7 +1997,7 @@ class ClassFacetMachine():
         GridMachine.get(times, uvwThis, visThis, flagsThis, A0A1,
                           ModelGrid, ImToGrid=False,
                           DicoJonesMatrices=DicoJonesMatrices,
-                          freqs=freqs, TranformModelInput="FT",
+                          freqs=freqs, TranformModelInput=TranformModelInput,
                           ChanMapping=ChanMapping,
                           sparsification=DATA.get("Sparsification.Degrid")
                         )
@@ -1807,13 +2029,22 @@ class ClassFacetMachine():
         # create FacetNorm in shared dict if not exist
         self.BuildFacetNormImage()
 
+        # make (or reuse) the FFT'd model grids of the current model image, if caching them
+        cached_grid = bool(self.GD["Cache"]["ModelGrids"])
+        if cached_grid:
+            self.set_model_grid(ChanSel=ChanSel, Degrid=True)
+
         self._degrid_job_label = DATA["label"]
         self._degrid_job_id = "%s.Degrid.%s:" % (self._app_id, self._degrid_job_label)
 
+        nrows = DATA["uvw"].shape[0]
+        jones_table = self._makeJonesTable(DATA, degrid=True)
         for iFacet in self.DicoImager.keys():
             APP.runJob("%sF%d" % (self._degrid_job_id, iFacet), self._degrid_worker,
                             args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  ChanSel, self._model_dict.readonly()))#,serial=True)
+                                  ChanSel, self._model_dict.readonly(), cached_grid, jones_table),
+                            cost=self._facetJobCost(iFacet)*nrows)#,serial=True)
+        APP.flushJobs()
         #APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
 
 
@@ -40,7 +40,7 @@ from DDFacet.Other import ModColor
 import tables
 
 from DDFacet.Imager.ClassImToGrid import ClassImToGrid
-from matplotlib.path import Path
+from DDFacet.ToolsDir import ModFacetMask
 from SkyModel.Sky import ModVoronoiToReg
 import Polygon
 from DDFacet.ToolsDir import rad2hmsdms
@@ -569,16 +569,8 @@ class ClassFacetMachineTessel(ClassFacetMachine.ClassFacetMachine):
             Npix = self.DicoImager[iFacet]["NpixFacetPadded"]
             l0, l1, m0, m1 = self.DicoImager[iFacet]["lmExtentPadded"]
             X, Y = np.mgrid[l0:l1:Npix/10 * 1j, m0:m1:Npix/10 * 1j]
-            XY = np.dstack((X, Y))
-            XY_flat = XY.reshape((-1, 2))
             vertices = self.DicoImager[iFacet]["Polygon"]
-            mpath = Path(vertices)  # the vertices of the polygon
-            mask_flat = mpath.contains_points(XY_flat)
-            mask = mask_flat.reshape(X.shape)
-            mpath = Path(self.CornersImageTot)
-            mask_flat2 = mpath.contains_points(XY_flat)
-            mask2 = mask_flat2.reshape(X.shape)
-            mask[mask2 == 0] = 0
+            mask = ModFacetMask.GiveFacetMask([vertices, self.CornersImageTot], l0, l1, m0, m1, Npix/10)
             R=np.sqrt(X**2+Y**2)
             R[mask==0]=1e6
             indx,indy=np.where(R==np.min(R))
@@ -23,11 +23,67 @@ from DDFacet.Other import ModColor
 log=MyLogger.getLogger("MaskMachine")
 from pyrap.images import image
 import scipy.special
+import scipy.ndimage
 import copy
 from DDFacet.Imager.ModModelMachine import ClassModModelMachine
 
 from DDFacet.ToolsDir import ModFFTW
 
+def GiveMinStatNoise(Acopy,SBox,ratio,Previous=None,Th=0.):
+    """
+    Min-filter noise estimate of the (decimated) image Acopy, -minimum_filter(Acopy,SBox)/ratio, and the noise floor
+    NoiseMed (the std of the noise map). Returns Noise,NoiseMed,State. If the State returned by a previous call on an
+    image of the same shape is passed as Previous, the estimate is updated incrementally (see _updateMinStatNoise()),
+    Previous is updated in place, and NoiseMed is carried forward.
+    """
+    if Previous is not None:
+        if _updateMinStatNoise(Acopy,SBox,ratio,Previous,Th):
+            return Previous["Noise"].copy(),Previous["NoiseMed"],Previous
+    Noise=-scipy.ndimage.filters.minimum_filter(Acopy,SBox)/ratio
+    NPixStats=10000
+    IndStats=np.int64(np.linspace(0,Noise.size-1,NPixStats))
+    NoiseMed=np.std(Noise.ravel()[IndStats])
+    #NoiseMed=np.median(Noise)
+    return Noise,NoiseMed,dict(Image=Acopy.copy(),Noise=Noise.copy(),NoiseMed=NoiseMed,SBox=SBox)
+
+def _updateMinStatNoise(Acopy,SBox,ratio,Previous,Th):
+    """
+    Incremental version of the min-filter noise estimate: the (decimated) image is cut into tiles of the box
+    size, and the minimum filter is only rerun over tiles that have a changed pixel within one box of them.
+    Since the filter footprint is one box, the recomputed tiles come out as if the whole image had been filtered.
+
+    A pixel has changed if it is more than Th*NoiseMed away from Previous["Image"], which holds, for each tile, the
+    image the tile was last filtered with: only the recomputed tiles are updated in Previous["Image"] (and
+    Previous["Noise"]), so that changes below the threshold add up until they trigger a recompute, rather than
+    being forgotten. Returns False, leaving Previous alone, if most tiles need recomputing.
+    """
+    Noise,Reference=Previous["Noise"],Previous["Image"]
+    Changed=np.abs(Acopy-Reference)>Th*Previous["NoiseMed"]
+    nx,ny=Acopy.shape
+    tx,ty=max(SBox[0],1),max(SBox[1],1)
+    ntx,nty=(nx+tx-1)/tx,(ny+ty-1)/ty
+    # tiles with changed pixels, then grown by one tile to account for the filter footprint
+    ChangedPad=np.zeros((ntx*tx,nty*ty),np.bool8)
+    ChangedPad[:nx,:ny]=Changed
+    DirtyTiles=ChangedPad.reshape((ntx,tx,nty,ty)).any(axis=3).any(axis=1)
+    DirtyTiles=scipy.ndimage.binary_dilation(DirtyTiles,structure=np.ones((3,3),np.bool8))
+    NDirty=np.count_nonzero(DirtyTiles)
+    print>>log, "  Updating noise map in %i/%i tiles"%(NDirty,DirtyTiles.size)
+    if NDirty>DirtyTiles.size/2:
+        return False
+    hx,hy=SBox[0]/2+1,SBox[1]/2+1
+    for itx,ity in zip(*np.where(DirtyTiles)):
+        x0,x1=itx*tx,min((itx+1)*tx,nx)
+        y0,y1=ity*ty,min((ity+1)*ty,ny)
+        # filter the tile plus a halo; at the image edges the halo is cut, as is the full image
+        X0,X1=max(x0-hx,0),min(x1+hx,nx)
+        Y0,Y1=max(y0-hy,0),min(y1+hy,ny)
+        Sub=scipy.ndimage.filters.minimum_filter(Acopy[X0:X1,Y0:Y1],SBox)
+        Noise[x0:x1,y0:y1]=-Sub[x0-X0:x1-X0,y0-Y0:y1-Y0]/ratio
+        Reference[x0:x1,y0:y1]=Acopy[x0:x1,y0:y1]
+    return True
+
+
 class ClassImageNoiseMachine():
     def __init__(self, GD, ExternalModelMachine=None, DegridFreqs=None, GridFreqs=None, MainCache=None):
         self.GD = copy.deepcopy(GD)
@@ -37,6 +93,9 @@ class ClassImageNoiseMachine():
         self.NoiseMapRestored=None
         self.NoiseMapReShape=None
         self._id_InputMap=None
+        # state kept between calls in incremental mode (see giveMinStatNoiseMap and giveBrutalRestored)
+        self._MinStatPrevious=None
+        self._BrutalInitPSF=None
         self.ExternalModelMachine=ExternalModelMachine
         self.DegridFreqs = DegridFreqs
         self.GridFreqs = GridFreqs
@@ -121,12 +180,13 @@ class ClassImageNoiseMachine():
         F=1.-(1.-f)**n
         ratio=np.abs(np.interp(0.5,F,x))
 
-        Noise=-scipy.ndimage.filters.minimum_filter(Acopy,SBox)/ratio
-
-        NPixStats=10000
-        IndStats=np.int64(np.linspace(0,Noise.size-1,NPixStats))
-        NoiseMed=np.std(Noise.ravel()[IndStats])
-        #NoiseMed=np.median(Noise)
+        Previous=self._MinStatPrevious
+        if not self.GD["Noise"]["Incremental"] or Previous is None or \
+                Previous["Image"].shape!=Acopy.shape or Previous["SBox"]!=SBox:
+            Previous=None
+        Noise,NoiseMed,Previous=GiveMinStatNoise(Acopy,SBox,ratio,Previous,self.GD["Noise"]["IncrementalTh"])
+        if self.GD["Noise"]["Incremental"]:
+            self._MinStatPrevious=Previous
         Noise[Noise<NoiseMed]=NoiseMed
 
         LargeNoise=np.zeros_like(Image[0,0])
@@ -185,8 +245,16 @@ class ClassImageNoiseMachine():
             print>>log,"Deconvolving on SNR map"
             self.DeconvMachine.RMSFactor = 0
             
-        self.DeconvMachine.Init(PSFVar=self.DicoVariablePSF,PSFAve=self.DicoVariablePSF["EstimatesAvgPSF"][-1],
-                                GridFreqs=self.GridFreqs, DegridFreqs=self.DegridFreqs, RefFreq=self.RefFreq)
+        # in incremental mode, the machine (and its model) is kept from the previous call, unless the PSF has changed
+        Incremental=self.GD["Noise"]["Incremental"]
+        if Incremental and self._BrutalInitPSF is self.DicoVariablePSF:
+            print>>log,"  Reusing brutal deconvolution machine and model from previous cycle"
+        else:
+            if self._BrutalInitPSF is not None:
+                self.DeconvMachine.Reset()
+            self.DeconvMachine.Init(PSFVar=self.DicoVariablePSF,PSFAve=self.DicoVariablePSF["EstimatesAvgPSF"][-1],
+                                    GridFreqs=self.GridFreqs, DegridFreqs=self.DegridFreqs, RefFreq=self.RefFreq)
+            self._BrutalInitPSF=self.DicoVariablePSF if Incremental else None
 
         if self.NoiseMapReShape is not None:
             self.DeconvMachine.setNoiseMap(self.NoiseMapReShape,PNRStop=self.GD["Mask"]["SigTh"])
@@ -273,6 +341,7 @@ class ClassImageNoiseMachine():
         self.DicoDirty["ImageCube"][...]=self.Orig_Dirty[...]
 
 
-        self.DeconvMachine.Reset()
+        if not Incremental:
+            self.DeconvMachine.Reset()
         #MyLogger.setLoud(ListSilentModules)
         return self.Restored
@@ -617,23 +617,20 @@ class DDFacetSourceProvider(SourceProvider):
         ntime = times.shape[0]
         
         if pol_type == "linear":
-            XRcorr = point_sol.offset_XX
-            YLcorr = point_sol.offset_YY
+            corrs = ["XX", "YY"]
         elif pol_type == "circular":
-            XRcorr = point_sol.offset_RR
-            YLcorr = point_sol.offset_LL
+            corrs = ["RR", "LL"]
         else:
             raise ValueError("Invalid polarisation type %s. This is a bug" % pol_type)      
         
         nchan = self._manager._nchan
         
         # corrrection is in powerbeam centre so take the average between XX and YY offsets in RA and DEC
-        point_errors = np.empty((times.shape[0], nstations, nchan, 2), dtype=context.dtype)
-        for a, station_name in enumerate(self._manager._station_names):
-            data =  ((XRcorr(station_name, times) + YLcorr(station_name, times)) / 2).T
-            assert data.shape == (ntime, 2)
-            data_chan = np.tile(data, (1, 1, nchan)).reshape(ntime, nchan, 2) 
-            point_errors[:, a, :, :] = np.deg2rad(data_chan) 
+        # offsets of all stations come out of one call, as [ncorr, na, ntime, 2]
+        data = point_sol.offsets(self._manager._station_names, times, corrs).mean(axis=0)
+        assert data.shape == (nstations, ntime, 2)
+        point_errors = np.empty((ntime, nstations, nchan, 2), dtype=context.dtype)
+        point_errors[...] = np.deg2rad(data.transpose((1, 0, 2)))[:, :, np.newaxis, :]
         
         return point_errors
 
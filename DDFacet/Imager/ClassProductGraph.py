@@ -0,0 +1,248 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import collections
+from DDFacet.Other import MyLogger
+from DDFacet.Other.AsyncProcessPool import APP
+from DDFacet.ToolsDir import ModFFTW
+
+log = MyLogger.getLogger("ClassProductGraph")
+
+
+class ClassProductGraph(object):
+    """
+    Builds a set of image products (e.g. the outputs of ClassDeconvMachine.Restore) following their dependencies.
+
+    Products are held in a SharedDict. Each product is either:
+        - an external image, already held in some other SharedDict (addExternal)
+        - another name for an existing product (addAlias)
+        - computed in the main process from its dependencies (addImage)
+        - a Gaussian convolution of another product, done by one APP job per channel (addConvolution)
+    Products are only made if something that is saved needs them, and each one is made once. Build() submits
+    convolutions ahead of the saves that need them, so that independent convolutions run in parallel on the
+    workers, then saves the requested products in order as they become available. The FITS writes go to the I/O
+    queue and overlap with whatever is still being computed. A product is deleted from the SharedDict (again via the
+    I/O queue, hence after its own save) once all the products that depend on it have been made.
+
+    To bound memory use, convolutions are submitted ahead only while the convolved products held in the SharedDict
+    (i.e. started and not yet deleted) add up to at most max_planes image planes. By default, this is the plane
+    count of the largest convolved product seen so far (and at least 2), so that a cube is convolved on its own,
+    and single images a couple at a time.
+    """
+    def __init__(self, images, name="products", max_planes=None):
+        self.images = images
+        self.name = name
+        self.max_planes = max_planes
+        self._largest = 2
+        self._nodes = collections.OrderedDict()
+        # labels of products that have been started, and job specs of those still being made by jobs
+        self._started = set()
+        self._pending = {}
+        # number of products yet to be made from a given product, and products already deleted
+        self._users = collections.defaultdict(int)
+        self._released = set()
+
+    def _add(self, label, kind, deps=(), **kw):
+        if label in self._nodes:
+            raise KeyError("product %s is already defined" % label)
+        for dep in deps:
+            if dep not in self._nodes:
+                raise KeyError("product %s depends on undefined product %s" % (label, dep))
+        self._nodes[label] = dict(kind=kind, deps=list(deps), **kw)
+
+    def addExternal(self, label, sd, field):
+        """Adds a product that already exists as field in SharedDict sd. These are never deleted."""
+        self._add(label, "external", sd=sd, field=field)
+
+    def addAlias(self, label, target):
+        """Adds a product that is the same image as product target"""
+        self._add(label, "alias", deps=[target])
+
+    def addImage(self, label, func, deps=()):
+        """
+        Adds a product computed in the main process as func(*deps). func returns the image, which is then put into
+        the SharedDict unless func has already done so itself (e.g. via addSharedArray).
+        """
+        self._add(label, "image", deps=deps, func=func)
+
+    def addConvolution(self, label, dep, CellSizeRad, GaussPars, dtype=None):
+        """
+        Adds a product made by convolving product dep (which must be held in our own SharedDict) with Gaussians.
+        GaussPars gives the Gaussian parameters per channel of dep.
+        """
+        self._add(label, "convolve", deps=[dep], CellSizeRad=CellSizeRad, GaussPars=GaussPars, dtype=dtype)
+
+    def location(self, label):
+        """Returns the SharedDict and field holding product label"""
+        node = self._nodes[label]
+        if node["kind"] == "external":
+            return node["sd"], node["field"]
+        if node["kind"] == "alias":
+            return self.location(node["deps"][0])
+        return self.images, label
+
+    def _isReady(self, label):
+        return label in self._started and label not in self._pending
+
+    def _start(self, label, wait=True):
+        """
+        Starts making product label, making its dependencies first. If wait is False, does nothing (and returns False)
+        when a dependency is still being made by jobs. Returns True once the product has been started.
+        """
+        if label in self._started:
+            return True
+        node = self._nodes[label]
+        for dep in node["deps"]:
+            if wait:
+                self.get(dep)
+            elif not self._start(dep, wait=False) or not self._isReady(dep):
+                return False
+        kind = node["kind"]
+        if kind == "image":
+            image = node["func"](*[ self.get(dep) for dep in node["deps"] ])
+            if label not in self.images:
+                self.images[label] = image
+        elif kind == "convolve":
+            sd, field = self.location(node["deps"][0])
+            if sd is not self.images:
+                raise ValueError("input %s of convolution %s is not held in %s" % (field, label, self.name))
+            image = sd[field]
+            self.images.addSharedArray(label, image.shape, node["dtype"] or image.dtype)
+            jobid = "%s:convolve:%s:" % (self.name, label)
+            sd_rw = self.images.readwrite()
+            for ch in range(image.shape[0]):
+                APP.runJob(jobid+str(ch), ModFFTW._convolveSingleGaussianFFTW_noret,
+                           args=(sd_rw, field, label, ch, node["CellSizeRad"], node["GaussPars"][ch], None, False))
+            self._pending[label] = jobid+"*"
+        self._started.add(label)
+        if label not in self._pending:
+            self._made(label)
+        return True
+
+    def _made(self, label):
+        """Called once product label is complete. Aliases hold on to their target until they are released themselves."""
+        node = self._nodes[label]
+        if node["kind"] != "alias":
+            for dep in node["deps"]:
+                self._unuse(dep)
+
+    def _unuse(self, label):
+        self._users[label] -= 1
+        if self._users[label] <= 0:
+            self._release(label)
+
+    def _release(self, label):
+        if label in self._released:
+            return
+        self._released.add(label)
+        node = self._nodes[label]
+        if node["kind"] == "alias":
+            for dep in node["deps"]:
+                self._unuse(dep)
+        elif node["kind"] != "external" and label in self.images:
+            APP.runJob("%s:del:%s" % (self.name, label), _delImage_worker, io=0,
+                       args=(self.images.readwrite(), label))
+
+    def get(self, label):
+        """Returns product label, making it (and waiting for its jobs) if needed"""
+        self._start(label)
+        jobspec = self._pending.pop(label, None)
+        if jobspec is not None:
+            APP.awaitJobResults(jobspec)
+            self._made(label)
+        sd, field = self.location(label)
+        return sd[field]
+
+    def _closure(self, labels):
+        """Returns all products needed to make the given ones, in dependency order"""
+        order = []
+        def visit(label):
+            if label in order:
+                return
+            for dep in self._nodes[label]["deps"]:
+                visit(dep)
+            order.append(label)
+        for label in labels:
+            visit(label)
+        return order
+
+    def Build(self, saves, save_handler):
+        """
+        Makes and saves products. saves is a list of (label, kwargs) tuples: each product is saved by an I/O job
+        calling save_handler(sd, field, **kwargs). Returns once everything has been submitted; the caller awaits
+        the "<name>:save:*" and "<name>:del:*" jobs.
+        """
+        saves = [ (label, kwargs) for label, kwargs in saves if label in self._nodes ]
+        needed = self._closure([ label for label, _ in saves ])
+        for label in needed:
+            for dep in self._nodes[label]["deps"]:
+                self._users[dep] += 1
+        for label, _ in saves:
+            self._users[label] += 1
+        print>>log, "making %d image products to save %d of them" % (len(needed), len(saves))
+        convolutions = [ label for label in needed if self._nodes[label]["kind"] == "convolve" ]
+        # submit convolutions ahead, so that they run in parallel. Other products are only made when they are
+        # about to be saved (or are needed by a convolution), to limit memory use.
+        self._startConvolutions(convolutions)
+        for label, kwargs in saves:
+            self.get(label)
+            sd, field = self.location(label)
+            APP.runJob("%s:save:%s" % (self.name, label), save_handler, io=0, args=(sd.readonly(), field),
+                       kwargs=kwargs)
+            self._unuse(label)
+            # convolutions of convolved products may have been unblocked
+            self._startConvolutions(convolutions)
+
+    def _planes(self, label):
+        """Returns the number of image planes of convolution label (i.e. of its input)"""
+        sd, field = self.location(self._nodes[label]["deps"][0])
+        return sd[field].shape[0]
+
+    def _startConvolutions(self, convolutions):
+        """
+        Submits convolutions whose input can be made right away, in the order they are needed, while the
+        convolved products held in memory stay within the plane budget (see class documentation)
+        """
+        inflight = sum([ self._planes(label) for label in convolutions
+                         if label in self._started and label not in self._released ])
+        for label in convolutions:
+            if label in self._started:
+                continue
+            dep = self._nodes[label]["deps"][0]
+            # don't make new inputs ahead while convolutions are in flight, they would be held in memory too
+            if inflight and dep not in self._started:
+                break
+            if not self._start(dep, wait=False) or not self._isReady(dep):
+                continue
+            planes = self._planes(label)
+            self._largest = max(self._largest, planes)
+            if inflight and inflight + planes > (self.max_planes or self._largest):
+                break
+            self._start(label, wait=False)
+            inflight += planes
+        APP.flushJobs()
+
+
+def _delImage_worker(sd, field):
+    """Worker function to delete a product from the SharedDict. Runs on the I/O queue, after the product's save."""
+    if field in sd:
+        sd.delete_item(field)
+
+APP.registerJobHandlers(_delImage_worker)
@@ -30,6 +30,7 @@ from DDFacet.Other import MyLogger
 from DDFacet.Other import ModColor
 log=MyLogger.getLogger("ClassImageDeconvMachine")
 from DDFacet.Array import NpParallel
+from DDFacet.Array.ClassMaxPyramid import ClassMaxPyramid
 from DDFacet.Other import ClassTimeIt
 from pyrap.images import image
 from DDFacet.Imager.ClassPSFServer import ClassPSFServer
@@ -101,6 +102,7 @@ class ClassImageDeconvMachine():
         self.CurrentNegMask = None
         self._NoiseMap = None
         self._PNRStop = None  # in _peakMode "sigma", provides addiitonal stopping criterion
+        self._PeakIndex = None  # peak-search index over the current PeakMap, built in Deconvolve()
 
 
     def Init(self, **kwargs):
@@ -183,6 +185,7 @@ class ClassImageDeconvMachine():
         else:
             print>> log, "Will search for the peak in the unweighted dirty map"
             self._PeakSearchImage = self._MeanDirty
+        self._PeakIndex = None
 
         if self.ModelImage is None:
             self._ModelImage=np.zeros_like(self._Dirty)
@@ -214,6 +217,9 @@ class ClassImageDeconvMachine():
             W=np.mean(np.float32(self.DicoDirty["WeightChansImages"]),axis=1)  #Get the weights (assuming they stay relatively the same over stokes terms)
             self._MeanDirty[0,:,x0d:x1d,y0d:y1d]-=np.sum(LocalSM[:,:,x0p:x1p,y0p:y1p]*W.reshape((W.size,1,1,1)),axis=0) #Sum over frequency
 
+        if self._PeakIndex is not None:
+            self._PeakIndex.update(x0d, x1d, y0d, y1d)
+
     def setChannel(self,ch=0):
         """
         In case we ever want to deconvolve per channel.
@@ -276,7 +282,13 @@ class ClassImageDeconvMachine():
         Fluxlimit_RMS = self.RMSFactor*RMS
 
         #Find position and intensity of first peak
-        x,y,MaxDirty=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
+        TileSize=self.GD["Deconv"]["PeakSearchTile"]
+        if TileSize:
+            self._PeakIndex=ClassMaxPyramid(PeakMap,DoAbs=DoAbs,Mask=self.MaskArray,TileSize=TileSize)
+            x,y,MaxDirty=self._PeakIndex.whereMax()
+        else:
+            self._PeakIndex=None
+            x,y,MaxDirty=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
 
         #Get peak factor stopping criterion
         Fluxlimit_Peak = MaxDirty*self.PeakFactor
@@ -324,7 +336,10 @@ class ClassImageDeconvMachine():
                 #grab a new peakmap
                 PeakMap = self.Dirty[0, :, :]
 
-                x,y,ThisFlux=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
+                if self._PeakIndex is not None:
+                    x,y,ThisFlux=self._PeakIndex.whereMax()
+                else:
+                    x,y,ThisFlux=NpParallel.A_whereMax(PeakMap,NCPU=self.NCPU,DoAbs=DoAbs,Mask=self.MaskArray)
 
                 # deprecated?
                 self.GainMachine.SetFluxMax(ThisFlux)
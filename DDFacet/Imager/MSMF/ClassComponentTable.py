@@ -0,0 +1,116 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+import scipy.signal
+import scipy.ndimage
+
+
+class ClassComponentTable(object):
+    """
+    Columnar version of the HMP component dictionary (DicoSMStacked["Comp"]). Instead of one dict per (x,y) key,
+    components are stored as arrays:
+        X, Y:       pixel coordinates, shape [ncomp]
+        SolsArray:  solutions, shape [ncomp,#basis_functions,#stokes_terms]
+        SumWeights: weights, shape [ncomp,#stokes_terms]
+    This is what the model image renderer and the DicoModel files use.
+    """
+    def __init__(self, X, Y, SolsArray, SumWeights):
+        self.X = np.int32(X)
+        self.Y = np.int32(Y)
+        self.SolsArray = np.float32(SolsArray)
+        self.SumWeights = np.float32(SumWeights)
+
+    @staticmethod
+    def FromDicoComp(DicoComp, NFuncs, NPol):
+        """Makes a table from a component dictionary"""
+        keys = DicoComp.keys()
+        if not keys:
+            return ClassComponentTable(np.zeros(0), np.zeros(0), np.zeros((0, NFuncs, NPol)), np.zeros((0, NPol)))
+        XY = np.array(keys).reshape((len(keys), 2))
+        return ClassComponentTable(XY[:, 0], XY[:, 1],
+                                   np.array([DicoComp[key]["SolsArray"] for key in keys]),
+                                   np.array([DicoComp[key]["SumWeights"] for key in keys]))
+
+    @staticmethod
+    def FromDico(Dico):
+        """Makes a table from its on-disk form (see ToDico)"""
+        return ClassComponentTable(Dico["X"], Dico["Y"], Dico["SolsArray"], Dico["SumWeights"])
+
+    def ToDico(self):
+        """Returns the on-disk form of the table: a dict of arrays, which pickles without per-component overhead"""
+        return dict(X=self.X, Y=self.Y, SolsArray=self.SolsArray, SumWeights=self.SumWeights)
+
+    def ToDicoComp(self):
+        """Returns a component dictionary. Its entries are views into the table arrays."""
+        return dict(((x, y), dict(SolsArray=sols, SumWeights=sw))
+                    for x, y, sols, sw in zip(self.X.tolist(), self.Y.tolist(), self.SolsArray, self.SumWeights))
+
+    def __len__(self):
+        return self.X.size
+
+    def Render(self, ModelImage, FreqIn, RefFreq, ListScales, DoAbs=False):
+        """
+        Adds the components into ModelImage, of shape [nchan,npol,nx,ny], at frequencies FreqIn.
+        Delta components are scattered onto the image in one go, Gaussian components are either scattered one
+        kernel pixel at a time (few components) or gridded and FFT-convolved with the kernel (many components).
+        Either way, pixels out of reach of the components' kernels are left untouched.
+        """
+        nchan = ModelImage.shape[0]
+        for iFunc, ThisComp in enumerate(ListScales):
+            Sol = self.SolsArray[:, iFunc, :]
+            # a given basis function is only used by a fraction of the components
+            ind = np.where((Sol != 0).any(axis=1))[0]
+            if not ind.size:
+                continue
+            x, y, Sol = self.X[ind], self.Y[ind], Sol[ind]
+            for ch in xrange(nchan):
+                Flux = Sol*(FreqIn[ch]/RefFreq)**ThisComp["Alpha"]
+                if DoAbs:
+                    Flux = np.abs(Flux)
+                if ThisComp["ModelType"] == "Delta":
+                    # (x,y) are unique, so a fancy-indexed add is safe here
+                    ModelImage[ch][:, x, y] += Flux.T
+                elif ThisComp["ModelType"] == "Gaussian":
+                    self._renderGaussian(ModelImage[ch], x, y, Flux, ThisComp["Model"])
+        return ModelImage
+
+    @staticmethod
+    def _renderGaussian(Image, x, y, Flux, Gauss):
+        npol, nx, ny = Image.shape
+        Sup, _ = Gauss.shape
+        # kernel pixel (dx,dy) lands on (x+dx-Sup/2,y+dy-Sup/2), as GiveEdgesDissymetric does for odd Sup
+        if Sup%2 and x.size*Sup*Sup > nx*ny:
+            Grid = np.zeros((nx, ny), np.float32)
+            for pol in xrange(npol):
+                Grid[x, y] = Flux[:, pol]
+                Conv = scipy.signal.fftconvolve(Grid, Gauss, mode="same")
+                # the FFT leaves round-off everywhere: zero the pixels that no component reaches, so that the
+                # image is as sparse as it comes out of the direct path below
+                Conv[scipy.ndimage.maximum_filter(Grid != 0, size=Sup, mode="constant") == 0] = 0
+                Image[pol] += Conv
+        else:
+            for dx in xrange(Sup):
+                xs = x+(dx-Sup/2)
+                validx = (xs >= 0) & (xs < nx)
+                for dy in xrange(Sup):
+                    ys = y+(dy-Sup/2)
+                    valid = validx & (ys >= 0) & (ys < ny)
+                    Image[:, xs[valid], ys[valid]] += Gauss[dx, dy]*Flux[valid].T
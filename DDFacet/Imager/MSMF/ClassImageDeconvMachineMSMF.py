@@ -29,6 +29,7 @@ import psutil
 import numexpr
 from pyrap.images import image
 from DDFacet.Array import NpParallel
+from DDFacet.Array.ClassMaxPyramid import ClassMaxPyramid
 from DDFacet.Other import ClassTimeIt
 from DDFacet.Imager.MSMF import ClassMultiScaleMachine
 from DDFacet.Imager.ClassPSFServer import ClassPSFServer
@@ -128,6 +129,8 @@ class ClassImageDeconvMachine():
             self._peakMode = "weighted"
 
         self._prevPeak = None
+        # peak-search index over self._PeakSearchImage, (re)built in Deconvolve() and kept up to date by SubStep()
+        self._PeakIndex = None
 
     def setNCPU(self,NCPU):
         self.NCPU=NCPU
@@ -360,6 +363,7 @@ class ClassImageDeconvMachine():
         else:
             print>>log,"Will search for the peak in the unweighted dirty map"
             self._PeakSearchImage = self._MeanDirty
+        self._PeakIndex = None
 
 
         NPixStats = self.GD["Deconv"]["NumRMSSamples"]
@@ -557,6 +561,9 @@ class ClassImageDeconvMachine():
             a, b = self._MeanDirty[:, :, x0d:x1d, y0d:y1d], self._peakWeightImage[:, :, x0d:x1d, y0d:y1d]
             numexpr.evaluate("a*b", out=self._PeakSearchImage[:, :, x0d:x1d, y0d:y1d])
 
+        if self._PeakIndex is not None:
+            self._PeakIndex.update(x0d, x1d, y0d, y1d)
+
                 # pylab.subplot(1,3,3,sharex=ax,sharey=ax)
         # pylab.imshow(self._MeanDirty[0,0,x0d:x1d,y0d:y1d],interpolation="nearest",vmin=vmin,vmax=vmax)#,vmin=vmin,vmax=vmax)
         # pylab.colorbar()
@@ -644,7 +651,14 @@ class ClassImageDeconvMachine():
             print>>log,"  not using a mask"
             CurrentNegMask=None
         
-        x,y,MaxDirty = NpParallel.A_whereMax(self._PeakSearchImage,NCPU=self.NCPU,DoAbs=DoAbs,Mask=CurrentNegMask)
+        # the mask and DoAbs are fixed for the duration of the minor cycle, so (re)build the peak-search index here
+        TileSize = self.GD["Deconv"]["PeakSearchTile"]
+        if TileSize:
+            self._PeakIndex = ClassMaxPyramid(self._PeakSearchImage, DoAbs=DoAbs, Mask=CurrentNegMask, TileSize=TileSize)
+            x,y,MaxDirty = self._PeakIndex.whereMax()
+        else:
+            self._PeakIndex = None
+            x,y,MaxDirty = NpParallel.A_whereMax(self._PeakSearchImage,NCPU=self.NCPU,DoAbs=DoAbs,Mask=CurrentNegMask)
 
         # ThisFlux is evaluated against stopping criteria. In weighted mode, use the true flux. Else use sigma value.
         ThisFlux = self._MeanDirty[0,0,x,y] if self._peakMode is "weighted" else MaxDirty
@@ -768,8 +782,11 @@ class ClassImageDeconvMachine():
                 self._niter = i
 
                 # x,y,ThisFlux=NpParallel.A_whereMax(self.Dirty,NCPU=self.NCPU,DoAbs=1)
-                x, y, peak = NpParallel.A_whereMax(
-                    self._PeakSearchImage, NCPU=self.NCPU, DoAbs=DoAbs, Mask=CurrentNegMask)
+                if self._PeakIndex is not None:
+                    x, y, peak = self._PeakIndex.whereMax()
+                else:
+                    x, y, peak = NpParallel.A_whereMax(
+                        self._PeakSearchImage, NCPU=self.NCPU, DoAbs=DoAbs, Mask=CurrentNegMask)
 
                 if self.GD["HMP"]["FractionRandomPeak"] is not None:
                     op=lambda x: x
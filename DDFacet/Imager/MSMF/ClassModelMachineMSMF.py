@@ -36,6 +36,7 @@ from DDFacet.Imager import ClassFrequencyMachine
 from DDFacet.ToolsDir.GiveEdges import GiveEdges
 from DDFacet.ToolsDir.GiveEdges import GiveEdgesDissymetric
 from DDFacet.Imager import ClassModelMachine as ClassModelMachinebase
+from DDFacet.Imager.MSMF.ClassComponentTable import ClassComponentTable
 from DDFacet.ToolsDir import ModFFTW
 import scipy.ndimage
 from SkyModel.Sky import ModRegFile
@@ -57,6 +58,8 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         # self.DicoSMStacked["Comp"]={}
         self.DicoSMStacked={}
         self.DicoSMStacked["Type"]="HMP"
+        # columnar copy of DicoSMStacked["Comp"], see GiveCompTable()
+        self._CompTable=None
 
     def setRefFreq(self,RefFreq,Force=False):#,AllFreqs):
         if self.RefFreq is not None and not Force:
@@ -82,6 +85,15 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         D["Type"]="HMP"
         D["ListScales"]=self.ListScales
         D["ModelShape"]=self.ModelShape
+        if self.GD["Output"].get("DicoModelFormat","Dict")=="Columnar" and "Comp" in D:
+            # store components as a few arrays rather than one dict per component. Work on a shallow
+            # copy so as to leave the in-memory model alone
+            D=D.copy()
+            if D["Comp"] is self.DicoSMStacked.get("Comp"):
+                D["CompTable"]=self.GiveCompTable().ToDico()
+            else:
+                D["CompTable"]=ClassComponentTable.FromDicoComp(D["Comp"],len(self.ListScales),self.ModelShape[1]).ToDico()
+            del(D["Comp"])
         MyPickle.Save(D,FileName)
 
     def FromFile(self,FileName):
@@ -95,6 +107,22 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         self.RefFreq=self.DicoSMStacked["RefFreq"]
         self.ListScales=self.DicoSMStacked["ListScales"]
         self.ModelShape=self.DicoSMStacked["ModelShape"]
+        self._CompTable=None
+        # columnar DicoModel files: the table is used for rendering as is, and the component dict is made of views into it
+        if "CompTable" in self.DicoSMStacked:
+            self._CompTable=ClassComponentTable.FromDico(self.DicoSMStacked["CompTable"])
+            del(self.DicoSMStacked["CompTable"])
+            self.DicoSMStacked["Comp"]=self._CompTable.ToDicoComp()
+
+    def GiveCompTable(self):
+        """
+        Returns the components as a ClassComponentTable. The table is rebuilt from DicoSMStacked["Comp"]
+        whenever the components have changed since the last call.
+        """
+        DicoComp=self.DicoSMStacked.setdefault("Comp",{})
+        if self._CompTable is None or len(self._CompTable)!=len(DicoComp):
+            self._CompTable=ClassComponentTable.FromDicoComp(DicoComp,len(self.ListScales),self.ModelShape[1])
+        return self._CompTable
 
 
 
@@ -128,6 +156,7 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
             DicoComp=self.DicoSMStacked["Comp"]
 
 
+        self._CompTable=None
         comp = DicoComp.get(key)
         if comp is None:
             DicoComp[key] = comp = dict(
@@ -287,10 +316,6 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         Returns:
             Model image
         """
-        if DoAbs:
-            f_apply=np.abs
-        else:
-            f_apply=lambda x:x
         RefFreq=self.DicoSMStacked["RefFreq"]
         if FreqIn is None:
             FreqIn=np.array([RefFreq])
@@ -302,8 +327,6 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         FreqIn=np.array([FreqIn.ravel()]).flatten()
 
         _,npol,nx,ny=self.ModelShape
-        N0x=nx
-        N0y=ny
 
         nchan=FreqIn.size
         if out is not None:
@@ -316,37 +339,7 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         if "Comp" not in  self.DicoSMStacked.keys():
             return ModelImage
 
-        DicoComp=self.DicoSMStacked["Comp"]
-
-        DicoSM={}
-        for key in DicoComp.keys():
-            for pol in range(npol):
-                Sol=DicoComp[key]["SolsArray"][:,pol]#/self.DicoSMStacked[key]["SumWeights"]
-                x,y=key
-
-                #print>>log, "%s : %s"%(str(key),str(Sol))
-
-                for iFunc in range(Sol.size):
-                    ThisComp=self.ListScales[iFunc]
-                    ThisAlpha=ThisComp["Alpha"]
-                    for ch in range(nchan):
-                        Flux=Sol[iFunc]*(FreqIn[ch]/RefFreq)**(ThisAlpha)
-                        Flux=f_apply(Flux)
-                        if ThisComp["ModelType"]=="Delta":
-                            ModelImage[ch,pol,x,y]+=Flux
-
-                        elif ThisComp["ModelType"]=="Gaussian":
-                            Gauss=ThisComp["Model"]
-                            Sup,_=Gauss.shape
-                            x0,x1=x-Sup/2,x+Sup/2+1
-                            y0,y1=y-Sup/2,y+Sup/2+1
-
-
-                            Aedge,Bedge=GiveEdgesDissymetric((x,y),(N0x,N0y),(Sup/2,Sup/2),(Sup,Sup))
-                            x0d,x1d,y0d,y1d=Aedge
-                            x0p,x1p,y0p,y1p=Bedge
-
-                            ModelImage[ch,pol,x0d:x1d,y0d:y1d]+=Gauss[x0p:x1p,y0p:y1p]*Flux
+        self.GiveCompTable().Render(ModelImage,FreqIn,RefFreq,self.ListScales,DoAbs=DoAbs)
 
         # vmin,vmax=np.min(self._MeanDirtyOrig[0,0]),np.max(self._MeanDirtyOrig[0,0])
         # vmin,vmax=-1,1
@@ -382,6 +375,7 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
             print>>log, "  Removing neg components too"
             Lx,Ly=np.where( ((ModelImage<sig*Min)&(ModelImage!=0)) | (ModelImage<0))
 
+        self._CompTable=None
         for icomp in range(Lx.size):
             key=Lx[icomp],Ly[icomp]
             try:
@@ -393,6 +387,7 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         print>>log, "Cleaning model dictionary from masked components using %s"%(MaskName)
         im=image(MaskName)
         MaskArray=im.getdata()[0,0].T[::-1]
+        self._CompTable=None
         for (x,y) in self.DicoSMStacked["Comp"].keys():
             if MaskArray[x,y]==0:
                 del(self.DicoSMStacked["Comp"][(x,y)])
@@ -462,6 +457,7 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
         self.AnalyticSourceCat=ClassSM.ClassSM(SkyModel)
 
     def DelAllComp(self):
+        self._CompTable=None
         for key in self.DicoSMStacked["Comp"].keys():
             del(self.DicoSMStacked["Comp"][key])
 
@@ -495,6 +491,7 @@ class ClassModelMachine(ClassModelMachinebase.ClassModelMachine):
 
 
 
+        self._CompTable=None
         for iSource in range(SourceCat.shape[0]):
             x0=SourceCat.X[iSource]
             y0=SourceCat.Y[iSource]
@@ -18,6 +18,7 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
+import os
 import scipy.fftpack
 from DDFacet.ToolsDir import Gaussian
 import numpy as np
@@ -31,6 +32,7 @@ log = MyLogger.getLogger("WTerm")  # ,disable=True)
 from DDFacet.ToolsDir import ModTaper
 from DDFacet.ToolsDir import ModFitPoly2D
 from DDFacet.ToolsDir import ModFFTW
+from DDFacet.Other.CacheManager import CacheManager
 
 
 F2 = scipy.fftpack.fft2
@@ -280,11 +282,28 @@ def Give_dn(l0, m0, rad=1., order=4):
     return Cl, Cm, C.flatten()
 
 
+# version of the W-kernel computation: bump this when InitSphe()/InitW() change, to invalidate W-kernel libraries
+WKERNEL_VERSION = 1
+
+# cf_dict entries that are kept in a W-kernel library (see ClassWTermModified)
+WKERNEL_KEYS = "Sphe", "InvSphe", "CuCv", "W"
+
+# W-kernel libraries opened by this process, by directory
+_wkernel_libraries = {}
+
+def GiveWKernelLibrary(dirname):
+    """Returns a CacheManager for the W-kernel library in directory dirname, opened once per process"""
+    dirname = os.path.expanduser(dirname)
+    if dirname not in _wkernel_libraries:
+        _wkernel_libraries[dirname] = CacheManager(dirname)
+    return _wkernel_libraries[dirname]
+
+
 class ClassWTermModified():
     def __init__(self, Cell=10, Sup=15, Nw=11, wmax=30000, Npix=101, Freqs=np.array([100.e6]), OverS=11, lmShift=None,
                  mode="compute",
                  cf_dict=None, compute_cf=True,
-                 IDFacet=None):
+                 IDFacet=None, library=None, AdaptivePhaseError=0):
         """
         Class for computing/loading/saving w-kernels and spheroidals.
 
@@ -301,6 +320,14 @@ class ClassWTermModified():
                         "load" to load CFs from store_file, and save them to store_dict
                         "dict" to load CFs from store_dict
             IDFacet:
+            library:    if set, directory of a W-kernel library. With compute_cf, kernels are then looked up in
+                        the library (by the physical parameters they depend on, see giveLibraryKey()) before
+                        being computed, and computed kernels are added to it. Library entries are .npy files,
+                        memory-mapped on loading, so they can be shared by facets, images and runs.
+            AdaptivePhaseError: if set, Nw is the max number of w-planes, and the number actually used is
+                        the smallest one for which the w-term phase error of the facet stays below this (in
+                        radians), see GiveAdaptiveNw(). The support of the largest w-kernel is then also
+                        estimated from the w-term of the facet, rather than that of the phase centre.
         """
 
         self.Nw = int(Nw)
@@ -316,9 +343,12 @@ class ClassWTermModified():
         C = 299792458.
         waveMin = C/Freqs[-1]
         self.RefWave = waveMin
+        self.AdaptivePhaseError = AdaptivePhaseError
+        if AdaptivePhaseError:
+            self.Nw = self.GiveAdaptiveNw(wmax if compute_cf else cf_dict["wmax"])
 
         # recompute?
-        if compute_cf:
+        if compute_cf and not (library and self.loadFromLibrary(library, cf_dict, wmax)):
             cf_dict["wmax"] = self.wmax = wmax
             self.InitSphe()
             self.InitW()
@@ -327,6 +357,8 @@ class ClassWTermModified():
             cf_dict["InvSphe"] = dS(1./np.float64(self.ifzfCF.real))
             cf_dict["CuCv"] = np.array([self.Cu, self.Cv])
             NpShared.PackListSquareMatrix(cf_dict, "W", self.Wplanes + self.WplanesConj)
+            if library:
+                self.saveToLibrary(library, cf_dict)
         else:
             self.wmax = cf_dict["wmax"]
             self.ifzfCF = cf_dict["Sphe"]
@@ -337,6 +369,82 @@ class ClassWTermModified():
             self.Wplanes = ww[:self.Nw]
             self.WplanesConj = ww[self.Nw:]
 
+    def giveFacet_dn(self):
+        """
+        Returns the radius of the facet (in radians), and the polynomial fit of the w-term of the facet that is
+        left after its phase shift (see Give_dn())
+        """
+        lrad = ((self.Npix)/2.)*self.Cell/3600.*np.pi/180.
+        l0, m0 = self.lmShift if self.lmShift is not None else (0., 0.)
+        Cv, Cu, CoefPoly = Give_dn(l0, m0, rad=3*lrad, order=5)
+        return lrad, Cv, Cu, CoefPoly
+
+    def GiveAdaptiveNw(self, wmax):
+        """
+        Returns the number of w-planes needed by the facet, capped at Nw. With w-planes spaced by dw, the w of a
+        visibility is off by up to dw/2, and the w-term of a facet spanning a range dn of n-1 (after its phase
+        shift) is then off by a phase of up to pi*dw*dn/lambda. The planes are spaced so that this stays below
+        AdaptivePhaseError at the shortest wavelength.
+        """
+        lrad, _, _, CoefPoly = self.giveFacet_dn()
+        l, m = np.mgrid[-lrad:lrad:101j, -lrad:lrad:101j]
+        n_1 = ModFitPoly2D.polyval2d(l, m, CoefPoly)
+        Nw = int(np.ceil(np.pi*(wmax/self.RefWave)*(n_1.max()-n_1.min())/self.AdaptivePhaseError)) + 1
+        # keep at least 2 planes: with 1, every visibility would land on the w=0 plane and none would be cut. The
+        # gridders snap w to the nearest plane, and cut visibilities past the last one, so the cut is at wmax+dw/2
+        # (1.5*wmax with 2 planes) rather than at wmax
+        return min(max(Nw, 2), int(self.Nw))
+
+    def giveLibraryKey(self, wmax):
+        """Returns the W-kernel library key: the parameters that the kernels and spheroidal depend on"""
+        l0, m0 = self.lmShift if self.lmShift is not None else (0., 0.)
+        key = dict(Version=WKERNEL_VERSION, Npix=int(self.Npix), Cell=float(self.Cell), Nw=int(self.Nw),
+                   wmax=float(wmax), OverS=int(self.OverS), Support=int(self.Sup), RefWave=float(self.RefWave),
+                   # round off the last bits, so that facet centres computed along different paths match
+                   l0=round(float(l0), 12), m0=round(float(m0), 12))
+        # adaptive kernels have different supports
+        if self.AdaptivePhaseError:
+            key["AdaptiveSupport"] = True
+        return key
+
+    def loadFromLibrary(self, library, cf_dict, wmax):
+        """Copies the kernels from the W-kernel library into cf_dict. Returns False if they are not in the library."""
+        self._library_save = False
+        try:
+            lib = GiveWKernelLibrary(library)
+            path, state = lib.checkSharedElement("WKernels", self.giveLibraryKey(wmax))
+            if state == "busy":
+                print>>log, "W-kernels %s are being written by another run, will compute them locally" % path
+            if state != "valid":
+                self._library_save = state == "missing"
+                return False
+            for key in WKERNEL_KEYS:
+                cf_dict[key] = np.load(os.path.join(path, key+".npy"), mmap_mode="r")
+        except Exception as e:
+            print>>log, ModColor.Str("Error reading W-kernel library %s (%s), will recompute" % (library, e))
+            # cf_dict may be a SharedDict, whose delete_item() also removes the item from shared memory, or a dict
+            for key in WKERNEL_KEYS:
+                if key in cf_dict:
+                    if hasattr(cf_dict, "delete_item"):
+                        cf_dict.delete_item(key)
+                    else:
+                        del cf_dict[key]
+            return False
+        cf_dict["wmax"] = wmax
+        return True
+
+    def saveToLibrary(self, library, cf_dict):
+        """Adds the kernels in cf_dict to the W-kernel library, if loadFromLibrary() found them missing"""
+        if not getattr(self, "_library_save", False):
+            return
+        def writer(path):
+            for key in WKERNEL_KEYS:
+                np.save(os.path.join(path, key+".npy"), cf_dict[key])
+        try:
+            GiveWKernelLibrary(library).makeSharedElement("WKernels", self.giveLibraryKey(self.wmax), writer)
+        except Exception as e:
+            print>>log, ModColor.Str("Error writing W-kernel library %s (%s)" % (library, e))
+
 
     def InitSphe(self):
         T = ClassTimeIt.ClassTimeIt("Wterm")
@@ -385,6 +493,9 @@ class ClassWTermModified():
         l, m = np.mgrid[-lrad * np.sqrt(2.): np.sqrt(2.) * lrad: SupMax * 1j, -
                         lrad * np.sqrt(2.): np.sqrt(2.) * lrad: SupMax * 1j]
         n_1 = np.sqrt(1.-l**2-m**2)-1
+        if self.AdaptivePhaseError:
+            # size the kernels after the w-term of the facet, as left after its phase shift
+            n_1 = ModFitPoly2D.polyval2d(l, m, self.giveFacet_dn()[3])
         waveMin = C/Freqs[-1]
         T.timeit("0")
         W = np.exp(-2.*1j*np.pi*(wmax/waveMin)*n_1)*self.SpheW
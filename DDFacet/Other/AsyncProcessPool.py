@@ -30,6 +30,10 @@ import signal
 from collections import OrderedDict
 import glob
 import re
+import bisect
+import json
+import shutil
+from contextlib import contextmanager
 import numexpr
 import time
 
@@ -151,12 +155,20 @@ class AsyncProcessPool (object):
         self._job_handlers = {}
         self._events = {}
         self._results_map = {}
+        # sorted list of the job IDs in _results_map, for looking up jobs by prefix
+        self._results_keys = []
         self._job_counters = JobCounterPool()
+        # compute jobs submitted with a cost hint, held back until flushJobs()
+        self._costed_jobs = []
+        # tracing: see enableTracing()
+        self._trace_file = self._trace_dir = None
+        self._trace_fh = self._trace_fh_pid = None
 
     def __del__(self):
         self.shutdown()
 
-    def init(self, ncpu=None, affinity=None, parent_affinity=0, num_io_processes=1, verbose=0, pause_on_start=False):
+    def init(self, ncpu=None, affinity=None, parent_affinity=0, num_io_processes=1, verbose=0, pause_on_start=False,
+             trace_file=None):
         """
         Initializes an APP.
         Can be called multiple times at program startup
@@ -167,10 +179,13 @@ class AsyncProcessPool (object):
             parent_affinity:
             num_io_processes:
             verbose:
+            trace_file: if set, jobs and phases are traced, and a timeline is written to this file (see enableTracing())
 
         Returns:
 
         """
+        if trace_file:
+            self.enableTracing(trace_file)
         self.affinity = affinity
         self.verbose = verbose
 
@@ -514,7 +529,7 @@ class AsyncProcessPool (object):
     def runJob (self, job_id, handler=None, io=None, args=(), kwargs={},
                 event=None, counter=None,
                 singleton=False, collect_result=True,
-                serial=False):
+                serial=False, cost=None, _batch=None):
         """
         Puts a job on a processing queue.
 
@@ -534,6 +549,11 @@ class AsyncProcessPool (object):
                     If False, job result will be collected by awaitJobResults() and removed from the map: the job can be
                     run again.
             serial: if True, job is run serially in the main process. Useful for debugging.
+            cost:   optional estimate of the job's run time, in arbitrary units (e.g. pixels x visibilities), for
+                    compute jobs. Jobs with a cost hint are held back until flushJobs() is called (or until the
+                    next job without a cost hint is submitted, or the next await call), and are then queued in order
+                    of decreasing cost, so that the largest jobs of a batch do not end up running last
+                    (longest-processing-time-first scheduling).
         """
         if collect_result and os.getpid() != parent_pid:
             raise RuntimeError("runJob() with collect_result can only be called in the parent process. This is a bug.")
@@ -569,6 +589,10 @@ class AsyncProcessPool (object):
         for iarg, arg in enumerate(args):
             if type(arg) is shared_dict.SharedDict:
                 raise TypeError("positional argument %d is a SharedDict. This is a bug! Use readonly()/readwrite()/writeonly()"%iarg)
+        for item in (_batch and _batch[1]) or ():
+            for arg in item:
+                if type(arg) is shared_dict.SharedDict:
+                    raise TypeError("batch argument is a SharedDict. This is a bug! Use readonly()/readwrite()/writeonly()")
         for key, arg in kwargs.iteritems():
             if type(arg) is shared_dict.SharedDict:
                 raise TypeError("keyword %s is a SharedDict. This is a bug! Use readonly()/readwrite()/writeonly()"%key)
@@ -577,25 +601,203 @@ class AsyncProcessPool (object):
                        event=event and id(event),
                        counter=counter and id(counter),
                        collect_result=collect_result,
-                       args=args, kwargs=kwargs)
+                       args=args, kwargs=kwargs, batch=_batch,
+                       submit_time=time.time())
         # insert entry into dict of pending jobs
         if collect_result:
-            job = self._results_map[job_id] = Job(job_id, jobitem, singleton=singleton)
+            self._addJob(Job(job_id, jobitem, singleton=singleton))
         ## normal paralell mode, stick job on queue
         if self.ncpu > 1 and not serial:
             if self.verbose > 2:
                 print>>log, "enqueueing job %s: %s"%(job_id, handler_desc)
             # place it on appropriate queue
             if io is None:
-                self._compute_queue.put(jobitem)
+                if cost is not None:
+                    self._costed_jobs.append((cost, len(self._costed_jobs), jobitem))
+                else:
+                    self.flushJobs()
+                    self._compute_queue.put(jobitem)
             else:
-                io = max(len(self._io_queues)-1, io)
+                io = min(len(self._io_queues)-1, io)
                 self._io_queues[io].put(jobitem)
         # serial mode: process job in this process, and raise any exceptions up
         else:
             self._dispatch_job(jobitem, reraise=True)
 
+    def runJobBatch (self, job_id, handler=None, io=None, args=(), batch_args=(), kwargs={},
+                     counter=None, collect_result=True, batch_size=None, cost=None):
+        """
+        Runs many homogeneous jobs, handler(*(args+batch_args[i]), **kwargs) for each i, shipping them to the workers in
+        batches: each batch is one queue item, and returns one result message. This avoids the per-job IPC overhead
+        when jobs are small.
+
+        Args:
+            job_id:     base ID. Batches get IDs of the form "job_id#N"; use awaitJobBatch(job_id) to collect results.
+            args, kwargs: arguments common to all jobs. These are pickled (and SharedDicts instantiated) once per batch.
+            batch_args: list of tuples of per-job arguments, appended to args.
+            batch_size: number of jobs per batch. Default is to make ~4 batches per worker.
+            cost:       if set, a list of per-job cost hints (see runJob()), summed up per batch.
+            io, counter, collect_result: as for runJob(). Note that a counter is incremented once per batch.
+
+        Returns:
+            the number of batches submitted
+        """
+        batch_args = list(batch_args)
+        nbatch = len(batch_args)
+        if not batch_size:
+            batch_size = max(1, -(-nbatch // (4*max(self.ncpu, 1))))
+        ibatch = 0
+        for i0 in xrange(0, nbatch, batch_size):
+            i1 = min(i0+batch_size, nbatch)
+            self.runJob("%s#%d" % (job_id, ibatch), handler, io=io, args=tuple(args), kwargs=kwargs,
+                        counter=counter, collect_result=collect_result,
+                        cost=sum(cost[i0:i1]) if cost is not None else None,
+                        _batch=(ibatch, batch_args[i0:i1]))
+            ibatch += 1
+        return ibatch
+
+    def awaitJobBatch (self, job_id, progress=None, timing=None):
+        """
+        Waits for jobs submitted by runJobBatch(job_id) to complete, and returns a list of their results, in the
+        same order as batch_args.
+        """
+        results = self.awaitJobResults(job_id+"#*", progress=progress, timing=timing)
+        values = []
+        for _, batch_results in sorted(results):
+            values += batch_results
+        return values
+
+    def _addJob (self, job):
+        self._results_map[job.job_id] = job
+        bisect.insort(self._results_keys, job.job_id)
+
+    def _removeJob (self, job_id):
+        del self._results_map[job_id]
+        del self._results_keys[bisect.bisect_left(self._results_keys, job_id)]
+
+    def _matchJobs (self, jobspec):
+        """Returns IDs of jobs in the results map matching the given job spec, using the prefix index"""
+        match = re.search(r"[*?[]", jobspec)
+        if match is None:
+            return [jobspec] if jobspec in self._results_map else []
+        # jobs matching the literal part of the spec before the first wildcard are contiguous in the sorted list
+        prefix = jobspec[:match.start()]
+        matching_jobs = []
+        for job_id in self._results_keys[bisect.bisect_left(self._results_keys, prefix):]:
+            if not job_id.startswith(prefix):
+                break
+            matching_jobs.append(job_id)
+        if jobspec != prefix + "*":
+            matching_jobs = [ job_id for job_id in matching_jobs if fnmatch.fnmatchcase(job_id, jobspec) ]
+        return matching_jobs
+
+    def enableTracing (self, trace_file):
+        """
+        Enables tracing. Must be called in the parent process before the workers are started. Every process (parent
+        and workers) then appends trace events to its own file in a temporary directory, and writeTrace() merges
+        these into a timeline in Chrome trace format (load it in chrome://tracing or Perfetto).
+        Each job is traced with its worker, start/end, time spent waiting on the queue, and the shared memory in use
+        when it completed. The parent also traces the time it spends waiting on jobs, and any phases marked with
+        tracePhase().
+        """
+        if os.getpid() != parent_pid:
+            raise RuntimeError("This method can only be called in the parent process. This is a bug.")
+        self._trace_file = trace_file
+        self._trace_dir = "%s.parts" % trace_file
+        if os.path.exists(self._trace_dir):
+            shutil.rmtree(self._trace_dir)
+        os.mkdir(self._trace_dir)
+        print>>log, "tracing jobs and phases, timeline will be written to %s" % trace_file
+
+    @staticmethod
+    def _shmUsage():
+        """Returns bytes in use in /dev/shm, or None if this can't be determined"""
+        try:
+            st = os.statvfs("/dev/shm")
+            return (st.f_blocks - st.f_bfree) * st.f_frsize
+        except OSError:
+            return None
+
+    def traceEvent (self, name, category, t0, t1, **args):
+        """Records a trace event spanning times t0 to t1 (as returned by time.time()), if tracing is enabled"""
+        if not self._trace_dir:
+            return
+        # each process has its own trace file (re-opened after a fork)
+        if self._trace_fh_pid != os.getpid():
+            self._trace_fh = open(os.path.join(self._trace_dir, "%d.json" % os.getpid()), "a", 1)
+            self._trace_fh_pid = os.getpid()
+        args.setdefault("proc_id", self.proc_id)
+        args["shm_used_mb"] = (self._shmUsage() or 0)/float(1<<20)
+        event = dict(name=name, cat=category, ph="X", ts=int(t0*1e6), dur=int((t1-t0)*1e6),
+                     pid=parent_pid, tid=os.getpid(), args=args)
+        self._trace_fh.write(json.dumps(event) + "\n")
+
+    @contextmanager
+    def tracePhase (self, name, category="phase"):
+        """Context manager: traces the execution of the enclosed block (e.g. a minor cycle) as a phase"""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.traceEvent(name, category, t0, time.time())
+
+    @contextmanager
+    def allWorkerCores (self, enable=True):
+        """Context manager: lets a worker (normally pinned to its own core) run the enclosed block on all the
+        workers' cores, e.g. for a multithreaded job that would otherwise have its threads share one core.
+        Does nothing if enable is False."""
+        if not enable or not self.affinity or os.getpid() == parent_pid:
+            yield
+            return
+        proc = psutil.Process()
+        affinity = proc.cpu_affinity()
+        proc.cpu_affinity(list(self._cores))
+        try:
+            yield
+        finally:
+            proc.cpu_affinity(affinity)
+
+    def writeTrace (self):
+        """Merges the trace events recorded by all processes, and writes them out as a Chrome trace. Ends tracing."""
+        if not self._trace_dir or os.getpid() != parent_pid:
+            return
+        events = []
+        proc_names = {}
+        for filename in glob.glob(os.path.join(self._trace_dir, "*.json")):
+            for line in open(filename):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue    # incomplete line from a worker that was killed
+                events.append(event)
+                proc_names[event["tid"]] = event["args"].get("proc_id") or "main"
+        # name the timeline rows after the process IDs
+        for tid, proc_name in proc_names.iteritems():
+            events.append(dict(name="thread_name", ph="M", pid=parent_pid, tid=tid, args=dict(name=proc_name)))
+        events.sort(key=lambda event: event.get("ts", 0))
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), open(self._trace_file, "w"))
+        print>>log, "wrote timeline of %d traced events to %s" % (len(events), self._trace_file)
+        shutil.rmtree(self._trace_dir, ignore_errors=True)
+        self._trace_dir = None
+
+    def flushJobs (self):
+        """
+        Puts jobs submitted with a cost hint (see runJob()) on the compute queue, most expensive first.
+        """
+        if self._costed_jobs:
+            if self.verbose > 2:
+                print>>log, "enqueueing %d jobs in order of decreasing cost" % len(self._costed_jobs)
+            # ties are broken by submission order
+            for _, _, jobitem in sorted(self._costed_jobs, key=lambda x: (-x[0], x[1])):
+                self._compute_queue.put(jobitem)
+            self._costed_jobs = []
+
     def awaitJobCounter (self, counter, progress=None, total=None, timeout=10):
+        with self.tracePhase("wait: %s" % (progress or counter.name), "wait"):
+            self._awaitJobCounter(counter, progress, total, timeout)
+
+    def _awaitJobCounter (self, counter, progress, total, timeout):
+        self.flushJobs()
         if self.verbose > 2:
             print>> log, "  %s is complete" % counter.name
         if progress:
@@ -625,6 +827,11 @@ class AsyncProcessPool (object):
         Waits for events indicated by the given names to be set. This can be called from the parent process, or
         from any of the background processes.
         """
+        with self.tracePhase("wait: events", "wait"):
+            self._awaitEvents(*events)
+
+    def _awaitEvents (self, *events):
+        self.flushJobs()
         if self.verbose > 2:
             print>>log, "checking for completion events on %s" % " ".join(events)
         for event in events:
@@ -659,6 +866,12 @@ class AsyncProcessPool (object):
         """
         if os.getpid() != parent_pid:
             raise RuntimeError("This method can only be called in the parent process. This is a bug.")
+        label = timing or progress or (jobspecs if type(jobspecs) is str else ",".join(jobspecs))
+        with self.tracePhase("wait: %s" % label, "wait"):
+            return self._awaitJobResults(jobspecs, progress, timing)
+
+    def _awaitJobResults (self, jobspecs, progress, timing):
+        self.flushJobs()
         if type(jobspecs) is str:
             jobspecs = [ jobspecs ]
         # make a dict of all jobs still outstanding
@@ -666,7 +879,7 @@ class AsyncProcessPool (object):
         job_results = OrderedDict()   # this maps jobspec to a list of results
         total_jobs = complete_jobs = 0
         for jobspec in jobspecs:
-            matching_jobs = [job_id for job_id in self._results_map.iterkeys() if fnmatch.fnmatch(job_id, jobspec)]
+            matching_jobs = self._matchJobs(jobspec)
             for job_id in matching_jobs:
                 awaiting_jobs.setdefault(job_id, set()).add(jobspec)
             if not matching_jobs:
@@ -675,13 +888,14 @@ class AsyncProcessPool (object):
             job_results[jobspec] = len(matching_jobs), []
         # check dict of already returned results (perhaps from previous calls to awaitJobs). Remove
         # matching results, and assign them to appropriate jobspec lists
-        for job_id, job in self._results_map.items():
-            if job_id in awaiting_jobs and job.complete:
+        for job_id in awaiting_jobs.keys():
+            job = self._results_map[job_id]
+            if job.complete:
                 for jobspec in awaiting_jobs[job_id]:
                     job_results[jobspec][1].append(job.result)
                     complete_jobs += 1
                 if not job.singleton:
-                    del self._results_map[job_id]
+                    self._removeJob(job_id)
                 del awaiting_jobs[job_id]
         if progress:
             pBAR = ProgressBar(Title="  "+progress)
@@ -711,7 +925,7 @@ class AsyncProcessPool (object):
                     job_results[jobspec][1].append(result)
                     complete_jobs += 1
                 if not job.singleton:
-                    del self._results_map[job_id]
+                    self._removeJob(job_id)
                 del awaiting_jobs[job_id]
                 if progress:
                     pBAR.render(complete_jobs,(total_jobs or 1))
@@ -733,7 +947,8 @@ class AsyncProcessPool (object):
             times = np.array([ res['time'] for res in results ])
             num_errors = len([res for res in results if not res['success']])
             if timing or progress:
-                print>> log, "%s: %d jobs complete, average single-core time %.2fs per job" % (timing or progress, len(results), times.mean())
+                print>> log, "%s: %d jobs complete, average single-core time %.2fs per job%s" % (timing or progress, len(results), times.mean(),
+                                                                                                  self._formatIdleStats(results))
             elif self.verbose > 0:
                 print>> log, "%s: %d jobs complete, average single-core time %.2fs per job" % (jobspec, len(results), times.mean())
             if num_errors:
@@ -748,6 +963,31 @@ class AsyncProcessPool (object):
             result_values.append(resvals)
         return result_values[0] if len(result_values) == 1 else result_values
 
+    @staticmethod
+    def _formatIdleStats(results):
+        """
+        Formats wall time and worker utilisation for a set of job results. Idle time is the time workers that took
+        part spent not running these jobs between the first job starting and the last job finishing, and "tail" is
+        the part of it spent after a worker's last job, waiting for the others to complete.
+        """
+        if len(results) < 2:
+            return ""
+        t0 = min([res['start'] for res in results])
+        t1 = max([res['end'] for res in results])
+        wall = t1 - t0
+        if wall <= 0:
+            return ""
+        # end of last job on each worker
+        last_end = {}
+        for res in results:
+            last_end[res['proc_id']] = max(last_end.get(res['proc_id'], t0), res['end'])
+        busy = sum([res['time'] for res in results])
+        nworkers = len(last_end)
+        idle = max(nworkers*wall - busy, 0)
+        tail = sum([t1 - t for t in last_end.itervalues()])
+        return ", wall time %.2fs, %d workers %.0f%% busy (idle %.2fs, of which tail %.2fs)" % (
+            wall, nworkers, 100*busy/(nworkers*wall), idle, tail)
+
     def terminate(self):
         if self._started:
             self._termination_event.set()
@@ -757,6 +997,7 @@ class AsyncProcessPool (object):
 
     def shutdown(self):
         """Terminate worker threads"""
+        self.writeTrace()
         if not self._started:
             return
         if not self._termination_event.is_set():
@@ -816,6 +1057,7 @@ class AsyncProcessPool (object):
 
         If reraise is True, any eceptions are re-raised. This is useful for debugging."""
         timer = ClassTimeIt.ClassTimeIt()
+        t_start = time.time()
         event = counter = None
         try:
             job_id, event_id, counter_id, args, kwargs = [jobitem.get(attr) for attr in
@@ -842,18 +1084,26 @@ class AsyncProcessPool (object):
                 print>> log, "job %s: calling %s" % (job_id, handler_desc)
             if method is None:
                 # call object directly
-                result = handler(*args, **kwargs)
+                call = handler
             else:
                 call = getattr(handler, method, None)
                 if not callable(call):
                     raise KeyError("Job %s: unknown method '%s' for handler %s" % (job_id, method, handler_desc))
+            batch = jobitem.get("batch")
+            if batch is None:
                 result = call(*args, **kwargs)
+            else:
+                # batch of jobs: call handler for each set of per-job arguments, return batch index and list of results
+                ibatch, batch_args = batch
+                result = ibatch, [ call(*(args + [ arg.instantiate() if type(arg) is shared_dict.SharedDictRepresentation
+                                                   else arg for arg in item ]), **kwargs) for item in batch_args ]
             if self.verbose > 3:
                 print>> log, "job %s: %s returns %s" % (job_id, handler_desc, result)
             # Send result back
             if jobitem['collect_result']:
                 self._result_queue.put(
-                    dict(job_id=job_id, proc_id=self.proc_id, success=True, result=result, time=timer.seconds()))
+                    dict(job_id=job_id, proc_id=self.proc_id, success=True, result=result, time=timer.seconds(),
+                         start=t_start, end=time.time()))
         except KeyboardInterrupt:
             raise
         except Exception, exc:
@@ -866,8 +1116,13 @@ class AsyncProcessPool (object):
                 AsyncProcessPool.proc_id, job_id, traceback.format_exc()))
             if jobitem['collect_result']:
                 self._result_queue.put(
-                    dict(job_id=job_id, proc_id=self.proc_id, success=False, error=exc, time=timer.seconds()))
+                    dict(job_id=job_id, proc_id=self.proc_id, success=False, error=exc, time=timer.seconds(),
+                         start=t_start, end=time.time()))
         finally:
+            if self._trace_dir:
+                submit_time = jobitem.get("submit_time") or t_start
+                self.traceEvent(jobitem.get("job_id"), jobitem["handler"][2], t_start, time.time(),
+                                proc_id=self.proc_id, queue_wait=t_start - submit_time)
             # Raise event
             if event is not None:
                 event.set()
@@ -915,8 +1170,9 @@ def _init_default():
 
 _init_default()
 
-def init(ncpu=None, affinity=None, parent_affinity=0, num_io_processes=1, verbose=0, pause_on_start=False):
+def init(ncpu=None, affinity=None, parent_affinity=0, num_io_processes=1, verbose=0, pause_on_start=False, trace_file=None):
     global APP
-    APP.init(ncpu, affinity, parent_affinity, num_io_processes, verbose, pause_on_start=pause_on_start)
+    APP.init(ncpu, affinity, parent_affinity, num_io_processes, verbose, pause_on_start=pause_on_start,
+             trace_file=trace_file)
 
 
@@ -19,12 +19,24 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 import os, os.path, subprocess
+import errno
 import cPickle
 import collections
+import hashlib
+import shutil
+import time
+import numpy as np
 
 from DDFacet.Other import MyLogger, ModColor
 log = MyLogger.getLogger("CacheManager")
 
+# hash files hold a tuple of (HASH_RECORD, hash value, element size)
+HASH_RECORD = "DDFCacheRecord1"
+
+def _isMissing(exc):
+    """True if exc is the OSError of a file that is not there, e.g. one removed by another process since it was listed"""
+    return isinstance(exc, OSError) and exc.errno == errno.ENOENT
+
 
 class CacheManager (object):
     """
@@ -89,9 +101,50 @@ class CacheManager (object):
     that influence a particular cache item are used as the hashvalue in each case.
 
     Running with DeleteDDFProducts=1 causes all caches to be reset.
+
+
+    # Content-keyed cache elements
+
+    Calling checkCache() with content=True makes the element content-addressed: the hashkeys are reduced
+    to a digest (see getContentDigest()), and the digest becomes part of the element name, e.g.
+    "Data.npy" is stored as "Data@0123456789abcdef.npy". Several versions of an element can then live
+    side by side in the same cache, and any run that asks for the same inputs finds the same element.
+    For this to be safe, the hashkeys must describe exactly the inputs the element depends on, and
+    nothing else (e.g. the MS path and its modification stamp, see getPathStamp() and ClassMS.getMSStamp(),
+    the column, the row range, and the selection options).
+
+
+    # Commit protocol
+
+    checkCache() deletes the hash file of an element that is to be re-made, before the caller writes to
+    it. saveCache() then commits the element: the element is flushed to disk, and its hash file, which
+    also records the element's size, is written to a temporary file and renamed into place. An element
+    is thus valid only once completely written, and an element that has since been truncated or
+    partially overwritten (i.e. whose size does not match the recorded one) is re-made.
+
+    Caches shared by concurrent runs (e.g. a W-kernel library) use checkSharedElement() and
+    makeSharedElement() instead: elements are written to a directory private to the writing process and
+    renamed into place, and an element that exists but is not committed is left alone.
+
+
+    # Size budgets
+
+    A cache can be given a byte budget (the budget argument, e.g. --Cache-MaxSize), and all caches of
+    a process can be given a common one (CacheManager.total_budget, e.g. --Cache-MaxTotalSize). These
+    are enforced on every saveCache(), by deleting the least recently used committed elements (an
+    element is used when checkCache() finds it valid, or when it is committed). Elements used since
+    the start of this run are never deleted, since this or another process of the run may be using them.
+    See also the CacheInventory.py script.
     """
 
-    def __init__(self, dirname, reset=False, cachedir=None, nfswarn=False):
+    # all cache managers of this process, used to enforce the total budget
+    _registry = []
+    # total size budget of all caches, in bytes. 0 for no limit.
+    total_budget = 0
+    # start of this run: elements used since are never evicted. Inherited by forked worker processes.
+    _run_start = time.time()
+
+    def __init__(self, dirname, reset=False, cachedir=None, nfswarn=False, budget=0):
         """
         Initializes cache manager.
 
@@ -100,6 +153,7 @@ class CacheManager (object):
             reset: if True, cache is reset upon first access
             cachedir: if set, caches things under cachedir/dirname. Useful for fast local storage.
             nfswarn: if True and directory is NFS mounted, prints a warning
+            budget: max size of the cache in bytes, including any caches nested in its directory. 0 for no limit.
         """
         # strip trailing slashes
         while dirname[-1] == "/":
@@ -109,13 +163,15 @@ class CacheManager (object):
         self.dirname = dirname
         self.hashes = {}
         self.pid = os.getpid()
+        self.budget = budget
+        CacheManager._registry.append(self)
         if not os.path.exists(dirname):
             print>>log, ("cache directory %s does not exist, creating" % dirname)
             os.mkdir(dirname)
         else:
             if reset:
                 print>> log, ("clearing cache %s, since we were asked to reset the cache" % dirname)
-                os.system("rm -fr "+dirname)
+                shutil.rmtree(dirname)
                 os.mkdir(dirname)
         # check for NFS system and print warning
         if nfswarn:
@@ -153,6 +209,201 @@ class CacheManager (object):
         """
         return os.path.join(self.dirname, self.getElementName(name, **kw))
 
+    @staticmethod
+    def getContentName(name, digest):
+        """Forms up the name of content-keyed element 'name' with the given digest, as NAME@DIGEST.EXT"""
+        root, ext = os.path.splitext(name)
+        return "%s@%s%s" % (root, digest, ext)
+
+    @staticmethod
+    def isContentName(filename, name):
+        """Returns True if filename is a content-keyed version of element 'name' (see getContentName())"""
+        root, ext = os.path.splitext(name)
+        return filename.startswith(root+"@") and filename.endswith(ext) and \
+               "@" not in filename[len(root)+1:len(filename)-len(ext)]
+
+    @staticmethod
+    def getContentDigest(hashkeys):
+        """
+        Returns a short hex digest of hashkeys. Hashkeys may be nested dicts, lists, tuples, numpy arrays or scalars;
+        dicts are digested in key order, so the digest does not depend on the order in which they were filled.
+        """
+        def canonical(obj):
+            if hasattr(obj, 'iteritems'):
+                return [ (canonical(key), canonical(value)) for key, value in sorted(obj.iteritems()) ]
+            if isinstance(obj, (list, tuple)):
+                return [ canonical(x) for x in obj ]
+            if isinstance(obj, np.ndarray):
+                return canonical(obj.tolist())
+            if isinstance(obj, np.generic):
+                return obj.item()
+            return obj
+        return hashlib.sha1(repr(canonical(hashkeys))).hexdigest()[:16]
+
+    @staticmethod
+    def getPathStamp(path, exclude=()):
+        """
+        Returns a modification stamp for a file, or for a directory such as an MS. For a directory, this is the latest
+        modification time and total size of the files directly inside it (i.e. the table files of an MS main table,
+        which change whenever a column is written to), leaving out the files named in exclude, and the casacore lock
+        file (table.lock), which is rewritten whenever the table is opened.
+        """
+        if not os.path.isdir(path):
+            st = os.stat(path)
+            return st.st_mtime, st.st_size
+        mtime, size = 0, 0
+        for filename in os.listdir(path):
+            filepath = os.path.join(path, filename)
+            if filename != "table.lock" and filename not in exclude and not os.path.isdir(filepath):
+                st = os.stat(filepath)
+                mtime = max(mtime, st.st_mtime)
+                size += st.st_size
+        return mtime, size
+
+    @staticmethod
+    def getElementSize(path):
+        """Returns the size in bytes of a cache element (a file, or a directory)"""
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        size = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError, exc:
+                    if not _isMissing(exc):
+                        raise
+        return size
+
+    @staticmethod
+    def _syncElement(path):
+        """Flushes a cache element (a file, or a directory) to disk"""
+        if os.path.isdir(path):
+            paths = [ os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(path)
+                      for filename in filenames ]
+        else:
+            paths = [path]
+        for filepath in paths:
+            fd = os.open(filepath, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _removeElement(path):
+        """Removes a cache element (a file, or a directory). Files removed meanwhile by another process are skipped."""
+        def onerror(func, filepath, exc_info):
+            if not _isMissing(exc_info[1]):
+                raise exc_info[0], exc_info[1], exc_info[2]
+        if os.path.isdir(path):
+            shutil.rmtree(path, onerror=onerror)
+        elif os.path.lexists(path):
+            try:
+                os.unlink(path)
+            except OSError, exc:
+                if not _isMissing(exc):
+                    raise
+
+    @staticmethod
+    def getInventory(dirname):
+        """
+        Returns the contents of the cache in directory dirname, including the caches nested in it (e.g. the per-chunk
+        caches of an MS cache), as a list of (path, size, last_used, committed) tuples. Committed elements have a
+        hash file, and last_used is the time it was last touched. Other files, such as those of elements still being
+        written (or left behind by an interrupted run) are listed as not committed. Files named after a committed
+        element (e.g. PSF.DicoPickle, next to PSF) are counted as part of that element. Files removed by another
+        process (e.g. a concurrent eviction or commit) while the inventory is taken are left out.
+        """
+        try:
+            entries = sorted(os.listdir(dirname))
+        except OSError, exc:
+            if _isMissing(exc):
+                return []
+            raise
+        committed = set([ filename[:-5] for filename in entries if filename.endswith(".hash") ])
+        items = []
+        extras = collections.defaultdict(int)
+        for filename in entries:
+            path = os.path.join(dirname, filename)
+            if filename.endswith(".hash") or ".hash.tmp" in filename:
+                continue
+            try:
+                if filename in committed:
+                    items.append([path, CacheManager.getElementSize(path), os.stat(path+".hash").st_mtime, True])
+                    continue
+                owner = [ name for name in committed if filename.startswith(name+".") ]
+                if owner:
+                    extras[os.path.join(dirname, owner[0])] += CacheManager.getElementSize(path)
+                elif os.path.isdir(path):
+                    items += [ list(item) for item in CacheManager.getInventory(path) ]
+                else:
+                    st = os.stat(path)
+                    items.append([path, st.st_size, st.st_mtime, False])
+            except OSError, exc:
+                if not _isMissing(exc):
+                    raise
+        for item in items:
+            item[1] += extras.get(item[0], 0)
+        return [ tuple(item) for item in items ]
+
+    @staticmethod
+    def trimCaches(dirnames, budget, protect_since=None):
+        """
+        Enforces a size budget (in bytes) on the caches in the given directories, by deleting committed elements,
+        least recently used first. Elements used since time protect_since are never deleted. Returns the size of the
+        caches after trimming.
+        """
+        items = [ item for dirname in dirnames if os.path.isdir(dirname)
+                  for item in CacheManager.getInventory(dirname) ]
+        total = sum([ size for _, size, _, _ in items ])
+        if total <= budget:
+            return total
+        for path, size, last_used, committed in sorted(items, key=lambda item: item[2]):
+            if not committed:
+                continue
+            if protect_since is not None and last_used >= protect_since:
+                print>>log, ModColor.Str("WARNING: caches in %s are %.2f GB, over budget of %.2f GB, but the remaining "
+                                         "elements are in use" % (",".join(dirnames), total/float(1<<30),
+                                                                  budget/float(1<<30)), col="red")
+                break
+            print>>log, "caches are %.2f GB, over budget of %.2f GB: evicting %s (%.2f GB)" % \
+                        (total/float(1<<30), budget/float(1<<30), path, size/float(1<<30))
+            # remove the hash first: an interrupted eviction leaves an invalid element behind, not a valid truncated one
+            try:
+                try:
+                    os.unlink(path + ".hash")
+                except OSError, exc:
+                    # already being evicted by another process: finish the job
+                    if not _isMissing(exc):
+                        raise
+                CacheManager._removeElement(path)
+                for filename in os.listdir(os.path.dirname(path)):
+                    if filename.startswith(os.path.basename(path)+"."):
+                        CacheManager._removeElement(os.path.join(os.path.dirname(path), filename))
+            except OSError, exc:
+                print>>log, ModColor.Str("WARNING: failed to evict %s: %s" % (path, exc), col="red")
+                continue
+            total -= size
+            if total <= budget:
+                break
+        return total
+
+    @staticmethod
+    def _getTopDirs(dirnames):
+        """Returns the directories that are not nested in any of the others"""
+        dirnames = set(dirnames)
+        return sorted([ dirname for dirname in dirnames if not any([ dirname.startswith(other + "/")
+                                                                     for other in dirnames ]) ])
+
+    def enforceBudgets(self):
+        """Enforces the budget of this cache, and the total budget of all caches of this process"""
+        if self.budget:
+            CacheManager.trimCaches([self.dirname], self.budget, protect_since=CacheManager._run_start)
+        if CacheManager.total_budget:
+            dirnames = CacheManager._getTopDirs([ cache.dirname for cache in CacheManager._registry ])
+            CacheManager.trimCaches(dirnames, CacheManager.total_budget, protect_since=CacheManager._run_start)
+
     def getCacheURL (self, name, **kw):
         """
         Forms up a URL for a disk-backed shared element. This takes the form of "file://PATH", where path is
@@ -160,7 +411,7 @@ class CacheManager (object):
         """
         return "file://" + self.getElementPath(name, **kw)
 
-    def checkCache(self, name, hashkeys, directory=False, reset=False, ignore_key=False):
+    def checkCache(self, name, hashkeys, directory=False, reset=False, ignore_key=False, content=False):
         """
         Checks if cached element named "name" is valid.
 
@@ -172,25 +423,27 @@ class CacheManager (object):
                 doesn't exist. If the cache is invalid, the contents of the directory will be deleted.
             reset: if True, cache item is deleted
             ignore_key: if True, keys are not compared, and cache is considered valid regardless.
+            content: if True, element is content-keyed: its name on disk includes a digest of the keys, and the
+                digest is used as the hash value. See class documentation.
 
         Returns:
             tuple of (path, valid)
             where path is a path to cache object (or cache directory)
             and valid is True if a valid cache exists
         """
-        cachepath = self.getElementPath(name)
+        if content:
+            hash = self.getContentDigest(hashkeys)
+            cachepath = self.getElementPath(self.getContentName(name, hash))
+        else:
+            hash = hashkeys
+            cachepath = self.getElementPath(name)
         hashpath = cachepath + ".hash"
-        # convert hash keys into a single list
-        hash = hashkeys
-        self.hashes[name] = hashpath, hash
         # delete cache if explicitly asked to
         if reset:
             print>>log, "cache element %s will be explicitly reset" % cachepath
         else:
             if not os.path.exists(cachepath):
                 print>>log, "cache element %s does not exist, will re-make" % cachepath
-                if directory:
-                    os.mkdir(cachepath)
                 reset = True
             # check for stored hash
             if not reset:
@@ -199,10 +452,19 @@ class CacheManager (object):
                 except:
                     print>>log, "cache hash %s invalid, will re-make" % hashpath
                     reset = True
+            # check that the element is still the size it was committed with (hash files written before the
+            # commit protocol hold a bare hash value, and carry no size)
+            if not reset:
+                storedsize = None
+                if type(storedhash) is tuple and len(storedhash) == 3 and storedhash[0] == HASH_RECORD:
+                    _, storedhash, storedsize = storedhash
+                if storedsize is not None and self.getElementSize(cachepath) != storedsize:
+                    print>>log, "cache element %s is not the size it was written with, will re-make" % cachepath
+                    reset = True
             # check for hash match
             if not reset and not ignore_key and hash != storedhash:
                 ListDiffer=[]
-                for MainField, D1 in storedhash.iteritems():
+                for MainField, D1 in (storedhash.iteritems() if not content else ()):
                     if MainField not in hash:
                         ListDiffer.append("(%s: missing in hash)" % (str(MainField)))
                         continue
@@ -222,7 +484,7 @@ class CacheManager (object):
                     else:
                         if D0 != D1:
                             ListDiffer.append("(%s: %s vs %s)"%(str(MainField),str(D0),str(D1)))
-                for MainField in set(hash.keys()) - set(storedhash.keys()):
+                for MainField in (set(hash.keys()) - set(storedhash.keys()) if not content else ()):
                     ListDiffer.append(
                         "(%s: missing in stored hash)" % (str(MainField)))
 
@@ -237,11 +499,17 @@ class CacheManager (object):
                 os.unlink(hashpath)
             if os.path.exists(cachepath):
                 if directory:
-                    if os.system("rm -fr %s" % cachepath):
+                    try:
+                        shutil.rmtree(cachepath)
+                    except OSError:
                         raise OSError,"Failed to remove cache directory %s. Check permissions/ownership." % cachepath
-                    os.mkdir(cachepath)
                 else:
                     os.unlink(cachepath)
+            if directory:
+                os.mkdir(cachepath)
+        else:
+            # mark element as recently used
+            os.utime(hashpath, None)
 
         # store hash
         self.hashes[name] = hashpath, hash, reset
@@ -250,6 +518,7 @@ class CacheManager (object):
     def saveCache(self, name=None):
         """
         Saves cache hash to disk. Meant to be called after a cache object has been successfully written to.
+        This commits the cache object (see class documentation), and enforces the size budgets.
 
         Args:
             name: name of cache object. If None, all accumulated objects are flushed.
@@ -261,6 +530,80 @@ class CacheManager (object):
         for name in names:
             hashpath, hash, reset = self.hashes[name]
             if reset:
-                cPickle.dump(hash, file(hashpath, "w"))
+                cachepath = hashpath[:-5]
+                self._syncElement(cachepath)
+                tmppath = "%s.tmp%d" % (hashpath, os.getpid())
+                with open(tmppath, "w") as f:
+                    cPickle.dump((HASH_RECORD, hash, self.getElementSize(cachepath)), f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmppath, hashpath)
                 print>>log, "writing cache hash %s" % hashpath
                 del self.hashes[name]
+                self.enforceBudgets()
+
+    def checkSharedElement(self, name, hashkeys):
+        """
+        Checks content-keyed directory element 'name' (see checkCache()) of a cache that is shared by concurrent
+        runs, such as a W-kernel library. Unlike checkCache(), this never deletes or resets anything, since another
+        run may be writing the element. Use makeSharedElement() to make a missing element.
+
+        Returns:
+            tuple of (path, state)
+            where state is "valid" if the element is committed, "missing" if it does not exist, and "busy" if it
+            exists but is not committed (i.e. another run is committing it, or it is not the size it was
+            committed with). A busy element should be computed locally, and not saved.
+        """
+        hash = self.getContentDigest(hashkeys)
+        cachepath = self.getElementPath(self.getContentName(name, hash))
+        hashpath = cachepath + ".hash"
+        if not os.path.exists(cachepath):
+            return cachepath, "missing"
+        try:
+            storedhash = cPickle.load(file(hashpath))
+        except:
+            return cachepath, "busy"
+        if storedhash != (HASH_RECORD, hash, self.getElementSize(cachepath)):
+            return cachepath, "busy"
+        # mark element as recently used
+        os.utime(hashpath, None)
+        return cachepath, "valid"
+
+    def makeSharedElement(self, name, hashkeys, writer):
+        """
+        Makes and commits content-keyed directory element 'name' (see checkSharedElement()). The element is written
+        into a directory private to this process by writer(dirname), and renamed into place once complete, so other
+        runs only ever see a complete element. If another run has meanwhile made the element, the private copy is
+        discarded.
+
+        Returns:
+            True if this process made the element
+        """
+        hash = self.getContentDigest(hashkeys)
+        cachepath = self.getElementPath(self.getContentName(name, hash))
+        # not named cachepath+".*", so that it is not taken for part of the element (see getInventory())
+        tmppath = "%s~tmp%d" % (cachepath, os.getpid())
+        self._removeElement(tmppath)
+        os.mkdir(tmppath)
+        try:
+            writer(tmppath)
+            self._syncElement(tmppath)
+            # renaming onto a non-empty directory fails, so of concurrent writers, only the first succeeds
+            os.rename(tmppath, cachepath)
+        except OSError:
+            if not os.path.exists(cachepath):
+                raise
+            print>>log, "cache element %s was made by another run" % cachepath
+            return False
+        finally:
+            self._removeElement(tmppath)
+        hashpath = cachepath + ".hash"
+        tmppath = "%s.tmp%d" % (hashpath, os.getpid())
+        with open(tmppath, "w") as f:
+            cPickle.dump((HASH_RECORD, hash, self.getElementSize(cachepath)), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmppath, hashpath)
+        print>>log, "writing cache hash %s" % hashpath
+        self.enforceBudgets()
+        return True
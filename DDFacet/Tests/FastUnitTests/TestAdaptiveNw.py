@@ -0,0 +1,101 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from DDFacet.Imager import ModCF
+from DDFacet.ToolsDir import ModFitPoly2D
+
+
+class _CFDict(dict):
+    """Holds the kernels of a ClassWTermModified, in place of a SharedDict"""
+    def addSharedArray(self, name, shape, dtype):
+        self[name] = np.zeros(shape, dtype)
+        return self[name]
+
+def _giveWTerm(lmShift=(0., 0.), wmax=1000., Nw=64, PhaseError=0.05, cf_dict=None):
+    # 101 pixels of 1' (a facet radius of 0.84 deg), at a wavelength of 2 m
+    compute_cf = cf_dict is None
+    return ModCF.ClassWTermModified(Cell=60., Sup=7, Nw=Nw, wmax=wmax, Npix=101, Freqs=np.array([149896229.]),
+                                    OverS=3, lmShift=lmShift, cf_dict=_CFDict() if compute_cf else cf_dict,
+                                    compute_cf=compute_cf, AdaptivePhaseError=PhaseError)
+
+def _giveMaxPhaseError(WTerm):
+    """Max w-term phase error over the facet of a visibility halfway between two w-planes"""
+    lrad, _, _, CoefPoly = WTerm.giveFacet_dn()
+    l, m = np.mgrid[-lrad:lrad:101j, -lrad:lrad:101j]
+    n_1 = ModFitPoly2D.polyval2d(l, m, CoefPoly)
+    dw = WTerm.wmax/(WTerm.Nw-1.)
+    return np.pi*dw*(n_1.max()-n_1.min())/WTerm.RefWave
+
+def testAdaptiveNwBounds():
+    # capped at Nw, with a floor of 2
+    assert _giveWTerm(PhaseError=1e-4, Nw=16).Nw == 16
+    assert _giveWTerm(PhaseError=100.).Nw == 2
+
+def testAdaptiveNwGrowth():
+    NwCentre = _giveWTerm().Nw
+    NwOffset = _giveWTerm(lmShift=(.4, .4)).Nw
+    NwFar = _giveWTerm(wmax=4000.).Nw
+    assert 2 < NwCentre < NwOffset < 64
+    assert NwCentre < NwFar < 64
+
+def testAdaptiveNwPhaseError():
+    for lmShift in (0., 0.), (.1, -.2), (.4, .4):
+        for wmax in 1000., 4000.:
+            WTerm = _giveWTerm(lmShift=lmShift, wmax=wmax)
+            assert WTerm.Nw < 64
+            assert _giveMaxPhaseError(WTerm) <= WTerm.AdaptivePhaseError
+            # one plane less would go over
+            WTerm.Nw -= 1
+            assert _giveMaxPhaseError(WTerm) > WTerm.AdaptivePhaseError
+
+def testAdaptiveNwCached():
+    # the cached kernels are loaded with the number of planes they were computed with, which is worked out again
+    # from the wmax they were computed for, whatever wmax is passed in
+    WTerm = _giveWTerm(lmShift=(.4, .4), wmax=4000.)
+    cf_dict = _CFDict(Sphe=WTerm.ifzfCF, CuCv=np.array([WTerm.Cu, WTerm.Cv]), wmax=WTerm.wmax)
+    ModCF.NpShared.PackListSquareMatrix(cf_dict, "W", WTerm.Wplanes + WTerm.WplanesConj)
+    Cached = _giveWTerm(lmShift=(.4, .4), wmax=1000., cf_dict=cf_dict)
+    assert Cached.Nw == WTerm.Nw and Cached.wmax == 4000.
+    assert len(Cached.Wplanes) == len(WTerm.Wplanes)
+    assert all([ (A == B).all() for A, B in zip(Cached.Wplanes, WTerm.Wplanes) ])
+
+def testLibraryReadError():
+    # a broken library entry is recomputed, also with a plain dict holding the kernels
+    library = tempfile.mkdtemp()
+    try:
+        WTerm = _giveWTerm()
+        lib = ModCF.GiveWKernelLibrary(library)
+        path, state = lib.checkSharedElement("WKernels", WTerm.giveLibraryKey(1000.))
+        assert state == "missing"
+        def writer(dirname):
+            for key in ModCF.WKERNEL_KEYS[:2]:
+                np.save(os.path.join(dirname, key+".npy"), np.zeros(1))
+        assert lib.makeSharedElement("WKernels", WTerm.giveLibraryKey(1000.), writer)
+        cf_dict = _CFDict()
+        assert not WTerm.loadFromLibrary(library, cf_dict, 1000.)
+        assert not [ key for key in ModCF.WKERNEL_KEYS if key in cf_dict ]
+    finally:
+        shutil.rmtree(library)
@@ -0,0 +1,44 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+
+
+import numpy as np
+from DDFacet.Imager.MSMF.ClassComponentTable import ClassComponentTable
+
+
+def testRenderGaussianPaths():
+    np.random.seed(0)
+    Gauss = np.float32(np.exp(-np.arange(-4, 5)[:, None]**2/4.-np.arange(-4, 5)[None, :]**2/4.))
+    x, y = np.random.randint(0, 20, 80), np.random.randint(0, 64, 80)
+    x, y = np.array(sorted(set(zip(x, y)))).T
+    Flux = np.float32(np.random.randn(x.size, 1))
+    # this many components are gridded and FFT-convolved with the kernel
+    assert x.size*Gauss.size > 64*64
+    Image = np.zeros((1, 64, 64), np.float32)
+    ClassComponentTable._renderGaussian(Image, x, y, Flux, Gauss)
+    # one at a time, they are scattered one kernel pixel at a time
+    Ref = np.zeros((1, 64, 64), np.float32)
+    for i in xrange(x.size):
+        ClassComponentTable._renderGaussian(Ref, x[i:i+1], y[i:i+1], Flux[i:i+1], Gauss)
+    # both leave the pixels out of reach of the components at exactly zero
+    assert (Ref[:, 25:, :] == 0).all()
+    assert ((Image != 0) == (Ref != 0)).all()
+    assert np.allclose(Image, Ref, atol=1e-5)
@@ -0,0 +1,58 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+
+import numpy as np
+import scipy.ndimage
+from DDFacet.ToolsDir import ModFacetMask
+
+
+def _bruteMask(polygons, l0, l1, m0, m1, Npix):
+    X, Y = np.mgrid[l0:l1:Npix * 1j, m0:m1:Npix * 1j]
+    mask = np.ones(X.shape, bool)
+    for P in polygons:
+        P = np.array(P, np.float64)
+        if (P[:, 0]*np.roll(P[:, 1], -1) - np.roll(P[:, 0], -1)*P[:, 1]).sum() < 0:
+            P = P[::-1]
+        for (px, py), (qx, qy) in zip(P, np.roll(P, -1, axis=0)):
+            mask &= (qx-px)*(Y-py) - (qy-py)*(X-px) >= 0
+    return mask
+
+def testConvexRuns():
+    np.random.seed(0)
+    Corners = np.array([[-.8, -.8], [.8, -.8], [.8, .8], [-.8, .8]])
+    for it in range(20):
+        # random convex polygon, in either orientation
+        angles = np.sort(np.random.uniform(0, 2*np.pi, np.random.randint(3, 9)))[::np.random.choice([-1, 1])]
+        lc, mc = np.random.uniform(-.8, .8, 2)
+        Polygon = np.array([lc+.3*np.cos(angles), mc+.3*np.sin(angles)]).T
+        Extent = lc-.4, lc+.4, mc-.4, mc+.4
+        for Npix in 31, 200:
+            j0, j1 = ModFacetMask.GiveConvexRuns([Polygon, Corners], *(Extent + (Npix,)))
+            assert (ModFacetMask.GiveRunsMask(j0, j1) == _bruteMask([Polygon, Corners], *(Extent + (Npix,)))).all()
+    # non-convex polygons are not rasterised by scanline
+    assert ModFacetMask.GiveConvexRuns([[[0, 0], [2, 0], [1, .2], [2, 2], [0, 2]]], 0, 2, 0, 2, 5) is None
+
+def testSmoothRuns():
+    Polygon = np.array([[-.3, -.2], [.25, -.3], [.35, .1], [0, .33], [-.3, .2]])
+    j0, j1 = ModFacetMask.GiveConvexRuns([Polygon], -.6, .6, -.6, .6, 301)
+    SW = ModFacetMask.SmoothRuns(j0, j1, 10., blocksize=64)
+    Ref = scipy.ndimage.gaussian_filter(np.float64(ModFacetMask.GiveRunsMask(j0, j1)), 10., mode="constant", truncate=8)
+    assert np.allclose(SW/SW.max(), Ref/Ref.max(), atol=1e-6)
@@ -0,0 +1,75 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+import numpy as np
+from DDFacet.Array.ClassMaxPyramid import ClassMaxPyramid
+
+
+def _bruteWhereMax(A, DoAbs, Mask):
+    """Peak value as found by the C code of NpParallel.A_whereMax: NaNs skipped, and 0 if no pixel is positive"""
+    B = np.abs(A) if DoAbs else A.copy()
+    B[np.isnan(B)] = -np.inf
+    if Mask is not None:
+        B[Mask != 0] = -np.inf
+    return max(B.max(), 0)
+
+def testMaxPyramidLocalUpdates():
+    np.random.seed(0)
+    for DoAbs in [0, 1]:
+        for Mask in [None, np.random.rand(1, 1, 123, 97) < 0.3]:
+            A = np.float32(np.random.randn(1, 1, 123, 97))
+            Index = ClassMaxPyramid(A, DoAbs=DoAbs, Mask=Mask, TileSize=16)
+            for it in range(50):
+                x, y = np.random.randint(0, 123), np.random.randint(0, 97)
+                x0, x1, y0, y1 = max(x-10, 0), x+10, max(y-10, 0), y+10
+                A[0, 0, x0:x1, y0:y1] -= np.float32(np.random.randn()*3)
+                Index.update(x0, x1, y0, y1)
+                x, y, V = Index.whereMax()
+                assert V == _bruteWhereMax(A[0, 0], DoAbs, None if Mask is None else Mask[0, 0])
+                assert V == (abs(A[0, 0, x, y]) if DoAbs else A[0, 0, x, y])
+                assert Mask is None or not Mask[0, 0, x, y]
+
+def testMaxPyramidAllMasked():
+    A = np.float32(np.random.randn(1, 1, 40, 30))
+    Mask = np.ones(A.shape, bool)
+    for DoAbs in [0, 1]:
+        Index = ClassMaxPyramid(A, DoAbs=DoAbs, Mask=Mask, TileSize=16)
+        assert Index.whereMax() == (0, 0, 0.)
+
+def testMaxPyramidAllNegative():
+    A = -np.float32(np.random.rand(1, 1, 40, 30)) - 1
+    # the C code only looks for the peak above 0
+    assert ClassMaxPyramid(A, DoAbs=0, TileSize=16).whereMax() == (0, 0, 0.)
+    x, y, V = ClassMaxPyramid(A, DoAbs=1, TileSize=16).whereMax()
+    assert V == np.abs(A).max() == abs(A[0, 0, x, y])
+
+def testMaxPyramidNaN():
+    np.random.seed(1)
+    A = np.float32(np.random.randn(2, 1, 40, 30))
+    A[0, 0, 3, 4] = A[1, 0, 20, 21] = np.nan
+    for DoAbs in [0, 1]:
+        Index = ClassMaxPyramid(A, DoAbs=DoAbs, TileSize=16)
+        x, y, V = Index.whereMax()
+        assert V == _bruteWhereMax(A, DoAbs, None)
+        # a NaN at the peak moves it to the next largest pixel
+        A[:, :, x, y] = np.nan
+        Index.update(x, x+1, y, y+1)
+        x, y, V = Index.whereMax()
+        assert V == _bruteWhereMax(A, DoAbs, None) == (np.abs(A) if DoAbs else A)[:, 0, x, y].max()
@@ -0,0 +1,45 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+
+
+import numpy as np
+import scipy.ndimage
+from DDFacet.Imager.ClassImageNoiseMachine import GiveMinStatNoise
+
+
+def testMinStatNoiseIncremental():
+    np.random.seed(0)
+    SBox, ratio, Th = (10, 10), 2.5, 0.1
+    A = np.random.randn(200, 200)
+    Noise, NoiseMed, State = GiveMinStatNoise(A, SBox, ratio)
+    for it in range(20):
+        # slow drift just below the threshold in one corner, which is never recomputed when the image is only
+        # compared to that of the previous cycle
+        A[20:40, 20:40] -= 0.9*Th*NoiseMed
+        # a large change elsewhere
+        x, y = np.random.randint(0, 190, 2)
+        A[x:x+10, y:y+10] += np.random.randn(10, 10)
+        Noise, NoiseMed1, State = GiveMinStatNoise(A, SBox, ratio, State, Th)
+        assert NoiseMed1 == NoiseMed
+        Ref = -scipy.ndimage.filters.minimum_filter(A, SBox)/ratio
+        # tiles are recomputed if a pixel in their footprint drifted by over Th*NoiseMed since the tile or its
+        # neighbour was last filtered
+        assert np.abs(Noise-Ref).max() <= 2*Th*NoiseMed/ratio
@@ -40,22 +40,19 @@ class ClassCoordConv():
         
 
     def lm2radec(self,l_list,m_list):
-
-        ra_list=np.zeros(l_list.shape,dtype=np.float)
-        dec_list=np.zeros(l_list.shape,dtype=np.float)
-        
-        for i in range(l_list.shape[0]):
-            l=l_list[i]
-            m=m_list[i]
-            if (l_list[i]==0.)&(m_list[i]==0.):
-                ra_list[i]=self.rarad
-                dec_list[i]=self.decrad
-                continue
-            Rp=self.R+self.vl2*l+self.vm2*m-(1.-np.sqrt(1.-l**2-m**2))*self.vn2
-            dec_list[i]=np.arcsin(Rp[2])
-            ra_list[i]=np.arctan(Rp[1]/Rp[0])
-            if Rp[0]<0.: ra_list[i]+=np.pi
-    
+        """Converts arrays of l,m coordinates to ra,dec, all directions at once"""
+        l=np.asarray(l_list,dtype=np.float64)
+        m=np.asarray(m_list,dtype=np.float64)
+        R,vl2,vm2,vn2=[np.asarray(v).reshape((3,)+(1,)*l.ndim) for v in (self.R,self.vl2,self.vm2,self.vn2)]
+        Rp=R+vl2*l+vm2*m-(1.-np.sqrt(1.-l**2-m**2))*vn2
+        dec_list=np.arcsin(Rp[2])
+        with np.errstate(divide="ignore",invalid="ignore"):
+            ra_list=np.arctan(Rp[1]/Rp[0])
+        ra_list[Rp[0]<0.]+=np.pi
+        # the phase centre itself is given exactly
+        centre=(l==0.)&(m==0.)
+        ra_list[centre]=self.rarad
+        dec_list[centre]=self.decrad
         return ra_list,dec_list
 
     def radec2lm(self,ra,dec):
@@ -0,0 +1,143 @@
+'''
+DDFacet, a facet-based radio imaging package
+Copyright (C) 2013-2016  Cyril Tasse, l'Observatoire de Paris,
+SKA South Africa, Rhodes University
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+# Facet masks and spatial weights.
+#
+# Facets are convex (Voronoi cells, or squares, clipped by the square image), so their mask is a single run of
+# pixels per row. GiveConvexRuns() finds these runs by scanline, and the mask is smoothed separably: the row
+# pass is a lookup in the cumulative sum of the Gaussian (the sum of the Gaussian over a run), and the column
+# pass a 1D FFT convolution over the columns the facet touches.
+
+import numpy as np
+
+
+def _halfPlanes(vertices):
+    """
+    Returns the edges of a polygon as (px, py, dx, dy) arrays, oriented counter-clockwise, so that the inside
+    is on the left of each edge. Returns None if the polygon is not convex.
+    """
+    P = np.array(vertices, np.float64).reshape((-1, 2))
+    # drop closing vertex, if present
+    if len(P) > 1 and (P[0] == P[-1]).all():
+        P = P[:-1]
+    px, py = P[:, 0], P[:, 1]
+    dx, dy = np.roll(px, -1) - px, np.roll(py, -1) - py
+    # convex if all turns are in the direction of the polygon's orientation (or straight)
+    sense = np.sign((px*np.roll(py, -1) - np.roll(px, -1)*py).sum())
+    turns = sense*(dx*np.roll(dy, -1) - dy*np.roll(dx, -1))
+    if (turns < -1e-12*np.abs(turns).max()).any():
+        return None
+    # orient counter-clockwise
+    if sense < 0:
+        px, py, dx, dy = np.roll(px, -1), np.roll(py, -1), -dx, -dy
+    return px, py, dx, dy
+
+
+def GiveConvexRuns(polygons, l0, l1, m0, m1, Npix):
+    """
+    Rasterises the intersection of convex polygons onto an Npix x Npix grid spanning [l0,l1] along axis 0 and
+    [m0,m1] along axis 1, with the same pixel positions as np.mgrid[l0:l1:Npix*1j, m0:m1:Npix*1j].
+
+    Returns (j0, j1) arrays of size Npix: the pixels of row i inside the polygons are j0[i]<=j<j1[i] (j0>=j1 for
+    rows outside). Returns None if one of the polygons is not convex.
+    """
+    x = np.linspace(l0, l1, Npix)
+    lo = np.empty(Npix)
+    hi = np.empty(Npix)
+    lo.fill(-np.inf)
+    hi.fill(np.inf)
+    for vertices in polygons:
+        edges = _halfPlanes(vertices)
+        if edges is None:
+            return None
+        # the inside of edge k is dx*(y-py) - dy*(x-px) >= 0: a lower bound on y for dx>0, an upper one for dx<0
+        for px, py, dx, dy in zip(*edges):
+            if dx > 0:
+                np.maximum(lo, py + dy*(x-px)/dx, out=lo)
+            elif dx < 0:
+                np.minimum(hi, py + dy*(x-px)/dx, out=hi)
+            elif dy != 0:
+                hi[dy*(x-px) > 0] = -np.inf
+    dm = (m1-m0)/float(Npix-1)
+    j0 = np.clip(np.ceil((lo-m0)/dm), 0, Npix).astype(np.int64)
+    j1 = np.clip(np.floor((hi-m0)/dm)+1, 0, Npix).astype(np.int64)
+    return j0, j1
+
+
+def GiveRunsMask(j0, j1):
+    """Converts runs (see GiveConvexRuns()) to a boolean mask"""
+    j = np.arange(len(j0))
+    return (j[np.newaxis, :] >= j0[:, np.newaxis]) & (j[np.newaxis, :] < j1[:, np.newaxis])
+
+
+def GiveFacetMask(polygons, l0, l1, m0, m1, Npix):
+    """
+    Returns the Npix x Npix boolean mask of the intersection of polygons (see GiveConvexRuns()). Non-convex
+    polygons are rasterised with matplotlib.
+    """
+    runs = GiveConvexRuns(polygons, l0, l1, m0, m1, Npix)
+    if runs is not None:
+        return GiveRunsMask(*runs)
+    from matplotlib.path import Path
+    X, Y = np.mgrid[l0:l1:Npix * 1j, m0:m1:Npix * 1j]
+    XY_flat = np.dstack((X, Y)).reshape((-1, 2))
+    mask = np.ones(XY_flat.shape[0], bool)
+    for vertices in polygons:
+        mask &= Path(vertices).contains_points(XY_flat)
+    return mask.reshape(X.shape)
+
+
+def SmoothRuns(j0, j1, Sig, truncate=6., blocksize=256):
+    """
+    Convolves the mask given by runs (see GiveConvexRuns()) with a Gaussian exp(-r**2/(2*Sig**2)), Sig in pixels,
+    zero outside the grid. Returns an Npix x Npix float32 array. Columns are processed in blocks of blocksize.
+    """
+    Npix = len(j0)
+    out = np.zeros((Npix, Npix), np.float32)
+    rows = np.where(j1 > j0)[0]
+    if not len(rows):
+        return out
+    R = int(np.ceil(truncate*Sig))
+    g = np.exp(-np.arange(-R, R+1)**2/(2.*Sig**2))
+    # cumulative sum of the Gaussian, G[k] = sum(g[:k])
+    G = np.concatenate(([0.], np.cumsum(g)))
+    # rows and columns reached by the smoothed facet
+    i0, i1 = max(rows[0]-R, 0), min(rows[-1]+R+1, Npix)
+    c0, c1 = max(j0[rows].min()-R, 0), min(j1[rows].max()+R, Npix)
+    # FFT size for the column pass, with room for the Gaussian to not wrap around
+    nfft = 1
+    while nfft < (i1-i0)+2*R:
+        nfft *= 2
+    kern = np.zeros(nfft)
+    kern[:R+1] = g[R:]
+    kern[-R:] = g[:R]
+    fkern = np.fft.rfft(kern)[:, np.newaxis]
+    for b0 in xrange(c0, c1, blocksize):
+        b1 = min(b0+blocksize, c1)
+        # row pass: sum of the Gaussian over the run, at each column
+        j = np.arange(b0, b1)[np.newaxis, :]
+        a = np.clip(j0[i0:i1, np.newaxis] - j + R, 0, 2*R+1)
+        b = np.clip(j1[i0:i1, np.newaxis] - j + R, 0, 2*R+1)
+        A = np.where(b > a, G[b] - G[a], 0.)
+        # column pass
+        fA = np.fft.rfft(A, n=nfft, axis=0)
+        fA *= fkern
+        out[i0:i1, b0:b1] = np.fft.irfft(fA, n=nfft, axis=0)[:i1-i0]
+    return out
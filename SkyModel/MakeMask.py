@@ -388,49 +388,24 @@ class ClassMakeMask():
 
         print>>log,"  Labeling islands"
         self.ImIsland,NIslands=scipy.ndimage.label(self.ImMask)
-        ImIsland=self.ImIsland
-        NIslands+=1
-        nx,_=ImIsland.shape
 
         print>>log,"  Found %i islands"%NIslands
-        
-        NMaxPix=100000
-        Island=np.zeros((NIslands,NMaxPix,2),np.int32)
-        NIslandNonZero=np.zeros((NIslands,),np.int32)
 
         print>>log,"  Extracting pixels in islands"
-        pBAR= ProgressBar('white', width=50, block='=', empty=' ',Title="      Extracting ", HeaderSize=10,TitleSize=13)
-        comment=''
-
-
-
-        for ipix in range(nx):
-            
-            pBAR.render(int(100*ipix / (nx-1)), comment)
-            for jpix in range(nx):
-                iIsland=self.ImIsland[ipix,jpix]
-                if iIsland:
-                    NThis=NIslandNonZero[iIsland]
-                    Island[iIsland,NThis,0]=ipix
-                    Island[iIsland,NThis,1]=jpix
-                    NIslandNonZero[iIsland]+=1
+        X,Y,Offsets=ClassIslands.GiveIslandPixelIndex(self.ImIsland,NIslands)
+        S=self.Restored[0,0,X,Y]
 
         print>>log,"  Listing pixels in islands"
 
         NMinPixIsland=5
         DicoIslands=collections.OrderedDict()
-        for iIsland in range(1,NIslands):
-            ind=np.where(Island[iIsland,:,0]!=0)[0]
-            if ind.size < NMinPixIsland: continue
-            Npix=ind.size
-            Comps=np.zeros((Npix,3),np.float32)
-            for ipix in range(Npix):
-                x,y=Island[iIsland,ipix,0],Island[iIsland,ipix,1]
-                s=self.Restored[0,0,x,y]
-                Comps[ipix,0]=x
-                Comps[ipix,1]=y
-                Comps[ipix,2]=s
-            DicoIslands[iIsland]=Comps
+        for iIsland in np.where(np.diff(Offsets)>=NMinPixIsland)[0]:
+            i0,i1=Offsets[iIsland],Offsets[iIsland+1]
+            Comps=np.zeros((i1-i0,3),np.float32)
+            Comps[:,0]=X[i0:i1]
+            Comps[:,1]=Y[i0:i1]
+            Comps[:,2]=S[i0:i1]
+            DicoIslands[iIsland+1]=Comps
 
         print>>log,"  Final number of islands: %i"%len(DicoIslands)
         self.DicoIslands=DicoIslands
@@ -598,10 +573,9 @@ class ClassMakeMask():
         print>>log, "  Building mask image from filtered islands"
         #pBAR= ProgressBar('white', width=50, block='=', empty=' ',Title="      Building ", HeaderSize=10,TitleSize=13)
         #comment=''
-        for iIsland in DicoIslands.keys():
-            #pBAR.render(int(100*iIsland / float(len(DicoIslands.keys())-1)), comment)
-            x,y,s=DicoIslands[iIsland].T
-            self.ImMask[np.int32(x),np.int32(y)]=1
+        if not DicoIslands: return
+        Comps=np.concatenate(DicoIslands.values())
+        self.ImMask[np.int32(Comps[:,0]),np.int32(Comps[:,1])]=1
 
 
     def GiveIm(self,x,y,s):
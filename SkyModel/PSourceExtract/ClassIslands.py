@@ -8,6 +8,25 @@ from DDFacet.Other import MyLogger
 log=MyLogger.getLogger("ClassIsland")
 
 
+def GiveIslandPixelIndex(ImIsland,NIslands):
+    """
+    Builds a compressed (CSR-style) index of the pixels of a label image, as returned by scipy.ndimage.label.
+    Returns X,Y,Offsets: the pixels of label iIsland (1..NIslands) are X[Offsets[iIsland-1]:Offsets[iIsland]]
+    and the same slice of Y, in row-major order. This is one stable sort of the labelled pixels, rather than
+    one pass over the image per island.
+    """
+    _,ny=ImIsland.shape
+    Flat=ImIsland.ravel()
+    ind=np.flatnonzero(Flat)
+    Label=Flat[ind]
+    # mergesort is stable, so pixels stay in row-major order within each island
+    ind=ind[np.argsort(Label,kind="mergesort")]
+    Offsets=np.zeros((NIslands+1,),np.int64)
+    Offsets[1:]=np.cumsum(np.bincount(Label,minlength=NIslands+1)[1:NIslands+1])
+    return ind/ny,ind%ny,Offsets
+
+
+
 class ClassIslands():
     def __init__(self,A,T=None,box=(100,100),MinPerIsland=4,DeltaXYMin=2,Boost=3,DoPlot=False,FillNoise=True,
                  MaskImage=None):
@@ -233,15 +252,13 @@ class ClassIslands():
         #             Island[iIsland-1,NThis,1]=jpix
         #             NIslandNonZero[iIsland-1]+=1
 
-        indx,indy=np.where(self.ImIsland)
-        Label=self.ImIsland[indx,indy]
-        nx=indx.size
+        indx,indy,Offsets=GiveIslandPixelIndex(self.ImIsland,NIslands)
 
         print>>log,"  Listing pixels in islands"
         LIslands=[]
-        for iIsland in range(1,NIslands+1):
-            ind,=np.where(Label==iIsland)
-            LIslands.append(np.array([indx[ind],indy[ind]]).T.tolist())
+        for iIsland in range(NIslands):
+            i0,i1=Offsets[iIsland],Offsets[iIsland+1]
+            LIslands.append(np.array([indx[i0:i1],indy[i0:i1]]).T.tolist())
 
         # ##############################
         # for iPix in range(nx):